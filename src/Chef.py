@@ -1,13 +1,12 @@
 import time
-import pickle
-import socket
 import random
 import logging
 import argparse
-import threading
-import queue
-from ringNode import RingNode
-from utils import recv, send, work
+from collections import deque
+from entity import Entity
+from messages import (COOK_ORDER, COOK_TIME, HANDOVER_ORDER, ORDER, PICKUP, ClientOrder, ClientPickup, EquipmentFree,
+                      EquipmentRequest, HandoverOrder, OrderReady)
+from utils import work, action_time, config, cook_time, ITEMS
 
 
 logging.basicConfig(level=logging.INFO,
@@ -16,228 +15,185 @@ logging.basicConfig(level=logging.INFO,
 
 logger = logging.getLogger('Chef')
 
-class Chef(threading.Thread):
-    def __init__(self, ring_port, ring_size, timeout, port=5002, ide=2):
-        threading.Thread.__init__(self)
-        self.name = 'Chef'
-        self.id = ide
-        self.port = port
-        self.ring_addr = ('localhost', ring_port)
-        if self.port == ring_port:
-            self.ring_addr = None
-        self.ring_size = ring_size
-        self.cook_order = queue.Queue()
-        # holds the order that is beeing cooked
-        self.currently_cooking = {} 
-
-        # Create a logger for the clerk
-        self.logger = logging.getLogger('SIMU - (' + str(self.id) + ') ' + self.name)
-        self.logger.setLevel(logging.INFO)
-
-        # Start communication thread
-        self.comm_thread = RingNode(self.name, self.id, ('localhost', self.port), self.ring_size, self.ring_addr, timeout)
-        self.comm_thread.start()
-
-    def run(self):
-
-        # socket for receiving clients requests
-        client_socket=socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        client_socket.settimeout(3)
-        client_socket.bind(('localhost', self.port + 100))  # client_port = port + 100
-
-        # get entities table
-        entities_table = self.comm_thread.get_nodes_table()
-        while entities_table is None:
-            entities_table = self.comm_thread.get_nodes_table()
-            work(0.5)
+class Chef(Entity):
+    def __init__(self, ring_port, ring_size, timeout, port=5002, ide=2, comm_thread=None, parallelism=None):
+        Entity.__init__(self, 'Chef', ring_port, ring_size, timeout, port, ide, comm_thread)
+        # orders waiting for a free cooking slot
+        self.cook_order = deque()
+        # holds the orders that are beeing cooked, by ticket number: (cook order, portions left of each item)
+        self.currently_cooking = {}
+        # maximum number of orders cooked at the same time
+        if parallelism is None:
+            parallelism = config.getint('CHEF', 'PARALLELISM', fallback = 1)
+        self.parallelism = parallelism
+        # incremented at each status change, so the Clerk knows when the status board is updated
+        self.status_version = 0
+
+        # queued orders are handed over to idle Chefs
+        self.work_stealing = config.getboolean('CHEF', 'WORK_STEALING', fallback = False)
+        self.steal_interval = config.getfloat('CHEF', 'STEAL_INTERVAL', fallback = 0.5)
+        self.steal_timer = False
+        # status version of the idle Chefs when they got an order from 'self'
+        self.handed_over = {}
+
+    # queue depth and estimated cook time left, for the token status board
+    def status(self):
+        remaining = 0
+        for item, left in self.currently_cooking.values():
+            remaining += cook_time(left)
+        for item in self.cook_order:
+            remaining += cook_time(item.order)
+        self.status_version += 1
+        depth = len(self.currently_cooking) + len(self.cook_order)
+        return [self.status_version, depth, remaining, self.parallelism]
+
+    def publish_status(self):
+        self.comm_thread.set_status(self.status())
+        if self.work_stealing:
+            self.balance()
+
+    # hand over queued orders to the Chefs announcing free slots (depth < parallelism) in the status board;
+    # each idle Chef gets at most one order for each status version, and an order is never handed over twice
+    def balance(self):
+        board = self.comm_thread.get_status_board()
+        handed_over = False
+        for chef in self.entities_table['Chef']:
+            if chef == self.id or chef not in board:
+                continue
+            version, depth, remaining, parallelism = board[chef]
+            if depth >= parallelism or self.handed_over.get(chef) == version:
+                continue
+            item = next((item for item in self.cook_order if not item.handed_over), None)
+            if item is None:
+                break
+            self.cook_order.remove(item)
+            self.handed_over[chef] = version
+            handed_over = True
+            self.hand_over(item, chef)
+
+        if handed_over:
+            self.comm_thread.set_status(self.status())
+        # check the status board again while there are queued orders
+        if not self.steal_timer and any(not item.handed_over for item in self.cook_order):
+            self.steal_timer = True
+            self.call_later(self.steal_interval, self.steal_check)
+
+    def steal_check(self):
+        self.steal_timer = False
+        self.balance()
+
+    def hand_over(self, item, chef):
+        self.logger.info('Handing over order No. %s to Chef %s', item.ticket_no, chef)
+        self.comm_thread.put_send_requests(HandoverOrder(item.client_addr, item.order, item.ticket_no, item.issued_at, self.id, chef))
+
+    # idle Chefs are on the status board (and get handed over orders) before their first order
+    def joined(self):
+        self.publish_status()
+
+    # while leaving the ring, the queued orders go to the other Chefs (the ones with less orders first)
+    # and the orders being cooked are finished; the orders handed over to 'self' (never handed over twice)
+    # are cooked here, and the last Chef cooks all its orders
+    def drain(self):
+        chefs = [chef for chef in self.entities_table.get('Chef', []) if chef != self.id]
+        items = [item for item in self.cook_order if not item.handed_over]
+        if chefs and items:
+            board = self.comm_thread.get_status_board()
+            depth = {chef: board.get(chef, [0, 0])[1] for chef in chefs}
+            for item in items:
+                chef = min(chefs, key = depth.get)
+                depth[chef] += 1
+                self.cook_order.remove(item)
+                self.hand_over(item, chef)
+            self.publish_status()
+        while self.cook_order and len(self.currently_cooking) < self.parallelism:
+            self.start_order(self.cook_order.popleft())
+        return not self.cook_order and not self.currently_cooking
+
+    def handle_client(self, o, addr):
+        # Wait for a random time
+        delta = action_time()
+        self.logger.info('Wait for %f seconds', delta)
+        work(delta)
         
-        self.logger.info('Entities table: %s', entities_table)
-
-        done = False
-        while not done:
-
-            # waiting for client order
-            p, addr = recv(client_socket)
-
-            if p is not None:
-
-                # Wait for a random time
-                delta = random.gauss(2, 0.5)
-                self.logger.info('Wait for %f seconds', delta)
-                work(delta)
-                o = pickle.loads(p)
-                
-                method = o['method']
-                self.logger.info('Request received: %s', method)
-
-                # received client order
-                if method == 'ORDER':
-                    self.logger.info('Order: %s', o['args'])
-                    to_send = {'method':'CLIENT_ORDER', 'args':{'client_addr':addr,'order':o['args'], 'id':entities_table['Clerk'][0]}}
-                    self.comm_thread.put_send_requests(to_send)
-                # received client request to pickup his order
-                if method == 'PICKUP':
-                    to_send = {'method':'CLIENT_PICKUP','args':{'client_addr':addr,'order':o['args']['order'],'ticket_no':o['args']['ticket_no'], 'id':entities_table['Waiter'][0]}}
-                    self.comm_thread.put_send_requests(to_send)
-            else:                
-                self.logger.debug('Getting received request')
-                recv_request = self.comm_thread.get_recv_requests()
-                
-                if recv_request is not None:
-                    self.logger.debug('Request received %s', recv_request)
-
-                    method = recv_request['method']
-                    client_addr = recv_request['args']['client_addr']
-                    ticket_no = recv_request['args']['ticket_no']
-
-                    if method == 'COOK_ORDER':
-                        self.logger.info('Cook order No. %s received', ticket_no)
-                        
-                        # not currently cooking
-                        if not any(self.currently_cooking):
-                            
-                            order = recv_request['args']['order']
-
-                            n_fries = 0
-                            n_drink = 0
-                            n_hamburger = 0
-                            
-                            if 'hamburger' in order:
-                                n_hamburger = order['hamburger']
-
-                            if 'fries' in order:
-                                n_fries = order['fries']
-
-                            if 'drink' in order:
-                                n_drink = order['drink']
-
-                            recv_request['args']['fries_cook'] = n_fries
-                            recv_request['args']['hamburger_cook'] = n_hamburger
-                            recv_request['args']['drink_cook'] = n_drink
-                            
-                            args = {}
-                            args['client_addr'] = client_addr
-                            args['ticket_no'] = ticket_no
-                            args['id'] = entities_table['Drive-Through'][0]
-                            args['from'] = self.id
-
-                            self.currently_cooking[ticket_no] = recv_request['args']
-                            
-                            if n_hamburger != 0:
-                                self.logger.info('Requesting Barbecue Grill')
-                                o = {'method': 'REQUEST_BARBECUE_GRILL', 'args': args}
-                            elif n_fries != 0:
-                                self.logger.info('Requesting Fryer')
-                                o = {'method': 'REQUEST_FRYER', 'args': args}
-                            elif n_drink != 0:
-                                self.logger.info('Requesting Bar')
-                                o = {'method': 'REQUEST_BAR', 'args': args}
-
-                            self.comm_thread.put_send_requests(o)
-                        else:
-                            self.cook_order.put(recv_request['args'])
-                       
-                    elif method == 'COOK_TIME':
-                        # after requesting a certain kitchen equipment, chef is ready to cook
-                        equipment = recv_request['args']['equipment']
-                        ticket_no = recv_request['args']['ticket_no']
-                        time = recv_request['args']['time']
-
-                        if equipment == 'fryer':
-                            self.logger.info('Using fryer for %s seconds', time)
-                            self.currently_cooking[ticket_no]['fries_cook'] -= 1
-                            args = {'client_addr': client_addr, 'ticket_no': ticket_no, 'id': entities_table['Drive-Through'][0],'from': self.id}
-                            o = {'method': 'FREE_FRYER', 'args': args}
-
-                        elif equipment == 'barbecue_grill':
-                            self.logger.info('Using barbecue grill for %s seconds', time)
-                            self.currently_cooking[ticket_no]['hamburger_cook'] -= 1
-                            args = {'client_addr': client_addr, 'ticket_no': ticket_no, 'id': entities_table['Drive-Through'][0],'from': self.id}
-                            o = {'method': 'FREE_BARBECUE_GRILL', 'args': args}
-
-                        elif equipment == 'bar':
-                            self.logger.info('Using bar for %s seconds', time)
-                            self.currently_cooking[ticket_no]['drink_cook'] -= 1
-                            args = {'client_addr': client_addr, 'ticket_no': ticket_no, 'id': entities_table['Drive-Through'][0],'from': self.id}
-                            o = {'method': 'FREE_BAR', 'args': args}
-
-                        # simulating work
-                        work(time)
-                        
-                        self.comm_thread.put_send_requests(o)
-
-                        # chef if the order is ready
-                        drinks_left = self.currently_cooking[ticket_no]['drink_cook']
-                        hamburgers_left = self.currently_cooking[ticket_no]['hamburger_cook']
-                        fries_left = self.currently_cooking[ticket_no]['fries_cook']
-                        
-                        if drinks_left == 0 and hamburgers_left == 0 and fries_left == 0:
-                            # Order is ready
-                            self.logger.info('Order No. %s ready', ticket_no)
-                            args = {'client_addr': client_addr, 'ticket_no': ticket_no, 'id': entities_table['Waiter'][0]}
-                            o = {'method': 'ORDER_READY', 'args': args}
-                            del self.currently_cooking[ticket_no]
-
-                            # send to Waiter
-                            self.comm_thread.put_send_requests(o)
-                            
-                            # start preparing the next order in the queue
-                            if self.cook_order.qsize() != 0:
-                                item = self.cook_order.get()
-                                order = item['order']
-                                client_addr = item['client_addr']
-                                ticket_no = item['ticket_no']
-
-
-                                n_fries = 0
-                                n_drink = 0
-                                n_hamburger = 0
-                                
-                                if 'hamburger' in order:
-                                    n_hamburger = order['hamburger']
-
-                                if 'fries' in order:
-                                    n_fries = order['fries']
-                                
-                                if 'drink' in order:
-                                    n_drink = order['drink']
-                                
-                                item['fries_cook'] = n_fries
-                                item['hamburger_cook'] = n_hamburger
-                                item['drink_cook'] = n_drink
-                                
-                                args={}
-                                args['client_addr'] = client_addr
-                                args['ticket_no'] = ticket_no
-                                args['id'] = entities_table['Drive-Through'][0]
-                                args['from'] = self.id
-
-                                self.currently_cooking[ticket_no] = item
-                                
-                                if n_hamburger != 0:
-                                    self.logger.info('Requesting Barbecue Grill')
-                                    o = {'method': 'REQUEST_BARBECUE_GRILL', 'args': args}
-                                elif n_fries != 0:
-                                    self.logger.info('Requesting Fryer')
-                                    o = {'method': 'REQUEST_FRYER', 'args': args}
-                                elif n_drink != 0:
-                                    self.logger.info('Requesting Bar')
-                                    o = {'method': 'REQUEST_BAR', 'args': args}
-                                
-                                self.comm_thread.put_send_requests(o)
-
-                        else:
-                            # if order is not ready, continue requesting kitchen equipments
-                            args = {'client_addr': client_addr, 'ticket_no': ticket_no, 'id': entities_table['Drive-Through'][0],'from':self.id}
-
-                            if self.currently_cooking[ticket_no]['drink_cook'] != 0:
-                                self.logger.info('Requesting Bar')
-                                o = {'method': 'REQUEST_BAR', 'args': args}
-                            elif self.currently_cooking[ticket_no]['hamburger_cook'] != 0:
-                                self.logger.info('Requesting Barbecue Grill')
-                                o = {'method': 'REQUEST_BARBECUE_GRILL', 'args': args}
-                            elif self.currently_cooking[ticket_no]['fries_cook'] != 0:
-                                self.logger.info('Requesting Fryer')
-                                o = {'method': 'REQUEST_FRYER', 'args': args}
-
-                            self.comm_thread.put_send_requests(o)
\ No newline at end of file
+        method = o.method
+        self.logger.info('Request received: %s', method)
+
+        # received client order
+        if method is ORDER:
+            self.logger.info('Order: %s', o.order)
+            self.comm_thread.put_send_requests(ClientOrder(addr, o.order, self.shard('Clerk', addr)))
+        # received client request to pickup his order
+        if method is PICKUP:
+            self.comm_thread.put_send_requests(ClientPickup(addr, o.order, o.ticket_no, self.shard('Waiter', o.ticket_no)))
+
+    # start cooking an order: one request for all the portions of each kitchen equipment
+    def start_order(self, item):
+        left = {name: item.order.get(name, 0) for name in ITEMS.values()}
+        ticket_no = item.ticket_no
+        self.currently_cooking[ticket_no] = (item, left)
+
+        # portions of the whole order, used by the Restaurant scheduler
+        remaining = sum(left.values())
+        requests = 0
+        for equipment, name in [('barbecue_grill', 'Barbecue Grill'), ('fryer', 'Fryer'), ('bar', 'Bar')]:
+            portions = left[ITEMS[equipment]]
+            if portions != 0:
+                self.logger.info('Requesting %s for %s portions', name, portions)
+                self.comm_thread.put_send_requests(EquipmentRequest(equipment, item.client_addr, ticket_no, portions, remaining,
+                                                                    item.issued_at, self.id, self.entities_table['Drive-Through'][0]))
+                requests += 1
+
+        # empty order
+        if requests == 0:
+            self.order_ready(ticket_no)
+
+    # send the cooked order to the Waiter and start the next one in the queue
+    def order_ready(self, ticket_no):
+        item, left = self.currently_cooking.pop(ticket_no)
+        self.logger.info('Order No. %s ready', ticket_no)
+        self.comm_thread.put_send_requests(OrderReady(item.client_addr, ticket_no, self.shard('Waiter', ticket_no)))
+
+        if self.cook_order and not self.leaving:
+            self.start_order(self.cook_order.popleft())
+
+    # called by the entity timer when the equipment lease (COOK_TIME) is over
+    def cooked(self, lease):
+        equipment = lease.equipment
+        ticket_no = lease.ticket_no
+
+        # give the equipment units back
+        self.comm_thread.put_send_requests(EquipmentFree(equipment, lease.client_addr, ticket_no, lease.units, self.id,
+                                                         self.entities_table['Drive-Through'][0]))
+
+        item, left = self.currently_cooking[ticket_no]
+        left[ITEMS[equipment]] -= lease.portions
+
+        # the order is ready when all its equipment leases are over
+        if not any(left.values()):
+            self.order_ready(ticket_no)
+        self.publish_status()
+
+    def handle_request(self, recv_request):
+        method = recv_request.method
+        ticket_no = recv_request.ticket_no
+
+        if method is COOK_ORDER or method is HANDOVER_ORDER:
+            if method is HANDOVER_ORDER:
+                self.logger.info('Cook order No. %s handed over by Chef %s', ticket_no, recv_request.sender)
+            else:
+                self.logger.info('Cook order No. %s received', ticket_no)
+
+            # cook up to 'parallelism' orders at the same time (while leaving, the orders are handed over)
+            if len(self.currently_cooking) < self.parallelism and not self.leaving:
+                self.start_order(recv_request)
+            else:
+                self.cook_order.append(recv_request)
+            self.publish_status()
+
+        elif method is COOK_TIME:
+            # after requesting a certain kitchen equipment, chef is ready to cook
+            self.logger.info('Using %s (units %s) for %s portions in %s seconds', recv_request.equipment.replace('_', ' '),
+                             recv_request.units, recv_request.portions, recv_request.time)
+
+            # the chef keeps handling requests while the item is cooking
+            self.call_later(recv_request.time, self.cooked, recv_request)
@@ -1,14 +1,12 @@
 import time
-import pickle
-import socket
 import random
 import logging
 import argparse
-import threading
-import uuid
+import utils
 
-from ringNode import RingNode
-from utils import recv, send, work, choose_node
+from entity import Entity
+from messages import CLIENT_ORDER, ORDER, PICKUP, ClientPickup, CookOrder, OrderReply
+from utils import send, work, choose_node, action_time, config, cook_time
 
 
 logging.basicConfig(level=logging.INFO,
@@ -17,127 +15,85 @@ logging.basicConfig(level=logging.INFO,
 
 logger = logging.getLogger('Clerk')
 
+DISPATCH_POLICIES = ['round_robin', 'least_loaded', 'power_of_two']
+
+
+class Clerk(Entity):
+    def __init__(self, ring_port, ring_size, timeout, port = 5001, ide = 1, comm_thread = None, dispatch = None):
+        Entity.__init__(self, 'Clerk', ring_port, ring_size, timeout, port, ide, comm_thread)
+
+        # Chef dispatch policy: round_robin, least_loaded or power_of_two
+        if dispatch is None:
+            dispatch = config.get('CLERK', 'DISPATCH', fallback = 'round_robin')
+        if dispatch not in DISPATCH_POLICIES:
+            raise ValueError('Unknown dispatch policy: {}'.format(dispatch))
+        self.dispatch = dispatch
+        # cook time sent to each Chef after its last status: Chef id -> [status version, cook time]
+        self.dispatched = {}
+        # ticket numbers of the orders of this Clerk
+        self.tickets = utils.ticket_numbers(ide)
+
+    # estimated time for the Chef to finish its orders and 'order'
+    def completion_time(self, chef, board, order):
+        # Chefs without status did not receive any order yet
+        version, depth, remaining, parallelism = board.get(chef, [0, 0, 0, 1])
+        sent = self.dispatched.get(chef)
+        if sent is not None and sent[0] == version:
+            remaining += sent[1]
+        return (remaining + cook_time(order)) / parallelism
+
+    # Chef for a new order, following the dispatch policy
+    def choose_chef(self, order):
+        chefs = self.entities_table['Chef']
+        if self.dispatch == 'round_robin' or len(chefs) == 1:
+            return choose_node('Chef', self.entities_table)
+
+        board = self.comm_thread.get_status_board()
+        if self.dispatch == 'power_of_two':
+            chefs = random.sample(chefs, 2)
+        chef = min(chefs, key = lambda c: self.completion_time(c, board, order))
+
+        # the order counts in the Chef load until its status changes
+        version = board.get(chef, [0])[0]
+        sent = self.dispatched.get(chef)
+        if sent is None or sent[0] != version:
+            sent = self.dispatched[chef] = [version, 0]
+        sent[1] += cook_time(order)
+        return chef
+
+    def handle_client(self, o, addr):
+        # Wait for a random time
+        delta = action_time()
+        self.logger.info('Wait for %f seconds', delta)
+        work(delta)
+        
+        method = o.method
+        self.logger.info('Received client request: %s', method)
 
-class Clerk(threading.Thread):
-    def __init__(self, ring_port, ring_size, timeout, port = 5001, ide = 1):
-        threading.Thread.__init__(self)
-        self.name ='Clerk'
-        self.id = ide
-        self.port = port
-        self.ring_addr = ('localhost', ring_port)
-        if self.port == ring_port:
-            self.ring_addr = None
-        self.ring_size = ring_size
-
-        # Create a logger for the clerk
-        self.logger = logging.getLogger('SIMU - (' + str(self.id) + ') ' + self.name)
-        self.logger.setLevel(logging.INFO)
-
-        # Start communication thread
-        self.comm_thread = RingNode(self.name, self.id, ('localhost', self.port), self.ring_size, self.ring_addr, timeout)
-        self.comm_thread.start()
-
-    def run(self):
-        # socket to give clients a ticket number for their order
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        client_socket.settimeout(3)
-        client_socket.bind(('localhost', self.port + 100))
-
-        # get entities table
-        entities_table = self.comm_thread.get_nodes_table()
-        while entities_table is None:
-                entities_table = self.comm_thread.get_nodes_table()
-                work(0.5)
+        if method is ORDER:
+            self.logger.info('Order: %s', o.order)
+            self.issue_ticket(addr, o.order)
+        
+        elif method is PICKUP:
+            self.logger.info('Forwarding pickup request to Waiter')
+            self.comm_thread.put_send_requests(ClientPickup(addr, o.order, o.ticket_no, self.shard('Waiter', o.ticket_no)))
+
+    # send the cook order to one Chef and the ticket number back to the client
+    def issue_ticket(self, client_addr, order):
+        # ticket number to identify client order
+        ticket_no = next(self.tickets)
+
+        self.logger.info('Sending cook order to one Chef')
+        self.comm_thread.put_send_requests(CookOrder(client_addr, order, ticket_no, utils.clock.time(), self.choose_chef(order)))
+
+        self.logger.info('Ticket number: %s', ticket_no)
+        send(self.client_socket, client_addr, OrderReply(ticket_no, order))
+
+    def handle_request(self, request):
+        # Wait for a random time
+        delta = action_time()
+        self.logger.info('Wait for %f seconds', delta)
+        work(delta)
         
-        self.logger.info('Entities table: %s', entities_table)
-
-        # all orders
-        #orders = {}
-
-        done = False
-        while not done:
-            # waiting for client order
-            p, addr = recv(client_socket)
-            if p is not None:
-                # Wait for a random time
-                delta = random.gauss(2, 0.5)
-                self.logger.info('Wait for %f seconds', delta)
-                work(delta)
-                
-                o = pickle.loads(p)
-                
-                method = o['method']
-                self.logger.info('Received client request: %s', method)
-
-                if o['method'] == 'ORDER':
-                    self.logger.info('Order: %s', o['args'])
-                    # ticket number to identify client order
-                    ticket_no = str(uuid.uuid4())
-                    
-                    order = o['args']
-                    #orders[ticket_no] = order
-                    
-                    # send cook order to chef
-                    args = {}
-                    args['client_addr'] = addr
-                    args['order'] = order
-                    args['ticket_no'] = ticket_no
-                    args['id'] = choose_node('Chef', entities_table)
-                    self.logger.info('Sending cook order to one Chef')
-                    self.comm_thread.put_send_requests({'method': 'COOK_ORDER', 'args': args})
-
-                    # send ticket number back to the client
-                    self.logger.info('Ticket number: %s', ticket_no)
-                    args = {'ticket_no': ticket_no, 'order': order}
-                    send(client_socket, addr, {'method': 'ORDER_REP', 'args': args})
-                
-                elif method == 'PICKUP':
-                    args = {}
-                    args['client_addr'] = addr
-                    args['order'] = o['args']['order']
-                    args['ticket_no'] = o['args']['ticket_no']
-                    args['id'] = entities_table['Waiter'][0]
-                    self.logger.info('Forwarding pickup request to Waiter')
-                    self.comm_thread.put_send_requests({'method':'CLIENT_PICKUP', 'args': args})
-                    
-            else:
-                try:
-                    self.logger.debug('Getting received request')
-                    request = self.comm_thread.get_recv_requests()
-                    if request is None:
-                        work(0.5)
-                        continue
-                except:
-                    self.logger.debug('Error getting received request')
-                    continue
-
-                if request is not None:
-                    self.logger.debug('Request %s', request)
-
-                    # Wait for a random time
-                    delta = random.gauss(2, 0.5)
-                    self.logger.info('Wait for %f seconds', delta)
-                    work(delta)
-                    
-                    if request['method'] == 'CLIENT_ORDER':
-                        # ticket number to identify client order
-                        ticket_no = str(uuid.uuid4())
-
-                        client_addr = request['args']['client_addr']
-                        order = request['args']['order']
-                        #orders[ticket_no] = order
-                        
-                        # send cook order to chef
-                        self.logger.info('Sending cook order to one Chef')
-                        args = {}
-                        args['client_addr'] = client_addr
-                        args['order'] = order
-                        args['ticket_no'] = ticket_no
-                        args['id'] = choose_node('Chef',entities_table)
-                        self.comm_thread.put_send_requests({'method': 'COOK_ORDER', 'args': args})
-
-                        # send ticket number back to the client
-                        self.logger.info('Ticket number: %s', ticket_no)
-                        args = {'ticket_no': ticket_no, 'order': order}
-                        send(client_socket, client_addr, {'method': 'ORDER_REP', 'args': args})
-                
\ No newline at end of file
+        if request.method is CLIENT_ORDER:
+            self.issue_ticket(request.client_addr, request.order)
@@ -1,16 +1,10 @@
-import argparse
-import configparser
 import logging
-import time
-import socket
-import pickle
-import threading
-import queue
-import random
-from utils import work, send, recv
+import utils
+from utils import work, action_time, config
 from random import gauss
-from ringNode import RingNode
-from threading import Thread
+from entity import Entity
+from messages import FREE_EQUIPMENT, ORDER, PICKUP, REQUEST_EQUIPMENT, ClientOrder, ClientPickup, CookTime
+from scheduler import create_scheduler
 
 # configure the log with INFO level
 logging.basicConfig(level=logging.INFO,
@@ -33,7 +27,7 @@ class Equipment:
 # BarbecueGrill extends Equipment
 class BarbecueGrill(Equipment):
     def __init__(self, config):
-        mean = config.getint('BARBECUE_GRILL','MEAN') 
+        mean = config.getfloat('BARBECUE_GRILL','MEAN') 
         std_deviation = config.getfloat('BARBECUE_GRILL','STD_DEVIATION') 
         Equipment.__init__(self, mean, std_deviation)
 
@@ -43,7 +37,7 @@ class BarbecueGrill(Equipment):
 # Bar extends Equipment
 class Bar(Equipment):
     def __init__(self, config):
-        mean = config.getint('BAR','MEAN') 
+        mean = config.getfloat('BAR','MEAN') 
         std_deviation = config.getfloat('BAR','STD_DEVIATION') 
         Equipment.__init__(self, mean, std_deviation)
 
@@ -53,7 +47,7 @@ class Bar(Equipment):
 # Fryer extends Equipment
 class Fryer(Equipment):
     def __init__(self, config):
-        mean = config.getint('FRYER','MEAN') 
+        mean = config.getfloat('FRYER','MEAN') 
         std_deviation = config.getfloat('FRYER','STD_DEVIATION')
         Equipment.__init__(self, mean, std_deviation)
     
@@ -61,183 +55,176 @@ class Fryer(Equipment):
         return Equipment.equipment_action(self)
 
 
-class Restaurant(threading.Thread):
-    def __init__(self, ring_port, ring_size, timeout, port = 5000, ide = 0):
-        threading.Thread.__init__(self)
-        self.name = 'Drive-Through'
-        self.id = ide
-        self.port = port
-        self.ring_addr = ('localhost', ring_port)
-        if self.port == ring_port:
-            self.ring_addr = None
-        self.ring_size = ring_size
-
-        # holds the order that is beeing cooked and decrements its value 
-        self.fryer_order = queue.Queue()
-        self.bar_order = queue.Queue()
-        self.barbecue_grill_order = queue.Queue()
-
-        # flags to know if a certain kitchen equipment is beeing used
-        self.using_fryer = None 
-        self.using_bar = None 
-        self.using_barbecue_grill = None 
-
-        # Create a logger for the clerk
-        self.logger = logging.getLogger('SIMU - (' + str(self.id) + ') ' + self.name)
-        self.logger.setLevel(logging.INFO)
-
-        # Start communication thread
-        self.comm_thread = RingNode(self.name, self.id, ('localhost', self.port), self.ring_size, self.ring_addr, timeout)
-        self.comm_thread.start()
-
-    def run(self):
-        # load the configuration file
-        config = configparser.ConfigParser()
-        config.read('../config.ini')
+# one unit of a kitchen equipment, cooking up to 'capacity' portions at the same time
+class EquipmentUnit:
+    def __init__(self, index, capacity):
+        self.index = index
+        self.capacity = capacity
+        # (chef id, ticket number) of the portions beeing cooked
+        self.holders = []
+        # time with at least one portion beeing cooked, and sum of the portions cooking time
+        self.busy_time = 0
+        self.portion_time = 0
+        self.last_change = utils.clock.time()
+
+    def free_slots(self):
+        return self.capacity - len(self.holders)
+
+    # accumulate the busy time until now (called before every change)
+    def update(self):
+        now = utils.clock.time()
+        if self.holders:
+            self.busy_time += now - self.last_change
+            self.portion_time += (now - self.last_change) * len(self.holders)
+        self.last_change = now
+
+    def status(self):
+        self.update()
+        return {'unit': self.index, 'busy': len(self.holders) > 0, 'in_use': len(self.holders), 'capacity': self.capacity,
+                'busy_time': self.busy_time, 'portion_time': self.portion_time}
+
+
+# units of the same kitchen equipment, configured in the equipment section (UNITS and CAPACITY)
+class EquipmentPool:
+    def __init__(self, name, equipment, units = 1, capacity = 1, scheduler = 'fifo'):
+        self.name = name
+        self.label = name.replace('_', ' ').title()
+        self.equipment = equipment
+        self.units = [EquipmentUnit(i, capacity) for i in range(units)]
+        # requests waiting for a free unit, in the scheduler order
+        self.waiting = create_scheduler(scheduler)
+
+    def free_slots(self):
+        return sum(unit.free_slots() for unit in self.units)
+
+    # up to 'count' slots, each one in the least loaded unit with a free slot (one unit per slot, maybe repeated)
+    def acquire(self, holder, count = 1):
+        slots = []
+        while len(slots) < count:
+            best = None
+            for unit in self.units:
+                if unit.free_slots() > 0 and (best is None or len(unit.holders) < len(best.holders)):
+                    best = unit
+            if best is None:
+                break
+            best.update()
+            best.holders.append(holder)
+            slots.append(best)
+        return slots
+
+    # returns False if 'holder' is not using all the units
+    def release(self, indexes, holder):
+        if not indexes or any(not 0 <= i < len(self.units) or holder not in self.units[i].holders for i in indexes):
+            return False
+        for i in indexes:
+            unit = self.units[i]
+            unit.update()
+            unit.holders.remove(holder)
+        return True
+
+    def idle(self):
+        return all(len(unit.holders) == 0 for unit in self.units)
+
+    def status(self):
+        return [unit.status() for unit in self.units]
+
+
+# kitchen equipments with their own class, the others only have MEAN and STD_DEVIATION
+EQUIPMENTS = {'barbecue_grill': BarbecueGrill, 'fryer': Fryer, 'bar': Bar}
+
+def create_pool(config, name, scheduler = 'fifo'):
+    section = name.upper()
+    if name in EQUIPMENTS:
+        equipment = EQUIPMENTS[name](config)
+    else:
+        equipment = Equipment(config.getfloat(section, 'MEAN'), config.getfloat(section, 'STD_DEVIATION'))
+    units = config.getint(section, 'UNITS', fallback = 1)
+    capacity = config.getint(section, 'CAPACITY', fallback = 1)
+    return EquipmentPool(name, equipment, units, capacity, scheduler)
+
+
+class Restaurant(Entity):
+    def __init__(self, ring_port, ring_size, timeout, port = 5000, ide = 0, comm_thread = None, scheduler = None):
+        Entity.__init__(self, 'Drive-Through', ring_port, ring_size, timeout, port, ide, comm_thread)
+
+        # equipment scheduling policy
+        if scheduler is None:
+            scheduler = config.get('RESTAURANT', 'SCHEDULER', fallback = 'fifo')
+        self.scheduler = scheduler
+
+        # create kitchen equipments, listed in the RESTAURANT section
+        names = config.get('RESTAURANT', 'EQUIPMENT', fallback = ', '.join(EQUIPMENTS))
+        self.pools = {}
+        for name in names.split(','):
+            pool = create_pool(config, name.strip(), scheduler)
+            self.pools[pool.name] = pool
+
+    # busy/idle state of every equipment unit
+    def equipment_status(self):
+        return {name: pool.status() for name, pool in self.pools.items()}
+
+    # state of the units of 'pool', logged every time a Chef takes or frees a unit
+    def log_status(self, pool):
+        self.logger.info('%s units: %s', pool.label, '; '.join('unit {} {} ({}/{} portions)'.format(
+            unit.index, 'busy' if unit.holders else 'idle', len(unit.holders), unit.capacity) for unit in pool.units))
+
+    # lease the slots to the Chef for all the portions of 'request', cooked in turns when there are less slots than portions
+    def grant(self, pool, slots, request):
+        portions = request.portions
+        self.logger.info('%s request by Chef %s (%s portions, units %s)', pool.label, request.sender, portions, [unit.index for unit in slots])
+        finish = [0] * len(slots)
+        schedule = []
+        for i in range(portions):
+            slot = finish.index(min(finish))
+            finish[slot] += max(pool.equipment.equipment_action(), 0)
+            schedule.append(finish[slot])
+        self.comm_thread.put_send_requests(CookTime(pool.name, [unit.index for unit in slots], portions, sorted(schedule),
+                                                    max(finish), request.client_addr, request.ticket_no, request.sender))
+
+    def handle_client(self, o, addr):
+        # Wait for a random time
+        delta = action_time()
+        self.logger.info('Wait for %f seconds', delta)
+        work(delta)
         
-        # socket for receiving clients requests
-        client_socket=socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        client_socket.settimeout(3)
-        client_socket.bind(('localhost', self.port + 100)) # client_port = port + 100
-
-        # create kitchen equipments
-        barbecue_grill = BarbecueGrill(config)
-        fryer = Fryer(config)
-        bar = Bar(config)
-
-        
-        # get entities table
-        entities_table = self.comm_thread.get_nodes_table()
-        while entities_table is None:
-            entities_table = self.comm_thread.get_nodes_table()
-            work(0.5)
-        
-        self.logger.info('Entities table: %s', entities_table)
-
-        done = False
-        while not done:
-            # waiting for client order
-            p, addr = recv(client_socket)
-
-            if p is not None:
-
-                # Wait for a random time
-                delta = random.gauss(2, 0.5)
-                self.logger.info('Wait for %f seconds', delta)
-                work(delta)
-                o = pickle.loads(p)
-                
-                method = o['method']
-                self.logger.info('Request received: %s', method)
-                if method == 'ORDER':
-                    self.logger.info('Order: %s', o['args'])
-                    self.logger.info('Forwarding ORDER request to Clerk')
-                    args = {'client_addr': addr,'order': o['args'], 'id': entities_table['Clerk'][0]}
-                    o = {'method':'CLIENT_ORDER', 'args': args}
-                    self.comm_thread.put_send_requests(o)
-                if method == 'PICKUP':
-                    self.logger.info('Forwarding PICKUP request to Waiter')
-                    args = {'client_addr':addr,'order': o['args']['order'],'ticket_no': o['args']['ticket_no'], 'id': entities_table['Waiter'][0]}
-                    o = {'method':'CLIENT_PICKUP', 'args': args}
-                    self.comm_thread.put_send_requests(o)
+        method = o.method
+        self.logger.info('Request received: %s', method)
+        if method is ORDER:
+            self.logger.info('Order: %s', o.order)
+            self.logger.info('Forwarding ORDER request to Clerk')
+            self.comm_thread.put_send_requests(ClientOrder(addr, o.order, self.shard('Clerk', addr)))
+        if method is PICKUP:
+            self.logger.info('Forwarding PICKUP request to Waiter')
+            self.comm_thread.put_send_requests(ClientPickup(addr, o.order, o.ticket_no, self.shard('Waiter', o.ticket_no)))
+
+    def handle_request(self, request):
+        method = request.method
+
+        # check witch kitchen equipment is beeing requested
+        pool = None
+        if method is REQUEST_EQUIPMENT or method is FREE_EQUIPMENT:
+            pool = self.pools.get(request.equipment)
+        if pool is None:
+            self.logger.info('Unknown request: %s', request)
+            return
+
+        # the slots held by each Chef for each order
+        holder = (request.sender, request.ticket_no)
+        if method is REQUEST_EQUIPMENT:
+            slots = pool.acquire(holder, request.portions)
+            if slots:
+                self.grant(pool, slots, request)
+                self.log_status(pool)
             else:
-                request = self.comm_thread.get_recv_requests()
-                
-                if request is not None:
-                    self.logger.debug('Request %s', request)
-                    
-                    client_addr = request['args']['client_addr']
-                    ticket_no = request['args']['ticket_no']
-                    from_id = request['args']['from']
-
-                    # check witch kitchen equipment is beeing requested
-                    if request['method'] == 'REQUEST_BARBECUE_GRILL':
-                        if self.using_barbecue_grill is None:
-                            self.logger.info('Barbecue grill request by Chef %s', from_id)
-                            time = barbecue_grill.to_grill()
-                            args = {'equipment': 'barbecue_grill','time': time, 'client_addr': client_addr, 'ticket_no': ticket_no, 'id': from_id}
-                            o = {'method': 'COOK_TIME', 'args': args}
-                            self.using_barbecue_grill = from_id
-                            self.comm_thread.put_send_requests(o)
-
-                        else:
-                            self.barbecue_grill_order.put({'client_addr':client_addr,'ticket_no':ticket_no,'id':from_id})
-                    elif request['method'] =='REQUEST_FRYER':
-                        if self.using_fryer is None:
-                            self.logger.info('Fryer request by Chef %s', from_id)
-                            time = fryer.to_fry()
-                            args = {'equipment':'fryer','time': time, 'client_addr': client_addr, 'ticket_no': ticket_no, 'id': from_id}
-                            o = {'method': 'COOK_TIME', 'args': args}
-                            self.using_fryer = from_id
-                            self.comm_thread.put_send_requests(o)
-
-                        else:
-                            self.fryer_order.put({'client_addr':client_addr,'ticket_no':ticket_no,'id':from_id})
-
-                    elif request['method'] =='REQUEST_BAR':
-                        if self.using_bar is None:
-                            self.logger.info('Bar request by Chef %s', from_id)
-                            time = bar.prepare_drink()
-                            args = {'equipment':'bar','time': time, 'client_addr': client_addr, 'ticket_no': ticket_no, 'id': from_id}
-                            o = {'method': 'COOK_TIME', 'args': args}
-                            self.using_bar = from_id
-                            self.comm_thread.put_send_requests(o)
-
-                        else:
-                            self.bar_order.put({'client_addr':client_addr,'ticket_no':ticket_no,'id':from_id})
-                    
-                    elif request['method'] == 'FREE_BARBECUE_GRILL':
-                        if self.using_barbecue_grill == from_id:
-                            # check if there are other barbecue grill requests
-                            if self.barbecue_grill_order.qsize() != 0:
-                                req = self.barbecue_grill_order.get()
-                                client_addr = req['client_addr']
-                                ticket_no = req['ticket_no']
-                                from_id = req['id']
-                                self.logger.info('Barbecue Grill request by Chef %s', from_id)
-                                time = barbecue_grill.to_grill()
-                                args = {'equipment':'barbecue_grill','time': time, 'client_addr': client_addr, 'ticket_no': ticket_no, 'id': from_id,'olaaaa':'olaaa'}
-                                o = {'method': 'COOK_TIME', 'args': args}
-                                self.using_barbecue_grill = from_id
-                                self.comm_thread.put_send_requests(o)
-
-                            else:
-                                self.logger.info('Barbecue Grill is free')
-                                self.using_barbecue_grill = None
-                        
-                    elif request['method'] == 'FREE_FRYER':
-                        if self.using_fryer == from_id:
-                            # check if there are other fryer requests
-                            if self.fryer_order.qsize() != 0:
-                                req = self.fryer_order.get()
-                                client_addr = req['client_addr']
-                                ticket_no = req['ticket_no']
-                                from_id = req['id']
-                                self.logger.info('Fryer request by Chef %s', from_id)
-                                time = fryer.to_fry()
-                                args = {'equipment':'fryer','time': time, 'client_addr': client_addr, 'ticket_no': ticket_no, 'id': from_id}
-                                o = {'method': 'COOK_TIME', 'args': args}
-                                self.using_fryer = from_id
-                                self.comm_thread.put_send_requests(o)
-
-                            else:
-                                self.logger.info('Fryer is free')
-                                self.using_fryer = None
-                    elif request['method'] == 'FREE_BAR':
-                        if self.using_bar == from_id:
-                            if self.bar_order.qsize()!=0:
-                                req=self.bar_order.get()
-
-                                client_addr = req['client_addr']
-                                ticket_no = req['ticket_no']
-                                from_id=req['id']
-                                time = bar.prepare_drink()
-                                self.logger.info('Bar request by Chef %s', from_id)
-                                args = {'equipment':'bar','time': time, 'client_addr': client_addr, 'ticket_no': ticket_no, 'id': from_id}
-                                o = {'method': 'COOK_TIME', 'args': args}
-                                self.using_bar = from_id
-                                self.comm_thread.put_send_requests(o)
-
-                            else:
-                                self.logger.info('Bar is free')
-                                self.using_bar = None
\ No newline at end of file
+                # the scheduling policies use the request fields as priorities
+                pool.waiting.push(request)
+
+        elif pool.release(request.units, holder):
+            # check if there are other requests for this equipment
+            while len(pool.waiting) != 0 and pool.free_slots() > 0:
+                req = pool.waiting.pop()
+                slots = pool.acquire((req.sender, req.ticket_no), req.portions)
+                self.grant(pool, slots, req)
+            self.log_status(pool)
+            if pool.idle():
+                self.logger.info('%s is free', pool.label)
@@ -0,0 +1,322 @@
+# coding: utf-8
+
+import argparse
+import collections
+import functools
+import heapq
+import itertools
+import logging
+import random
+import statistics
+import time
+import codec
+import utils
+from Chef import Chef
+from Waiter import Waiter
+from Clerk import Clerk, DISPATCH_POLICIES
+from Restaurant import Restaurant
+from messages import Delivery, Order, OrderReply, Payment, PaymentRequest, Pickup
+from ringNode import FingerTable
+from scheduler import SCHEDULERS
+
+# same log format as the real simulation, with virtual timestamps
+LOG_FORMAT = '%(asctime)s %(name)-25s %(levelname)-8s %(message)s'
+
+
+# simulation time that only moves forward when the entities work
+class VirtualClock:
+    def __init__(self, start = 0.0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(seconds, 0)
+
+
+# writes the virtual time in the log records
+class VirtualTimeFilter(logging.Filter):
+    def __init__(self, clock):
+        logging.Filter.__init__(self)
+        self.clock = clock
+
+    def filter(self, record):
+        record.created = self.clock.now
+        record.msecs = (self.clock.now - int(self.clock.now)) * 1000
+        return True
+
+
+# priority queue of events; each entity handles one event at a time, like its thread
+class EventLoop:
+    def __init__(self, clock):
+        self.clock = clock
+        self.events = []
+        self.sequence = itertools.count()
+        self.busy_until = {}
+        # events that arrived while their entity was working, in order; one 'free' event
+        # (function None) at 'busy_until' takes the first one, so the heap never holds the others
+        self.inboxes = {}
+        self.processed = 0
+
+    def schedule(self, t, entity, function, *args):
+        heapq.heappush(self.events, (t, next(self.sequence), entity, function, args))
+
+    def run(self):
+        events = self.events
+        inboxes = self.inboxes
+        busy_until = self.busy_until
+        while events:
+            t, sequence, entity, function, args = heapq.heappop(events)
+            inbox = None
+            if entity is not None:
+                inbox = inboxes.get(entity)
+                if function is None:
+                    # the entity is free: the first waiting event
+                    function, args = inbox.popleft()
+                elif inbox or t < busy_until.get(entity, 0):
+                    # the entity is still working: keep the event order
+                    if inbox is None:
+                        inbox = inboxes[entity] = collections.deque()
+                    if not inbox:
+                        heapq.heappush(events, (busy_until[entity], next(self.sequence), entity, None, ()))
+                    inbox.append((function, args))
+                    continue
+            self.clock.now = t
+            function(*args)
+            if entity is not None:
+                busy_until[entity] = self.clock.now
+                if inbox:
+                    heapq.heappush(events, (self.clock.now, next(self.sequence), entity, None, ()))
+            self.processed += 1
+
+
+# replaces the RingNode: messages reach their destination after one hop time per ring node
+class VirtualNode:
+    def __init__(self, simulation, name, identification):
+        self.simulation = simulation
+        self.name = name
+        self.id = identification
+
+    def get_nodes_table(self):
+        return self.simulation.nodes_table
+
+    def put_send_requests(self, o):
+        self.simulation.deliver_request(self.id, o)
+
+    # the status board is shared, without the token delay
+    def set_status(self, status):
+        self.simulation.status_board[self.id] = status
+
+    def get_status_board(self):
+        return self.simulation.status_board
+
+
+# replaces the entities client socket
+class VirtualSocket:
+    def __init__(self, simulation, address):
+        self.simulation = simulation
+        self.address = address
+
+    def sendto(self, p, address):
+        self.simulation.deliver_datagram(self.address, address, codec.decode(p))
+
+
+# same steps as client.py
+class VirtualClient:
+    def __init__(self, simulation, port, ring, pickup_ring = None):
+        self.simulation = simulation
+        # not 'localhost', so the clients never share an address with the entities
+        self.address = ('client', port)
+        self.ring = ring
+        self.pickup_ring = ring if pickup_ring is None else pickup_ring
+        self.logger = logging.getLogger('SIMU - Client: ' + str(port))
+        self.state = 'ORDER'
+        self.ticket_no = None
+        self.start = None
+        self.end = None
+
+    def arrive(self):
+        # Wait for a random time
+        delta = random.gauss(2, 0.5)
+        self.logger.info('Wait for %f seconds', delta)
+        self.simulation.loop.schedule(self.simulation.clock.now + max(delta, 0), None, self.order)
+
+    def order(self):
+        self.start = self.simulation.clock.now
+
+        # Make a random request
+        requested_items = {'hamburger': 0, 'drink': 0, 'fries': 0}
+        for i in range(random.randint(1,5)):
+            item_id = random.randint(0,2)
+            requested_items[list(requested_items)[item_id]] += 1
+
+        # Request some food
+        self.logger.info('Request some food...')
+        self.simulation.deliver_datagram(self.address, self.ring, Order(requested_items))
+
+    def receive(self, o, addr):
+        if self.state == 'ORDER' and type(o) is OrderReply:
+            self.logger.info('Received ticket %s', o.ticket_no)
+            # Pickup order
+            self.logger.info('Pickup order No. %s', o.ticket_no)
+            self.ticket_no = o.ticket_no
+            self.state = 'PICKUP'
+            self.simulation.deliver_datagram(self.address, self.pickup_ring, Pickup(o.ticket_no, o.order))
+        elif self.state in ('PICKUP', 'PAYMENT') and type(o) is PaymentRequest and o.ticket_no == self.ticket_no:
+            # the Waiter that takes over the ticket when a Waiter leaves sends the payment request again
+            self.logger.info('Received total amount to pay: $%s', o.amount)
+            # Send payment
+            self.logger.info('Sending payment with total amount of: $%s', o.amount)
+            self.state = 'PAYMENT'
+            self.simulation.deliver_datagram(self.address, addr, Payment(o.amount, self.ticket_no))
+        elif self.state == 'PAYMENT' and type(o) is Delivery and o.ticket_no == self.ticket_no:
+            self.logger.info('Order received: %s', o.order)
+            self.logger.info('Leaving Drive-Through')
+            self.state = 'DONE'
+            self.end = self.simulation.clock.now
+            self.simulation.finished += 1
+        else:
+            self.logger.warning('Unexpected reply from %s in state %s: %s', addr, self.state, o)
+
+
+class VirtualSimulation:
+    def __init__(self, no_chefs = 1, start = 0.0, scheduler = None, chef_parallelism = None, dispatch = None, no_clerks = 1, no_waiters = 1):
+        self.clock = VirtualClock(start)
+        self.loop = EventLoop(self.clock)
+        self.hop_time = utils.config.getfloat('SIMULATION', 'HOP_TIME', fallback = 0.0005)
+        self.finished = 0
+        self.ring_messages = 0
+        self.status_board = {}
+        utils.clock = self.clock
+
+        # same layout as Simulation.main, with optional extra Chefs, Clerks and Waiters (after id 3)
+        ring_size = 1 + no_clerks + no_chefs + no_waiters
+        chef_ids = [2] + list(range(4, 3 + no_chefs))
+        clerk_ids = [1] + list(range(3 + no_chefs, 2 + no_chefs + no_clerks))
+        waiter_ids = [3] + list(range(2 + no_chefs + no_clerks, ring_size))
+        self.nodes_table = {'Drive-Through': [0], 'Clerk': clerk_ids, 'Chef': chef_ids, 'Waiter': waiter_ids}
+        self.ring = list(range(ring_size))
+        self.routing = utils.config.get('TOKEN', 'ROUTING', fallback = 'token')
+        self.finger_tables = {ide: FingerTable(self.ring, ide) for ide in self.ring}
+
+        entities = [Restaurant(5000, ring_size, 3, 5000, 0, VirtualNode(self, 'Drive-Through', 0), scheduler)]
+        for ide in clerk_ids:
+            entities.append(Clerk(5000, ring_size, 3, 5000 + ide, ide, VirtualNode(self, 'Clerk', ide), dispatch))
+        for ide in waiter_ids:
+            entities.append(Waiter(5000, ring_size, 3, 5000 + ide, ide, VirtualNode(self, 'Waiter', ide)))
+        # 'chef_parallelism' gives the parallelism of each Chef, in turns (heterogeneous Chefs)
+        for i, ide in enumerate(chef_ids):
+            parallelism = None if chef_parallelism is None else chef_parallelism[i % len(chef_parallelism)]
+            entities.append(Chef(5000, ring_size, 3, 5000 + ide, ide, VirtualNode(self, 'Chef', ide), parallelism))
+
+        self.entities = {}
+        self.addresses = {}
+        for entity in entities:
+            entity.entities_table = self.nodes_table
+            entity.client_socket = VirtualSocket(self, ('localhost', entity.port + 100))
+            # entity timers are events of the simulation
+            entity.call_later = functools.partial(self.call_later, entity)
+            self.entities[entity.id] = entity
+            self.addresses[entity.client_socket.address] = entity
+        for entity in entities:
+            entity.joined()
+
+    def call_later(self, entity, delay, function, *args):
+        self.loop.schedule(self.clock.now + max(delay, 0), entity, function, *args)
+
+    # ring message from one entity to another, one hop time per ring node
+    def deliver_request(self, from_id, o):
+        self.ring_messages += 1
+        to_id = o.id
+        if self.routing == 'direct':
+            hops = 1
+        elif self.routing == 'finger':
+            hops = 0
+            node = from_id
+            while node != to_id:
+                node = self.finger_tables[node].next_hop(to_id)
+                hops += 1
+        else:
+            hops = (self.ring.index(to_id) - self.ring.index(from_id)) % len(self.ring)
+        if hops == 0:
+            hops = len(self.ring)
+        entity = self.entities[to_id]
+        self.loop.schedule(self.clock.now + hops * self.hop_time, entity, entity.handle_request, o)
+
+    # client datagram to an entity, or entity datagram to a client
+    def deliver_datagram(self, from_addr, to_addr, o):
+        if to_addr in self.addresses:
+            entity = self.addresses[to_addr]
+            self.loop.schedule(self.clock.now, entity, entity.handle_client, o, from_addr)
+        else:
+            client = self.clients[to_addr]
+            self.loop.schedule(self.clock.now, None, client.receive, o, from_addr)
+
+    # with 'spread', the clients send the orders to a random Clerk and the pickups to a random Waiter
+    def run(self, no_clients, rate, access_port, spread = False):
+        # Poisson arrivals with 'rate' clients per second
+        self.clients = {}
+        t = self.clock.now
+        for i in range(no_clients):
+            t += random.expovariate(rate)
+            if spread:
+                clerk = random.choice(self.nodes_table['Clerk'])
+                waiter = random.choice(self.nodes_table['Waiter'])
+                client = VirtualClient(self, 5005 + i, ('localhost', 5100 + clerk), ('localhost', 5100 + waiter))
+            else:
+                client = VirtualClient(self, 5005 + i, ('localhost', access_port))
+            self.clients[client.address] = client
+            self.loop.schedule(t, None, client.arrive)
+
+        self.loop.run()
+        return [client.end - client.start for client in self.clients.values() if client.end is not None]
+
+
+def main(no_clients, rate, no_chefs, access_port, seed, quiet, scheduler = None, dispatch = None):
+    random.seed(seed)
+    simulation = VirtualSimulation(no_chefs, time.time(), scheduler, dispatch = dispatch)
+
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT, datefmt='%m-%d %H:%M:%S', force=True,
+                        handlers=[logging.FileHandler('{0}/{1}.log'.format('./logs', 'simulation'), mode='w'),
+                                  logging.StreamHandler()])
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(VirtualTimeFilter(simulation.clock))
+    if quiet:
+        logging.disable(logging.INFO)
+
+    start = time.time()
+    virtual_start = simulation.clock.now
+    latencies = simulation.run(no_clients, rate, access_port)
+    elapsed = time.time() - start
+
+    print('Orders delivered: {} of {}'.format(len(latencies), no_clients))
+    print('Virtual time: {:.1f} s; wall time: {:.1f} s; events: {}'.format(
+        simulation.clock.now - virtual_start, elapsed, simulation.loop.processed))
+    if latencies:
+        latencies.sort()
+        print('Order latency: mean {:.2f} s; p50 {:.2f} s; p95 {:.2f} s; p99 {:.2f} s'.format(
+            statistics.mean(latencies), latencies[len(latencies) // 2],
+            latencies[int(len(latencies) * 0.95)], latencies[int(len(latencies) * 0.99)]))
+        print('Ring messages per order: {:.1f}'.format(simulation.ring_messages / len(latencies)))
+
+    # busy time of each equipment unit
+    duration = max(simulation.clock.now - virtual_start, 1e-9)
+    for name, units in simulation.entities[0].equipment_status().items():
+        print('{}: {}'.format(name, '; '.join('unit {} busy {:.0%} ({:.2f} portions)'.format(
+            unit['unit'], unit['busy_time'] / duration, unit['portion_time'] / duration) for unit in units)))
+    return latencies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Virtual-time simulation argument parser')
+    parser.add_argument('-c', dest='no_clients', type=int, help='number of clients', default=10)
+    parser.add_argument('-r', dest='rate', type=float, help='clients arrival rate (per second)', default=0.1)
+    parser.add_argument('-k', dest='no_chefs', type=int, help='number of chefs', default=1)
+    parser.add_argument('-a', dest='access_port', type=int, help='access port', default=5100)
+    parser.add_argument('-s', dest='seed', type=int, help='random seed', default=None)
+    parser.add_argument('-p', dest='scheduler', choices=list(SCHEDULERS), help='equipment scheduling policy', default=None)
+    parser.add_argument('-d', dest='dispatch', choices=DISPATCH_POLICIES, help='Chef dispatch policy', default=None)
+    parser.add_argument('-q', dest='quiet', action='store_true', help='only print the results')
+    args = parser.parse_args()
+    main(args.no_clients, args.rate, args.no_chefs, args.access_port, args.seed, args.quiet, args.scheduler, args.dispatch)
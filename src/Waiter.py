@@ -1,15 +1,13 @@
 # coding: utf-8
 
-import configparser
 import time
-import pickle
-import socket
 import random
 import logging
 import argparse
-import threading
-from ringNode import RingNode
-from utils import work, send, recv
+import utils
+from entity import Entity
+from messages import CLIENT_PICKUP, ORDER, ORDER_READY, PAYMENT, PICKUP, TICKET_HANDOVER, ClientOrder, ClientPickup, Delivery, PaymentRequest, TicketHandover
+from utils import work, send, action_time, config
 
 
 logging.basicConfig(level=logging.INFO,
@@ -17,145 +15,206 @@ logging.basicConfig(level=logging.INFO,
                     datefmt='%m-%d %H:%M:%S')
 
 
-class Waiter(threading.Thread):
-    def __init__(self, ring_port, ring_size, timeout, port = 5003, ide = 3):
-        threading.Thread.__init__(self)
-        self.name = 'Waiter'
-        self.id = ide
-        self.port = port
-        self.ring_addr = ('localhost', ring_port)
-        if self.port == ring_port:
-            self.ring_addr = None
-        self.ring_size = ring_size
+# payment of one ticket: BILLED until the client pays (PAID) or the payment timeout (EXPIRED)
+class PaymentSession:
+    def __init__(self, ticket_no, client_addr, order, amount, deadline):
+        self.ticket_no = ticket_no
+        self.client_addr = client_addr
+        self.order = order
+        self.amount = amount
+        self.deadline = deadline
+        self.state = 'BILLED'
 
-        # Create a logger for the clerk
-        self.logger = logging.getLogger('SIMU - (' + str(self.id) + ') ' + self.name)
-        self.logger.setLevel(logging.INFO)
 
-        # Start communication thread
-        self.comm_thread = RingNode(self.name, self.id, ('localhost', self.port), self.ring_size, self.ring_addr, timeout)
-        self.comm_thread.start()
-
-        # load the configuration file
-        self.config = configparser.ConfigParser()
-        self.config.read('../config.ini')
+class Waiter(Entity):
+    def __init__(self, ring_port, ring_size, timeout, port = 5003, ide = 3, comm_thread = None):
+        Entity.__init__(self, 'Waiter', ring_port, ring_size, timeout, port, ide, comm_thread)
 
         # items price
-        self.fries_price = self.config.getint('PRICE', 'FRIES')
-        self.drink_price = self.config.getint('PRICE', 'DRINK')
-        self.hamburger_price = self.config.getint('PRICE', 'HAMBURGER')
+        self.fries_price = config.getint('PRICE', 'FRIES')
+        self.drink_price = config.getint('PRICE', 'DRINK')
+        self.hamburger_price = config.getint('PRICE', 'HAMBURGER')
+
+        # pending pickup orders
+        self.pending_order = {}
+        # cooked orders whose pickup request did not arrive yet, by ticket number
+        self.ready_order = {}
+        # payment sessions of the billed orders, by ticket number
+        self.payments = {}
+        self.payment_timeout = config.getfloat('WAITER', 'PAYMENT_TIMEOUT', fallback = 60)
     
     # calculate total order cost
     def order_cost(self, order):
         # Wait for a random time
-        delta = random.gauss(2, 0.5)
+        delta = action_time()
         self.logger.info('Calculating order cost for %f seconds', delta)
         work(delta)
-        total_cost = order['fries'] * self.fries_price
-        total_cost += order['drink'] * self.drink_price
-        total_cost +=  order['hamburger'] * self.hamburger_price
+        total_cost = order.get('fries', 0) * self.fries_price
+        total_cost += order.get('drink', 0) * self.drink_price
+        total_cost +=  order.get('hamburger', 0) * self.hamburger_price
         return total_cost
-                
 
-    def run(self):
-        # socket for sending the finished request back to the client
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        client_socket.settimeout(3)
-        client_socket.bind(('localhost', self.port + 100))
+    # send the payment request of a cooked and picked up order
+    def bill(self, ticket_no, client_addr):
+        order = self.pending_order[ticket_no]
+        del self.pending_order[ticket_no]
+        
+        # get order total cost
+        order_cost = self.order_cost(order)
+
+        self.logger.info('Payment request for order No. %s', ticket_no)
+        self.logger.info('Total cost: $%s', order_cost)
+        # the order is delivered when the client payment arrives
+        deadline = utils.clock.time() + self.payment_timeout
+        self.open_session(PaymentSession(ticket_no, client_addr, order, order_cost, deadline))
+
+    # wait for the payment of a bill (also sent again by the Waiter that takes over the ticket)
+    def open_session(self, session):
+        self.payments[session.ticket_no] = session
+        self.call_later(session.deadline - utils.clock.time(), self.expire, session.ticket_no)
+        send(self.client_socket, session.client_addr, PaymentRequest(session.ticket_no, session.amount))
+
+    # pickup request of a ticket: billed at once if the order is ready
+    def pickup(self, ticket_no, order):
+        if ticket_no not in self.pending_order:
+            self.pending_order[ticket_no] = order
+        if ticket_no in self.ready_order:
+            self.bill(ticket_no, self.ready_order.pop(ticket_no))
+
+    # cooked order of a ticket: billed when the client pickup request arrives
+    def order_ready(self, ticket_no, client_addr):
+        if ticket_no in self.pending_order:
+            self.bill(ticket_no, client_addr)
+        else:
+            self.ready_order[ticket_no] = client_addr
+
+    # give the state of a ticket to the Waiter that owns it now
+    def hand_over(self, ticket_no):
+        waiter = self.shard('Waiter', ticket_no)
+        self.logger.info('Handing over ticket No. %s to Waiter %s', ticket_no, waiter)
+        session = self.payments.pop(ticket_no, None)
+        if session is not None:
+            o = TicketHandover(ticket_no, session.order, session.client_addr, session.amount, session.deadline, self.id, waiter)
+        elif ticket_no in self.ready_order:
+            o = TicketHandover(ticket_no, None, self.ready_order.pop(ticket_no), None, None, self.id, waiter)
+        else:
+            o = TicketHandover(ticket_no, self.pending_order.pop(ticket_no), None, None, None, self.id, waiter)
+        self.comm_thread.put_send_requests(o)
+
+    # after a Waiter joined or left, the tickets of the shards that moved go to their new Waiter
+    def rebalance(self):
+        for tickets in (self.pending_order, self.ready_order, self.payments):
+            for ticket_no in [ticket_no for ticket_no in tickets if self.shard('Waiter', ticket_no) != self.id]:
+                self.hand_over(ticket_no)
+
+    # while leaving the ring, every ticket goes to its new Waiter (once 'self' is out of the nodes table)
+    def drain(self):
+        if self.id in self.entities_table['Waiter']:
+            return False
+        self.rebalance()
+        return not self.pending_order and not self.ready_order and not self.payments
+
+    # payment session of a client payment, matched by ticket number and client address
+    def payment_session(self, o, addr):
+        ticket_no = o.ticket_no
+        if ticket_no is None:
+            # clients that do not send the ticket number: oldest bill of the client address
+            sessions = [session for session in self.payments.values() if session.client_addr == addr]
+            return min(sessions, key = lambda session: session.deadline) if sessions else None
+        session = self.payments.get(ticket_no)
+        if session is not None and session.client_addr == addr:
+            return session
+        return None
+
+    def pay(self, session, amount):
+        self.logger.info('Received payment amount of $%s for order No. %s', amount, session.ticket_no)
+        if amount < session.amount:
+            self.logger.warning('Payment of $%s is not enough, total cost: $%s', amount, session.amount)
+            return
+        session.state = 'PAID'
+        del self.payments[session.ticket_no]
+        self.logger.info('Order ready: %s', session.order)
+        self.logger.info('Sending finished order to client address: %s', session.client_addr)
+        send(self.client_socket, session.client_addr, Delivery(session.ticket_no, session.order))
+
+    # called by the entity timer when the payment timeout is over
+    def expire(self, ticket_no):
+        session = self.payments.get(ticket_no)
+        if session is not None and session.state == 'BILLED' and utils.clock.time() >= session.deadline:
+            session.state = 'EXPIRED'
+            del self.payments[ticket_no]
+            self.logger.warning('Payment of order No. %s expired', ticket_no)
+
+    def handle_client(self, o, addr):
+        # client payment does not wait for the random time
+        if o.method is PAYMENT:
+            session = self.payment_session(o, addr)
+            if session is None:
+                self.logger.warning('Payment from %s without a bill', addr)
+            else:
+                self.pay(session, o.amount)
+            return
 
-        # pending pickup orders
-        pending_order = {}
+        # Wait for a random time
+        delta = action_time()
+        self.logger.info('Wait for %f seconds', delta)
+        work(delta)
 
-        # get entities table
-        entities_table = self.comm_thread.get_nodes_table()
-        while entities_table is None:
-                entities_table = self.comm_thread.get_nodes_table()
-                work(0.5)
-        
-        self.logger.info('Entities table: %s', entities_table)
-
-        done = False    
-        while not done:
-                # waiting for client pickup request
-                p, addr = recv(client_socket)
-
-                if p is not None:
-                    # Wait for a random time
-                    delta = random.gauss(2, 0.5)
-                    self.logger.info('Wait for %f seconds', delta)
-                    work(delta)
-                    o = pickle.loads(p)
-
-                    method = o['method']
-                    self.logger.info('Received client request: %s', method)
-
-                    if method == 'PICKUP':
-                        ticket_no = o['args']['ticket_no']
-                        self.logger.info('Client pickup request')
-                        if ticket_no not in pending_order:
-                            pending_order[ticket_no] = o['args']['order']
-
-                    elif method == 'ORDER':
-                        self.logger.info('Order: %s', o['args'])
-                        self.logger.info('Forwarding ORDER request to Clerk')
-                        to_send = {'method':'CLIENT_ORDER','args':{'client_addr':addr,'order':o['args'], 'id':entities_table['Clerk'][0]}}
-                        self.comm_thread.put_send_requests(to_send)
-                    
+        method = o.method
+        self.logger.info('Received client request: %s', method)
+
+        if method is PICKUP:
+            ticket_no = o.ticket_no
+            self.logger.info('Client pickup request')
+            waiter = self.shard('Waiter', ticket_no)
+            if waiter != self.id:
+                # the ticket belongs to another Waiter
+                self.logger.info('Forwarding pickup request to Waiter %s', waiter)
+                self.comm_thread.put_send_requests(ClientPickup(addr, o.order, ticket_no, waiter))
+            else:
+                self.pickup(ticket_no, o.order)
+
+        elif method is ORDER:
+            self.logger.info('Order: %s', o.order)
+            self.logger.info('Forwarding ORDER request to Clerk')
+            self.comm_thread.put_send_requests(ClientOrder(addr, o.order, self.shard('Clerk', addr)))
+
+    def handle_request(self, recv_request):
+        # Wait for a random time
+        delta = action_time()
+        self.logger.info('Wait for %f seconds', delta)
+        work(delta)
+                
+        # token parsing
+        method = recv_request.method
+        client_addr = recv_request.client_addr
+        ticket_no = recv_request.ticket_no
+
+        self.logger.info('Received %s request', method)
+
+        if method is CLIENT_PICKUP:
+            self.logger.info('Client pickup request')
+            self.pickup(ticket_no, recv_request.order)
+
+        elif method is ORDER_READY:
+            self.order_ready(ticket_no, client_addr)
+
+        elif method is TICKET_HANDOVER:
+            self.logger.info('Ticket No. %s handed over by Waiter %s', ticket_no, recv_request.sender)
+            if recv_request.amount is not None:
+                session = PaymentSession(ticket_no, client_addr, recv_request.order, recv_request.amount, recv_request.deadline)
+                if self.shard('Waiter', ticket_no) != self.id:
+                    # handed over again below
+                    self.payments[ticket_no] = session
                 else:
-
-                    try:    
-                        self.logger.debug('Getting received request')
-                        recv_request = self.comm_thread.get_recv_requests()
-                        if recv_request is None:
-                            work(0.5)
-                            continue
-                    except:
-                        self.logger.debug('Error getting received request')
-                        continue
-
-                    if recv_request is not None:
-                        # Wait for a random time
-                        delta = random.gauss(2, 0.5)
-                        self.logger.info('Wait for %f seconds', delta)
-                        work(delta)
-                        
-                        
-                                
-                        # token parsing
-                        method = recv_request['method']
-                        client_addr = recv_request['args']['client_addr']
-                        ticket_no = recv_request['args']['ticket_no']
-
-                        self.logger.info('Received %s request', method)
-
-                        if method == 'CLIENT_PICKUP':
-                            self.logger.info('Client pickup request')
-                            order = recv_request['args']['order']
-                            if ticket_no not in list(pending_order.keys()):
-                                pending_order[ticket_no] = order
-                        
-                        elif method == 'ORDER_READY':
-                            if ticket_no in list(pending_order.keys()):
-                                order = pending_order[ticket_no]
-                                del pending_order[ticket_no]
-                                
-                                # get order total cost
-                                order_cost = self.order_cost(order)
-
-                                self.logger.info('Payment request for order No. %s', ticket_no)
-                                self.logger.info('Total cost: $%s', order_cost)
-                                send(client_socket, client_addr, order_cost)
-
-                                payed = False
-                                while not payed:
-                                    # waiting for client payment
-                                    p, addr = recv(client_socket)
-
-                                    if p is not None:
-                                        o = pickle.loads(p)
-                                        self.logger.info('Received payment amount of $%s', o['amount'])
-                                        self.logger.info('Order ready: %s', order)
-                                        self.logger.info('Sending finished order to client address: %s', client_addr)
-                                        send(client_socket, client_addr, order)
-                                        payed = True
-            
+                    # the client payment may have gone to the old Waiter: the bill is sent again
+                    self.open_session(session)
+            elif client_addr is not None:
+                self.order_ready(ticket_no, client_addr)
+            else:
+                self.pickup(ticket_no, recv_request.order)
+
+        # requests sent before the sender saw a Waiter join or leave
+        if ticket_no in self.pending_order or ticket_no in self.ready_order or ticket_no in self.payments:
+            if self.shard('Waiter', ticket_no) != self.id:
+                self.hand_over(ticket_no)
@@ -0,0 +1,875 @@
+# coding: utf-8
+
+import argparse
+import asyncio
+import codec
+import itertools
+import json
+import logging
+import os
+import pickle
+import queue
+import random
+import selectors
+import socket
+import statistics
+import sys
+import threading
+import time
+import timeit
+import tracemalloc
+import uuid
+import loadgen
+import utils
+from ringNode import RingNode, FingerTable
+from Chef import Chef
+from Waiter import Waiter
+from Clerk import Clerk, DISPATCH_POLICIES
+from Restaurant import Restaurant
+from scheduler import SCHEDULERS
+from sharding import HashRing
+from VirtualSimulation import VirtualSimulation
+from launcher import Launcher, default_layout
+from messages import ORDER_READY, ClientPickup, CookOrder, CookTime, EquipmentRequest, Order, OrderReady
+
+# only the benchmark results are printed
+logging.disable(logging.INFO)
+
+ENTITIES = ['Drive-Through', 'Clerk', 'Chef', 'Waiter']
+
+# end-to-end scenarios of the benchmark suite
+SCENARIOS = {
+    'idle': {'chefs': 1, 'sessions': 0, 'duration': 2},
+    'steady': {'chefs': 1, 'sessions': 300, 'rate': 40, 'profile': 'poisson'},
+    'burst': {'chefs': 1, 'sessions': 300, 'rate': 40, 'profile': 'burst', 'burst_size': 50},
+    'multi_chef': {'chefs': 3, 'sessions': 300, 'rate': 80, 'profile': 'poisson'},
+    # more sessions: with 13 Chefs the tail latency of 300 sessions depends on a few orders
+    'large_ring': {'chefs': 13, 'sessions': 600, 'rate': 80, 'profile': 'poisson'},
+}
+
+# metrics compared with the baseline (True if higher is better)
+METRICS = {'throughput': True, 'p50': False, 'p95': False, 'p99': False, 'rotation_ms': False, 'cpu_total': False}
+# tail latencies of a few hundred sessions change more between runs: compared with their own threshold
+TAIL_METRICS = ['p95', 'p99']
+
+
+# start a ring of communication nodes (without the simulation entities)
+def start_ring(base_port, names = ENTITIES, **kwargs):
+    nodes = []
+    for i, name in enumerate(names):
+        ring_addr = None if i == 0 else ('localhost', base_port)
+        node = RingNode(name, i, ('localhost', base_port + i), len(names), ring_addr, **kwargs)
+        node.daemon = True
+        node.start()
+        nodes.append(node)
+
+    for node in nodes:
+        node.ready.wait()
+    return nodes
+
+
+# orders per second delivered from the Clerk to the Chef, for each token batch size
+def token_batch(base_port, no_orders, batch_sizes):
+    results = {}
+    tickets = utils.ticket_numbers(1)
+    for batch_size in batch_sizes:
+        clerk, chef = start_ring(base_port, batch_size = batch_size)[1:3]
+        base_port += 10
+
+        start = time.time()
+        for i in range(no_orders):
+            clerk.put_send_requests(CookOrder(('localhost', 5006), {'hamburger': 2, 'drink': 1, 'fries': 1}, next(tickets), 0, chef.id))
+
+        received = 0
+        while received < no_orders:
+            if chef.get_recv_requests() is None:
+                time.sleep(0.0005)
+            else:
+                received += 1
+        elapsed = time.time() - start
+
+        results[batch_size] = no_orders / elapsed
+        print('Batch size {:3d}: {:8.1f} orders/s'.format(batch_size, results[batch_size]))
+    return results
+
+
+# per-hop token latency and enqueue-to-wake-up dispatch latency (Clerk -> Chef)
+def hop_latency(base_port, no_samples):
+    nodes = start_ring(base_port)
+    clerk, chef = nodes[1:3]
+
+    selector = selectors.DefaultSelector()
+    selector.register(chef.wakeup_recv, selectors.EVENT_READ)
+
+    dispatch = []
+    for i in range(no_samples):
+        o = OrderReady(('localhost', 5006), i, chef.id)
+        start = time.perf_counter()
+        clerk.put_send_requests(o)
+        selector.select()
+        dispatch.append(time.perf_counter() - start)
+        chef.wakeup_recv.recv(4096)
+        chef.get_recv_requests()
+
+    hop = [t / len(nodes) for t in nodes[0].rotation_times]
+    print('Per-hop latency:   median {:.3f} ms'.format(statistics.median(hop) * 1000))
+    print('Dispatch latency:  median {:.3f} ms; p99 {:.3f} ms'.format(
+        statistics.median(dispatch) * 1000, sorted(dispatch)[int(len(dispatch) * 0.99)] * 1000))
+
+
+# per-hop latency and CPU of a token going around without parking, dispatch latency (Clerk -> Chef) of small
+# and big (16 KB) messages, and messages per second sent back to back, for each transport
+def transport_cost(base_port, no_samples, transports = ('udp', 'local', 'tcp', 'unix'), duration = 2, big_size = 16384):
+    print('{:9s} {:>8s} {:>11s} {:>13s} {:>8s} {:>8s} {:>9s}'.format('transport', 'hop us', 'hop CPU us', 'dispatch ms', 'p99 ms',
+                                                              'big ms', 'msgs/s'))
+    for transport in transports:
+        nodes = start_ring(base_port, parking = False, transport = transport)
+        base_port += len(nodes)
+        clerk, chef = nodes[1:3]
+
+        time.sleep(0.2)
+        start = time.perf_counter()
+        cpu_start = sum(time.clock_gettime(time.pthread_getcpuclockid(node.ident)) for node in nodes)
+        time.sleep(duration)
+        cpu = sum(time.clock_gettime(time.pthread_getcpuclockid(node.ident)) for node in nodes) - cpu_start
+        elapsed = time.perf_counter() - start
+        hop = statistics.median(nodes[0].rotation_times) / len(nodes)
+
+        selector = selectors.DefaultSelector()
+        selector.register(chef.wakeup_recv, selectors.EVENT_READ)
+        latencies = {}
+        for size in [0, big_size]:
+            latencies[size] = []
+            for i in range(no_samples if size == 0 else no_samples // 10):
+                if size:
+                    o = ClientPickup(('localhost', 5006), {'x' * size: 1}, i, chef.id)
+                else:
+                    o = OrderReady(('localhost', 5006), i, chef.id)
+                start = time.perf_counter()
+                clerk.put_send_requests(o)
+                selector.select()
+                latencies[size].append(time.perf_counter() - start)
+                chef.wakeup_recv.recv(4096)
+                chef.get_recv_requests()
+            latencies[size].sort()
+
+        start = time.perf_counter()
+        for i in range(no_samples):
+            clerk.put_send_requests(OrderReady(('localhost', 5006), i, chef.id))
+        for i in range(no_samples):
+            chef.recv_requests.get()
+        throughput = no_samples / (time.perf_counter() - start)
+        selector.close()
+        for node in nodes:
+            node.stop()
+
+        dispatch, big = latencies[0], latencies[big_size]
+        print('{:9s} {:>8.1f} {:>11.1f} {:>13.3f} {:>8.3f} {:>8.3f} {:>9.0f}'.format(transport, hop * 1e6, cpu / (elapsed / hop) * 1e6,
+            dispatch[len(dispatch) // 2] * 1000, dispatch[int(len(dispatch) * 0.99)] * 1000, big[len(big) // 2] * 1000, throughput))
+
+
+# delivery latency of a directed message to the predecessor (farthest node), for each routing and ring size
+def routing_latency(base_port, no_samples, ring_sizes = (4, 32, 256)):
+    print('{:>6s} {:8s} {:>10s} {:>12s} {:>12s}'.format('nodes', 'routing', 'hops', 'median ms', 'p99 ms'))
+    for ring_size in ring_sizes:
+        ids = list(range(ring_size))
+        destination = ring_size - 1
+        for routing in ['token', 'finger', 'direct']:
+            nodes = start_ring(base_port, ['Chef'] * ring_size, routing = routing)
+            base_port += ring_size
+            source, target = nodes[0], nodes[destination]
+            # the finger tables are built at the end of the node discovery
+            while routing != 'token' and any(node.finger_table is None for node in nodes):
+                time.sleep(0.01)
+
+            if routing == 'token':
+                hops = destination
+            elif routing == 'finger':
+                hops, node = 0, 0
+                while node != destination:
+                    node = FingerTable(ids, node).next_hop(destination)
+                    hops += 1
+            else:
+                hops = 1
+
+            selector = selectors.DefaultSelector()
+            selector.register(target.wakeup_recv, selectors.EVENT_READ)
+            latencies = []
+            for i in range(no_samples):
+                o = OrderReady(('localhost', 5006), i, destination)
+                start = time.perf_counter()
+                source.put_send_requests(o)
+                selector.select()
+                latencies.append(time.perf_counter() - start)
+                target.wakeup_recv.recv(4096)
+                target.get_recv_requests()
+            selector.close()
+            for node in nodes:
+                node.stop()
+
+            latencies.sort()
+            print('{:>6d} {:8s} {:>10d} {:>12.3f} {:>12.3f}'.format(ring_size, routing, hops,
+                latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000))
+
+
+# CPU used by an idle ring and latency of the first message after an idle period, with and without token parking
+def token_parking(base_port, no_samples, ring_size = 4, idle_time = 2):
+    print('{:8s} {:>14s} {:>12s} {:>12s}'.format('parking', 'idle CPU %', 'median ms', 'p99 ms'))
+    for parking in [False, True]:
+        nodes = start_ring(base_port, ['Chef'] * ring_size, parking = parking)
+        base_port += ring_size
+        source, target = nodes[1], nodes[-1]
+
+        # CPU of all the nodes while the ring is idle
+        time.sleep(0.5)
+        start = sum(time.clock_gettime(time.pthread_getcpuclockid(node.ident)) for node in nodes)
+        time.sleep(idle_time)
+        cpu = sum(time.clock_gettime(time.pthread_getcpuclockid(node.ident)) for node in nodes) - start
+
+        # wake-up latency: each message is sent after the token is idle again
+        selector = selectors.DefaultSelector()
+        selector.register(target.wakeup_recv, selectors.EVENT_READ)
+        latencies = []
+        for i in range(no_samples):
+            time.sleep(0.02)
+            o = OrderReady(('localhost', 5006), i, target.id)
+            start = time.perf_counter()
+            source.put_send_requests(o)
+            selector.select()
+            latencies.append(time.perf_counter() - start)
+            target.wakeup_recv.recv(4096)
+            target.get_recv_requests()
+        selector.close()
+        for node in nodes:
+            node.stop()
+
+        latencies.sort()
+        print('{:8s} {:>14.1f} {:>12.3f} {:>12.3f}'.format(str(parking), cpu / idle_time * 100,
+            latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000))
+
+
+# recovery time after a lost token datagram: a steady stream of messages goes from one node to another
+# and, every 'interval' seconds, the token sent by the node in the middle of the ring is dropped
+def token_loss(base_port, no_losses, ring_size = 4, loss_timeouts = (0.05, 0.2), interval = 0.5):
+    # the claims are logged as warnings
+    logging.disable(logging.WARNING)
+    print('{:>10s} {:>12s} {:>12s} {:>8s} {:>10s} {:>11s}'.format('timeout s', 'median ms', 'max ms', 'sent', 'delivered', 'duplicates'))
+    for loss_timeout in loss_timeouts:
+        nodes = start_ring(base_port, ['Chef'] * ring_size, loss_timeout = loss_timeout)
+        base_port += ring_size
+        source, lossy, target = nodes[1], nodes[ring_size // 2], nodes[-1]
+
+        # the next 'to_drop[0]' tokens sent by 'lossy' are dropped, at the 'drops' times
+        to_drop = [0]
+        drops = []
+        send = lossy.send
+        def lossy_send(address, o):
+            if o['method'] == 'TOKEN' and o['args']['method'] == 'FRAME' and to_drop[0] > 0:
+                to_drop[0] -= 1
+                drops.append(time.perf_counter())
+                return
+            send(address, o)
+        lossy.send = lossy_send
+
+        # delivery time of each message
+        delivered = []
+        def consume():
+            while True:
+                request = target.recv_requests.get()
+                if request is None:
+                    break
+                delivered.append((time.perf_counter(), request.ticket_no))
+        consumer = threading.Thread(target = consume, daemon = True)
+        consumer.start()
+
+        sent = 0
+        end = time.perf_counter() + interval
+        while len(drops) < no_losses or time.perf_counter() < end:
+            source.put_send_requests(OrderReady(('localhost', 5006), sent, target.id))
+            sent += 1
+            time.sleep(0.001)
+            if time.perf_counter() >= end and len(drops) < no_losses:
+                to_drop[0] = 1
+                end = time.perf_counter() + interval
+
+        # wait for the last messages
+        deadline = time.perf_counter() + 5
+        while len(delivered) < sent and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        target.recv_requests.put(None)
+        consumer.join()
+        for node in nodes:
+            node.stop()
+
+        # recovery: from the dropped token to the next delivered message
+        times = [t for t, ticket_no in delivered]
+        recovery = sorted(next(t for t in times if t > drop) - drop for drop in drops)
+        tickets = [ticket_no for t, ticket_no in delivered]
+        print('{:>10.3f} {:>12.1f} {:>12.1f} {:>8d} {:>10d} {:>11d}'.format(loss_timeout, recovery[len(recovery) // 2] * 1000,
+            recovery[-1] * 1000, sent, len(set(tickets)), len(tickets) - len(set(tickets))))
+    logging.disable(logging.INFO)
+
+
+# time from the start of the nodes until all of them have the nodes table ('ready') and got the first token frame,
+# for each ring size: dynamic join with the old 3 s retry, dynamic join with fast retries and a static seed list;
+# the initial node starts last, so the first join requests are lost
+def ring_formation(base_port, ring_sizes = (4, 16, 64, 250, 500), timeout = 60):
+    modes = {'join 3 s': {'join_retry': 3}, 'join': {}, 'seeds': {}}
+    print('{:>6s} {:10s} {:>10s} {:>14s}'.format('nodes', 'mode', 'ready s', 'first frame s'))
+    for ring_size in ring_sizes:
+        for mode, kwargs in modes.items():
+            if mode == 'seeds':
+                kwargs = {'seeds': {i: ('Chef', ('localhost', base_port + i)) for i in range(ring_size)}}
+            start = time.perf_counter()
+            nodes = []
+            for i in reversed(range(ring_size)):
+                ring_addr = None if i == 0 else ('localhost', base_port)
+                node = RingNode('Chef', i, ('localhost', base_port + i), ring_size, ring_addr, **kwargs)
+                node.daemon = True
+                node.start()
+                nodes.append(node)
+            base_port += ring_size
+
+            deadline = start + timeout
+            ready = all(node.ready.wait(max(deadline - time.perf_counter(), 0)) for node in nodes)
+            ready_time = time.perf_counter() - start
+            while any(node.last_token_time is None for node in nodes) and time.perf_counter() < deadline:
+                time.sleep(0.001)
+            frame_time = time.perf_counter() - start
+            for node in nodes:
+                node.stop()
+            for node in nodes:
+                node.join()
+
+            if ready and frame_time < timeout:
+                print('{:>6d} {:10s} {:>10.3f} {:>14.3f}'.format(ring_size, mode, ready_time, frame_time))
+            else:
+                print('{:>6d} {:10s} {:>10s} {:>14s}'.format(ring_size, mode, '-', '> {} s'.format(timeout)))
+
+
+# datagram receive path under sustained load: recvfrom (a new bytes object for each datagram) against
+# recvfrom_into a reusable buffer, decoding each token datagram; the memory allocated by each receive call
+# (tracemalloc peak during the call) and for the whole run, and datagrams per second (without tracemalloc)
+def receive_path(no_datagrams, batch = 100):
+    o = CookOrder(('127.0.0.1', 5006), {'hamburger': 2, 'drink': 1, 'fries': 1}, next(utils.ticket_numbers(1)), 0, 2)
+    token = codec.encode_message({'method': 'TOKEN', 'args': {'method': 'FRAME', 'args': [o] * 4}})
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('localhost', 0))
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = receiver.getsockname()
+    buffer = codec.ReceiveBuffer()
+    paths = {'recvfrom': lambda: receiver.recvfrom(codec.MAX_DATAGRAM), 'recvfrom_into': lambda: buffer.recvfrom(receiver)}
+
+    print('{} bytes datagrams'.format(len(token)))
+    print('{:14s} {:>14s} {:>14s} {:>14s}'.format('path', 'bytes/receive', 'run peak KB', 'datagrams/s'))
+    for name, receive in paths.items():
+        results = []
+        for traced in [True, False]:
+            if traced:
+                tracemalloc.start()
+            start_memory = tracemalloc.get_traced_memory()[0] if traced else 0
+            allocated = 0
+            elapsed = 0
+            for i in range(no_datagrams // batch):
+                for j in range(batch):
+                    sender.sendto(token, address)
+                start = time.perf_counter()
+                for j in range(batch):
+                    if traced:
+                        current = tracemalloc.get_traced_memory()[0]
+                        tracemalloc.reset_peak()
+                        p, addr = receive()
+                        allocated += tracemalloc.get_traced_memory()[1] - current
+                    else:
+                        p, addr = receive()
+                    codec.decode(p)
+                elapsed += time.perf_counter() - start
+            if traced:
+                peak = tracemalloc.get_traced_memory()[1] - start_memory
+                tracemalloc.stop()
+                results += [allocated / no_datagrams, peak / 1024]
+            else:
+                results.append(no_datagrams / elapsed)
+        print('{:14s} {:>14.0f} {:>14.1f} {:>14.0f}'.format(name, *results))
+    receiver.close()
+    sender.close()
+
+
+# encode/decode time and size of the codec messages, compared with pickle
+def codec_cost(no_samples):
+    tickets = utils.ticket_numbers(1)
+
+    def cook_order():
+        return CookOrder(('127.0.0.1', 5006), {'hamburger': 2, 'drink': 1, 'fries': 1}, next(tickets), 1.5e9, 2, (1, 100))
+    messages = {
+        'ORDER': Order({'hamburger': 2, 'drink': 1, 'fries': 1}),
+        'COOK_ORDER': cook_order(),
+        'COOK_TIME': CookTime('fryer', [0], 1, [4.87], 4.87, ('127.0.0.1', 5006), next(tickets), 2, (0, 100)),
+        'TOKEN (4 msg)': {'method': 'TOKEN', 'args': {'method': 'FRAME', 'args': [cook_order() for i in range(4)]}},
+    }
+
+    print('{:15s} {:>12s} {:>12s} {:>8s}'.format('message', 'encode ns', 'decode ns', 'bytes'))
+    for name, o in messages.items():
+        p = pickle.dumps(o)
+        b = bytes(codec.encode_message(o))
+        for label, encode, decode, data in (('pickle', pickle.dumps, pickle.loads, p), ('codec', codec.encode_message, codec.decode, b)):
+            encode_ns = timeit.timeit(lambda: encode(o), number = no_samples) / no_samples * 1e9
+            decode_ns = timeit.timeit(lambda: decode(data), number = no_samples) / no_samples * 1e9
+            print('{:15s} {:>12.0f} {:>12.0f} {:>8d}  {}'.format(name, encode_ns, decode_ns, len(data), label))
+
+
+# nested dict messages (built like the entities built them) against the message classes, with the same fields:
+# time to build a message, memory of each message (without the shared order and address), encoded size, encode
+# and decode time, and time to read the method and three fields, like the entity handlers
+def message_cost(no_samples):
+    address = ('127.0.0.1', 5006)
+    order = {'hamburger': 2, 'drink': 1, 'fries': 1}
+    ticket_no = next(utils.ticket_numbers(1))
+
+    def cook_order():
+        args = {}
+        args['client_addr'] = address
+        args['order'] = order
+        args['ticket_no'] = ticket_no
+        args['issued_at'] = 1.5e9
+        args['id'] = 2
+        return {'method': 'COOK_ORDER', 'args': args}
+
+    kinds = {
+        'COOK_ORDER': (cook_order, lambda: CookOrder(address, order, ticket_no, 1.5e9, 2)),
+        'REQUEST_FRYER': (
+            lambda: {'method': 'REQUEST_FRYER', 'args': {'client_addr': address, 'ticket_no': ticket_no, 'portions': 2, 'remaining': 4,
+                                                         'issued_at': 1.5e9, 'id': 0, 'from': 2}},
+            lambda: EquipmentRequest('fryer', address, ticket_no, 2, 4, 1.5e9, 2, 0)),
+        'COOK_TIME': (
+            lambda: {'method': 'COOK_TIME', 'args': {'equipment': 'fryer', 'units': [0], 'portions': 2, 'schedule': [4.8, 9.7], 'time': 9.7,
+                                                     'client_addr': address, 'ticket_no': ticket_no, 'id': 2}},
+            lambda: CookTime('fryer', [0], 2, [4.8, 9.7], 9.7, address, ticket_no, 2)),
+        'ORDER_READY': (
+            lambda: {'method': 'ORDER_READY', 'args': {'client_addr': address, 'ticket_no': ticket_no, 'id': 3}},
+            lambda: OrderReady(address, ticket_no, 3)),
+    }
+
+    def read_dict(o):
+        args = o['args']
+        return o['method'] == 'ORDER_READY', args['client_addr'], args['ticket_no'], args['id']
+
+    def read_class(o):
+        return o.method is ORDER_READY, o.client_addr, o.ticket_no, o.id
+
+    # best of many short runs (the CPU of a virtual machine is often taken away for a while)
+    def best_ns(function):
+        return min(timeit.repeat(function, number = 500, repeat = max(no_samples // 500, 5))) / 500 * 1e9
+
+    print('{:14s} {:6s} {:>9s} {:>9s} {:>9s} {:>10s} {:>10s} {:>8s}'.format('message', 'form', 'build ns', 'bytes', 'encoded',
+                                                                         'encode ns', 'decode ns', 'read ns'))
+    for name, builders in kinds.items():
+        for form, build, read in zip(['dict', 'class'], builders, [read_dict, read_class]):
+            tracemalloc.start()
+            start = tracemalloc.get_traced_memory()[0]
+            built = [build() for i in range(1000)]
+            memory = (tracemalloc.get_traced_memory()[0] - start - sys.getsizeof(built)) / len(built)
+            tracemalloc.stop()
+
+            # sent messages have the sequence number of the sender
+            o = build()
+            if form == 'dict':
+                o['args']['msg_id'] = [2, 100]
+            else:
+                o.msg_id = (2, 100)
+            data = bytes(codec.encode_message(o))
+            print('{:14s} {:6s} {:>9.0f} {:>9.0f} {:>9d} {:>10.0f} {:>10.0f} {:>8.0f}'.format(name, form, best_ns(build), memory, len(data),
+                best_ns(lambda: codec.encode_message(o)), best_ns(lambda: codec.decode(data)), best_ns(lambda: read(o))))
+
+
+# uuid4 strings against the compact ticket numbers: time to issue a ticket, size of the messages with a ticket
+# and memory of each in-flight order in a dict by ticket (e.g. Chef.currently_cooking), the ticket included
+# (with dict messages: the message classes only take integer tickets)
+def ticket_cost(no_tickets):
+    kinds = {'uuid4': lambda: str(uuid.uuid4()), 'compact': utils.ticket_numbers(1).__next__}
+    order = {'hamburger': 2, 'drink': 1, 'fries': 1}
+
+    def cook_order(ticket_no):
+        return {'method': 'COOK_ORDER', 'args': {'client_addr': ('127.0.0.1', 5006), 'order': order, 'ticket_no': ticket_no, 'id': 2}}
+
+    print('{:10s} {:>10s} {:>12s} {:>12s} {:>12s} {:>12s}'.format('ticket', 'issue ns', 'COOK_ORDER', 'TOKEN (4)', 'pickled', 'dict B/order'))
+    for name, issue in kinds.items():
+        issue_ns = timeit.timeit(issue, number = no_tickets) / no_tickets * 1e9
+        message = cook_order(issue())
+        token = {'method': 'TOKEN', 'args': {'method': 'FRAME', 'args': [cook_order(issue()) for i in range(4)]}}
+
+        tracemalloc.start()
+        start = tracemalloc.get_traced_memory()[0]
+        in_flight = {}
+        for i in range(no_tickets):
+            in_flight[issue()] = order
+        memory = tracemalloc.get_traced_memory()[0] - start
+        tracemalloc.stop()
+        del in_flight
+        print('{:10s} {:>10.0f} {:>12d} {:>12d} {:>12d} {:>12.0f}'.format(name, issue_ns, len(codec.encode_message(message)),
+            len(codec.encode_message(token)), len(pickle.dumps(message)), memory / no_tickets))
+
+
+# order completion time of each equipment scheduling policy (virtual time, with a single fryer slot)
+def scheduler_policies(no_orders, rate = 0.12, no_chefs = 3, seed = 1):
+    utils.config.set('FRYER', 'UNITS', '1')
+    utils.config.set('FRYER', 'CAPACITY', '1')
+    print('{:16s} {:>8s} {:>8s} {:>8s} {:>8s}'.format('policy', 'mean s', 'p50 s', 'p95 s', 'p99 s'))
+    for name in SCHEDULERS:
+        random.seed(seed)
+        latencies = sorted(VirtualSimulation(no_chefs, scheduler = name).run(no_orders, rate, 5100))
+        print('{:16s} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f}'.format(name, statistics.mean(latencies), latencies[len(latencies) // 2],
+            latencies[int(len(latencies) * 0.95)], latencies[int(len(latencies) * 0.99)]))
+
+
+def plenty_of_equipment():
+    for section in ['BARBECUE_GRILL', 'BAR', 'FRYER']:
+        utils.config.set(section, 'UNITS', '16')
+        utils.config.set(section, 'CAPACITY', '4')
+
+
+# fast entities and plenty of equipment, so the Chefs are the bottleneck
+def chef_bound():
+    utils.config.set('ACTION_TIME', 'MEAN', '0.1')
+    utils.config.set('ACTION_TIME', 'STD_DEVIATION', '0.05')
+    plenty_of_equipment()
+
+
+# order completion time of each Chef dispatch policy, with and without work stealing,
+# with heterogeneous Chefs (virtual time)
+def chef_dispatch(no_orders, stealing = ('no',), chef_counts = (2, 4, 8), chef_parallelism = (1, 4), load = 0.8, seed = 1):
+    chef_bound()
+    print('{:6s} {:>7s} {:14s} {:9s} {:>8s} {:>8s} {:>8s}'.format('chefs', 'rate', 'policy', 'stealing', 'mean s', 'p95 s', 'p99 s'))
+    for no_chefs in chef_counts:
+        # about 8 seconds to cook an order, 'parallelism' orders at the same time
+        capacity = sum(chef_parallelism[i % len(chef_parallelism)] for i in range(no_chefs)) / 8
+        rate = load * capacity
+        for work_stealing in stealing:
+            utils.config.set('CHEF', 'WORK_STEALING', work_stealing)
+            for policy in DISPATCH_POLICIES:
+                random.seed(seed)
+                simulation = VirtualSimulation(no_chefs, chef_parallelism = chef_parallelism, dispatch = policy)
+                latencies = sorted(simulation.run(no_orders, rate, 5100))
+                print('{:<6d} {:>7.2f} {:14s} {:9s} {:>8.1f} {:>8.1f} {:>8.1f}'.format(no_chefs, rate, policy, work_stealing,
+                    statistics.mean(latencies), latencies[int(len(latencies) * 0.95)], latencies[int(len(latencies) * 0.99)]))
+
+
+# throughput with 1 to 'max_nodes' Clerks and Waiters (tickets sharded by consistent hashing), in virtual time,
+# and the tickets moved to another Waiter when one Waiter is added
+def sharding(no_orders, max_nodes = 4, rate = 2, seed = 1):
+    plenty_of_equipment()
+    # saturated Waiters take longer than the payment timeout to read the payments
+    utils.config.set('WAITER', 'PAYMENT_TIMEOUT', '1e9')
+    tickets = list(itertools.islice(utils.ticket_numbers(1), 10000))
+    print('{:>7s} {:>12s} {:>8s} {:>8s} {:>8s}'.format('nodes', 'orders/s', 'mean s', 'p99 s', 'moved'))
+    for no_nodes in range(1, max_nodes + 1):
+        random.seed(seed)
+        simulation = VirtualSimulation(8, chef_parallelism = (3,), no_clerks = no_nodes, no_waiters = no_nodes)
+        clients = simulation.run(no_orders, rate, 5100, spread = True)
+        latencies = sorted(clients)
+        ends = [client.end for client in simulation.clients.values() if client.end is not None]
+        starts = [client.start for client in simulation.clients.values() if client.start is not None]
+        throughput = len(ends) / (max(ends) - min(starts))
+
+        # tickets of the last Waiter, that were owned by the others before it joined
+        waiters = simulation.nodes_table['Waiter']
+        moved = ''
+        if len(waiters) > 1:
+            before, after = HashRing(waiters[:-1]), HashRing(waiters)
+            moved = '{:.0%}'.format(sum(before.node(ticket) != after.node(ticket) for ticket in tickets) / len(tickets))
+        print('{:>7d} {:>12.3f} {:>8.1f} {:>8.1f} {:>8s}'.format(no_nodes, throughput, statistics.mean(latencies),
+            latencies[int(len(latencies) * 0.99)], moved))
+
+
+# scale all the action and equipment times (e.g. 0.001 turns seconds into milliseconds)
+def scale_times(scale):
+    for section in ['ACTION_TIME', 'BARBECUE_GRILL', 'BAR', 'FRYER']:
+        for option in ['MEAN', 'STD_DEVIATION']:
+            utils.config.set(section, option, str(utils.config.getfloat(section, option) * scale))
+
+
+# start the entities in this process, like Simulation.main (with 'no_chefs' Chefs)
+def start_restaurant(base_port, no_chefs):
+    ring_size = 3 + no_chefs
+    entities = [Restaurant(base_port, ring_size, 3, base_port, 0),
+                Clerk(base_port, ring_size, 3, base_port + 1, 1),
+                Chef(base_port, ring_size, 3, base_port + 2, 2),
+                Waiter(base_port, ring_size, 3, base_port + 3, 3)]
+    for ide in range(4, ring_size):
+        entities.append(Chef(base_port, ring_size, 3, base_port + ide, ide))
+    for entity in entities:
+        entity.start()
+
+    deadline = time.time() + 30
+    for entity in entities:
+        while entity.entities_table is None:
+            if time.time() > deadline:
+                raise RuntimeError('Ring not formed (ports {}-{} in use?)'.format(base_port, base_port + ring_size - 1))
+            time.sleep(0.01)
+    return entities
+
+
+# a Chef (or Waiter) joins the running restaurant after a third of the sessions, and the first one leaves after
+# two thirds: time until the Clerk sees each change, orders started (or billed) by each node in each phase,
+# and the client latency
+def membership(base_port, no_sessions, role = 'Chef', rate = 60, scale = 0.001, timeout = 20):
+    scale_times(scale)
+    entities = start_restaurant(base_port, 1)
+    clerk, first = entities[1], entities[ENTITIES.index(role)]
+    # method called once for each order of the node
+    counted_method = {'Chef': 'start_order', 'Waiter': 'bill'}[role]
+    phase = ['1 ' + role]
+    started = {}
+    def count_orders(node):
+        method = getattr(node, counted_method)
+        def counted(*args):
+            started[phase[0], node.id] = started.get((phase[0], node.id), 0) + 1
+            method(*args)
+        setattr(node, counted_method, counted)
+    count_orders(first)
+
+    result = {}
+    def load():
+        mix = {'hamburger': 1, 'drink': 1, 'fries': 1}
+        result['stats'] = asyncio.run(loadgen.generate(('localhost', base_port + 100), no_sessions, rate, 'poisson', 1, mix, timeout))
+    generator = threading.Thread(target = load)
+    generator.start()
+    duration = no_sessions / rate
+
+    time.sleep(duration / 3)
+    ide = len(entities)
+    node = {'Chef': Chef, 'Waiter': Waiter}[role](base_port, ide + 1, 3, base_port + ide, ide)
+    count_orders(node)
+    start = time.perf_counter()
+    node.start()
+    while ide not in clerk.entities_table[role]:
+        time.sleep(0.001)
+    join_time = time.perf_counter() - start
+    phase[0] = '2 {}s'.format(role)
+    entities.append(node)
+
+    time.sleep(duration / 3)
+    start = time.perf_counter()
+    first.leave()
+    while first.id in clerk.entities_table[role]:
+        time.sleep(0.001)
+    leave_time = time.perf_counter() - start
+    phase[0] = 'after leave'
+    first.comm_thread.join()
+    unlink_time = time.perf_counter() - start
+
+    generator.join()
+    for entity in entities:
+        entity.stop()
+
+    summary = result['stats'].summary()
+    print('{}: join: {:.1f} ms; leave: {:.1f} ms (out of the ring after {:.1f} ms)'.format(role, join_time * 1000, leave_time * 1000, unlink_time * 1000))
+    for name in ['1 ' + role, '2 {}s'.format(role), 'after leave']:
+        print('{:12s} {}'.format(name, '; '.join('{} {}: {} orders'.format(role, node_id, started.get((name, node_id), 0))
+                                                  for node_id in [first.id, node.id])))
+    print('completed: {} of {}; failed: {}; p50 {:.3f} s; p99 {:.3f} s'.format(summary['completed'], summary['started'],
+        sum(summary['failed'].values()), summary['total']['p50'], summary['total']['p99']))
+
+
+# throughput and client latency of the entities as threads of this process (one GIL for all of them)
+# and as one process each (launcher.py); the clients arrive at 'rate' per Chef
+def process_layout(base_port, no_sessions, chef_counts = (1, 3), rate = 50, scale = 0.001, timeout = 20):
+    scale_times(scale)
+    print('{} CPUs'.format(os.cpu_count()))
+    print('{:>6s} {:10s} {:>10s} {:>10s} {:>8s} {:>8s}'.format('chefs', 'layout', 'orders/s', 'completed', 'p50 s', 'p99 s'))
+    mix = {'hamburger': 1, 'drink': 1, 'fries': 1}
+    for no_chefs in chef_counts:
+        for layout in ['threads', 'processes']:
+            if layout == 'threads':
+                entities = start_restaurant(base_port, no_chefs)
+            else:
+                launcher = Launcher(default_layout('localhost', base_port, no_chefs), console = False)
+                launcher.start()
+                if not launcher.wait_ready(30):
+                    raise RuntimeError('Ring not formed (ports {}-{} in use?)'.format(base_port, base_port + no_chefs + 2))
+
+            start = time.time()
+            stats = asyncio.run(loadgen.generate(('localhost', base_port + 100), no_sessions, rate * no_chefs, 'poisson', 1, mix, timeout))
+            elapsed = time.time() - start
+            if layout == 'threads':
+                for entity in entities:
+                    entity.stop()
+            else:
+                launcher.stop()
+            base_port += 200
+
+            summary = stats.summary()
+            print('{:>6d} {:10s} {:>10.1f} {:>10d} {:>8.3f} {:>8.3f}'.format(no_chefs, layout, summary['completed'] / elapsed,
+                summary['completed'], summary['total']['p50'], summary['total']['p99']))
+
+
+# CPU time used by the threads of each node (entity and communication thread)
+def nodes_cpu_time(entities):
+    cpu = {}
+    for entity in entities:
+        threads = [entity, entity.comm_thread]
+        cpu['({}) {}'.format(entity.id, entity.name)] = sum(
+            time.clock_gettime(time.pthread_getcpuclockid(thread.ident)) for thread in threads)
+    return cpu
+
+
+def run_scenario(name, base_port, timeout):
+    scenario = SCENARIOS[name]
+    entities = start_restaurant(base_port, scenario['chefs'])
+    restaurant = entities[0]
+    restaurant.comm_thread.rotation_times.clear()
+    cpu_start = nodes_cpu_time(entities)
+
+    start = time.time()
+    if scenario['sessions'] > 0:
+        mix = {'hamburger': 1, 'drink': 1, 'fries': 1}
+        stats = asyncio.run(loadgen.generate(('localhost', base_port + 100), scenario['sessions'], scenario['rate'],
+                                             scenario['profile'], scenario.get('burst_size', 1), mix, timeout))
+        summary = stats.summary()
+    else:
+        time.sleep(scenario['duration'])
+        summary = {'completed': 0}
+    elapsed = time.time() - start
+
+    cpu_end = nodes_cpu_time(entities)
+    for entity in entities:
+        entity.stop()
+
+    rotation = list(restaurant.comm_thread.rotation_times)
+    result = {'completed': summary['completed'],
+              'throughput': summary['completed'] / elapsed,
+              'rotation_ms': statistics.median(rotation) * 1000 if rotation else None,
+              'cpu': {node: (cpu_end[node] - cpu_start[node]) / elapsed * 100 for node in cpu_end}}
+    result['cpu_total'] = sum(result['cpu'].values())
+    if 'total' in summary:
+        for percentile in ['p50', 'p95', 'p99']:
+            result[percentile] = summary['total'][percentile]
+        result['failed'] = sum(summary['failed'].values())
+    return result
+
+
+# median of each metric over several runs of one scenario
+def median_result(runs):
+    result = {}
+    for key, value in runs[0].items():
+        if key == 'cpu':
+            result[key] = {node: statistics.median(run[key][node] for run in runs) for node in value}
+        elif key in ('completed', 'failed'):
+            result[key] = statistics.median_low(run[key] for run in runs)
+        elif value is not None:
+            result[key] = statistics.median(run[key] for run in runs)
+        else:
+            result[key] = None
+    return result
+
+
+def print_result(name, result):
+    print('[{}]'.format(name))
+    print('  throughput:     {:.1f} orders/s ({} completed)'.format(result['throughput'], result['completed']))
+    if 'p50' in result:
+        print('  order latency:  p50 {:.3f} s; p95 {:.3f} s; p99 {:.3f} s ({} failed)'.format(
+            result['p50'], result['p95'], result['p99'], result['failed']))
+    if result['rotation_ms'] is not None:
+        print('  token rotation: {:.3f} ms (median)'.format(result['rotation_ms']))
+    print('  CPU per node:   ' + '; '.join('{} {:.1f}%'.format(node, cpu) for node, cpu in result['cpu'].items()))
+
+
+# compare two runs; returns the regressions bigger than 'threshold' (relative), 'tail_threshold' for p95 and p99
+def compare(results, baseline, threshold, tail_threshold):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            new, old = result.get(metric), baseline[name].get(metric)
+            if new is None or old is None or old == 0:
+                continue
+            change = (new - old) / old
+            limit = tail_threshold if metric in TAIL_METRICS else threshold
+            regression = change < -limit if higher_is_better else change > limit
+            print('{:12s} {:12s} {:>12.4f} -> {:>12.4f} ({:+.1f}%){}'.format(
+                name, metric, old, new, change * 100, '  REGRESSION' if regression else ''))
+            if regression:
+                regressions.append((name, metric, change))
+    return regressions
+
+
+# each scenario runs 'runs' times and its metrics are the medians of the runs
+def suite(base_port, names, scale, timeout, output, baseline, threshold, tail_threshold = 0.5, runs = 3):
+    scale_times(scale)
+    results = {}
+    for i, name in enumerate(names):
+        results[name] = median_result([run_scenario(name, base_port + (i * runs + run) * 200, timeout) for run in range(runs)])
+        print_result(name, results[name])
+    results = {'scale': scale, 'runs': runs, 'scenarios': results}
+
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if baseline is not None:
+        with open(baseline) as f:
+            baseline = json.load(f)
+        if baseline['scale'] != scale:
+            print('Warning: baseline time scale is {}'.format(baseline['scale']))
+        if baseline.get('runs', 1) != runs:
+            print('Warning: baseline medians of {} runs'.format(baseline.get('runs', 1)))
+        return compare(results['scenarios'], baseline['scenarios'], threshold, tail_threshold)
+    return []
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Token ring benchmarks')
+    parser.add_argument('scenario', choices=['token', 'hop', 'routing', 'parking', 'loss', 'codec', 'scheduler', 'dispatch', 'stealing', 'sharding', 'membership', 'formation', 'processes', 'transport', 'receive', 'tickets', 'messages', 'suite'], help='benchmark scenario')
+    parser.add_argument('-p', dest='base_port', type=int, help='first port used by the rings', default=6000)
+    parser.add_argument('-n', dest='no_orders', type=int, help='number of orders', default=2000)
+    parser.add_argument('-b', dest='batch_sizes', type=int, nargs='+', help='token batch sizes', default=[1, 2, 4, 8, 16])
+    parser.add_argument('-s', dest='scenarios', nargs='+', choices=list(SCENARIOS), help='suite scenarios', default=list(SCENARIOS))
+    parser.add_argument('--scale', type=float, help='suite time scale', default=0.001)
+    parser.add_argument('--timeout', type=float, help='suite client timeout per phase (seconds)', default=20)
+    parser.add_argument('-o', dest='output', help='write the suite results to a JSON file', default=None)
+    parser.add_argument('--baseline', help='compare the suite results with a JSON baseline', default=None)
+    parser.add_argument('--threshold', type=float, help='relative change reported as regression', default=0.2)
+    parser.add_argument('--tail-threshold', type=float, help='relative change of p95 and p99 reported as regression', default=0.5)
+    parser.add_argument('--runs', type=int, help='suite runs of each scenario (the medians are compared)', default=3)
+    args = parser.parse_args()
+
+    if args.scenario == 'token':
+        token_batch(args.base_port, args.no_orders, args.batch_sizes)
+    elif args.scenario == 'hop':
+        hop_latency(args.base_port, args.no_orders)
+    elif args.scenario == 'routing':
+        routing_latency(args.base_port, min(args.no_orders, 500))
+    elif args.scenario == 'parking':
+        token_parking(args.base_port, min(args.no_orders, 200))
+    elif args.scenario == 'loss':
+        token_loss(args.base_port, min(args.no_orders, 20))
+    elif args.scenario == 'codec':
+        codec_cost(args.no_orders)
+    elif args.scenario == 'scheduler':
+        scheduler_policies(args.no_orders)
+    elif args.scenario == 'dispatch':
+        chef_dispatch(args.no_orders)
+    elif args.scenario == 'stealing':
+        chef_dispatch(args.no_orders, stealing = ('no', 'yes'))
+    elif args.scenario == 'sharding':
+        sharding(args.no_orders)
+    elif args.scenario == 'membership':
+        membership(args.base_port, min(args.no_orders, 600))
+        membership(args.base_port + 200, min(args.no_orders, 600), 'Waiter')
+    elif args.scenario == 'formation':
+        ring_formation(args.base_port)
+    elif args.scenario == 'processes':
+        process_layout(args.base_port, min(args.no_orders, 600))
+    elif args.scenario == 'transport':
+        transport_cost(args.base_port, min(args.no_orders, 1000))
+    elif args.scenario == 'receive':
+        receive_path(args.no_orders * 50)
+    elif args.scenario == 'tickets':
+        ticket_cost(args.no_orders * 100)
+    elif args.scenario == 'messages':
+        message_cost(args.no_orders * 10)
+    elif args.scenario == 'suite':
+        regressions = suite(args.base_port, args.scenarios, args.scale, args.timeout, args.output, args.baseline, args.threshold,
+                            args.tail_threshold, args.runs)
+        if regressions:
+            raise SystemExit(1)
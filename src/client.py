@@ -1,8 +1,9 @@
 # coding: utf-8
 
 import time
-import pickle
+import codec
 import socket
+from messages import Delivery, Order, OrderReply, Payment, PaymentRequest, Pickup
 import random
 import logging
 import argparse
@@ -46,34 +47,45 @@ def main(port, ring, timeout):
     
     # Request some food
     logger.info('Request some food...')
-    p = pickle.dumps({'method': 'ORDER', 'args': requested_items})
+    p = codec.encode_message(Order(requested_items))
     sock.sendto(p, ring) 
 
     # Wait for Ticket
-    p, addr = sock.recvfrom(1024)
-    o = pickle.loads(p)
-    # Received message is: o['args'] = {'ticket_no': ticket_no, 'order': order}
-    logger.info('Received ticket %s', o['args']['ticket_no'])
+    p, addr = sock.recvfrom(codec.MAX_DATAGRAM)
+    o = codec.decode(p)
+    # Received message is ORDER_REP (ticket number and order)
+    if type(o) is not OrderReply:
+        logger.error('Unexpected reply from %s: %s', addr, o)
+        sock.close()
+        return 1
+    ticket_no = o.ticket_no
+    logger.info('Received ticket %s', ticket_no)
 
     # Pickup order 
-    logger.info('Pickup order No. %s', o['args']['ticket_no'])
-    p = pickle.dumps({"method": 'PICKUP', "args": o['args']})
+    logger.info('Pickup order No. %s', o.ticket_no)
+    p = codec.encode_message(Pickup(o.ticket_no, o.order))
     sock.sendto(p, ring)
 
-    # Wait for payment request
-    p, addr = sock.recvfrom(1024)
-    o = pickle.loads(p)
-    logger.info('Received total amount to pay: $%s', o)
-
-    # Send payment
-    logger.info('Sending payment with total amount of: $%s', o)
-    p = pickle.dumps({'method': 'PAYMENT', 'amount': o})
-    sock.sendto(p, addr)
-
-    # Wait for payment request
-    p, addr = sock.recvfrom(1024)
-    o = pickle.loads(p)
-    logger.info('Order received: %s', o)
+    # Wait for payment request (the Waiter that takes over the ticket when a Waiter leaves sends it again)
+    p, addr = sock.recvfrom(codec.MAX_DATAGRAM)
+    o = codec.decode(p)
+    while type(o) is PaymentRequest and o.ticket_no == ticket_no:
+        logger.info('Received total amount to pay: $%s', o.amount)
+
+        # Send payment
+        logger.info('Sending payment with total amount of: $%s', o.amount)
+        p = codec.encode_message(Payment(o.amount, ticket_no))
+        sock.sendto(p, addr)
+
+        # Wait for the order
+        p, addr = sock.recvfrom(codec.MAX_DATAGRAM)
+        o = codec.decode(p)
+
+    if type(o) is not Delivery or o.ticket_no != ticket_no:
+        logger.error('Unexpected reply from %s: %s', addr, o)
+        sock.close()
+        return 1
+    logger.info('Order received: %s', o.order)
 
     # Close socket
     logger.info('Leaving Drive-Through')
@@ -0,0 +1,307 @@
+import itertools
+import messages
+import struct
+import time
+
+# binary wire format used by the token ring and by the clients
+#
+# datagram = version (1 byte) | flags (1 byte) | [fragment header] | value
+# value    = tag (1 byte) | tag specific payload (network byte order)
+#
+# method names, dictionary keys and other well known strings are sent as
+# 1 byte symbols. New symbols must be appended at the end of the tables,
+# changing the existing ones requires a new VERSION.
+VERSION = 1
+FLAG_FRAGMENT = 0x01
+
+# maximum size of each datagram
+MAX_DATAGRAM = 1024
+# maximum number of fragments of a single message
+MAX_FRAGMENTS = 256
+
+METHODS = ('TOKEN', 'RING_COUNT', 'NODE_DISCOVERY', 'FRAME', 'NODE_JOIN_REQ', 'NODE_JOIN_REP',
+           'ORDER', 'ORDER_REP', 'PICKUP', 'PAYMENT',
+           'CLIENT_ORDER', 'CLIENT_PICKUP', 'COOK_ORDER', 'COOK_TIME', 'ORDER_READY',
+           'REQUEST_BARBECUE_GRILL', 'REQUEST_FRYER', 'REQUEST_BAR',
+           'FREE_BARBECUE_GRILL', 'FREE_FRYER', 'FREE_BAR')
+
+SYMBOLS = METHODS + ('method', 'args', 'id', 'from', 'address', 'successor_id', 'successor_addr',
+                     'client_addr', 'order', 'ticket_no', 'equipment', 'time', 'amount',
+                     'hamburger', 'drink', 'fries', 'barbecue_grill', 'fryer', 'bar',
+                     'Drive-Through', 'Clerk', 'Chef', 'Waiter',
+                     'fries_cook', 'hamburger_cook', 'drink_cook', 'unit',
+                     'units', 'portions', 'schedule',
+                     'remaining', 'issued_at', 'status',
+                     'HANDOVER_ORDER', 'handed_over', 'ROUTE', 'addresses',
+                     'WAKE', 'idle', 'epoch',
+                     'TOKEN_CLAIM', 'generation', 'msg_id',
+                     'members', 'version', 'JOIN', 'LEAVE', 'UNLINK', 'table', 'nodes', 'name', 'sizes')
+
+# entity messages (messages.TYPES) are sent as records: the code of the class and the field values, without the names
+RECORD_TYPES = messages.TYPES
+
+METHOD_CODES = {method: code for code, method in enumerate(METHODS)}
+RECORD_CODES = {cls: code for code, cls in enumerate(RECORD_TYPES)}
+SYMBOL_CODES = {symbol: code for code, symbol in enumerate(SYMBOLS)}
+
+# value tags
+NONE, TRUE, FALSE, INT8, INT16, INT32, INT64, FLOAT, STR, SYMBOL, ADDR, LIST, TUPLE, DICT, MESSAGE, RECORD = range(16)
+
+# hashable values accepted as dict keys (a list key would make the decoding fail with TypeError)
+KEY_TYPES = (str, int, float, bool, type(None), tuple)
+
+HEADER = struct.Struct('!BB')
+FRAGMENT = struct.Struct('!IHH')    # message id, fragment index, number of fragments
+TAG = struct.Struct('!B')
+INT8_S = struct.Struct('!Bb')
+INT16_S = struct.Struct('!Bh')
+INT32_S = struct.Struct('!Bi')
+INT64_S = struct.Struct('!Bq')
+FLOAT_S = struct.Struct('!Bd')
+LENGTH = struct.Struct('!BH')       # tag and 2 bytes length (strings, lists, tuples and dicts)
+CODE = struct.Struct('!BB')         # tag and 1 byte code (symbols, messages and records)
+PORT = struct.Struct('!H')
+
+# pre-encoded symbols and small integers
+SYMBOL_BYTES = {symbol: CODE.pack(SYMBOL, code) for symbol, code in SYMBOL_CODES.items()}
+INT8_BYTES = {i: INT8_S.pack(INT8, i) for i in range(-0x80, 0x80)}
+
+message_ids = itertools.count()
+
+
+def encode_value(o, out):
+    t = type(o)
+    if t is str:
+        code = SYMBOL_BYTES.get(o)
+        if code is not None:
+            out += code
+        else:
+            data = o.encode('utf-8')
+            out += LENGTH.pack(STR, len(data))
+            out += data
+    elif t is int:
+        if -0x80 <= o < 0x80:
+            out += INT8_BYTES[o]
+        elif -0x8000 <= o < 0x8000:
+            out += INT16_S.pack(INT16, o)
+        elif -0x80000000 <= o < 0x80000000:
+            out += INT32_S.pack(INT32, o)
+        elif -0x8000000000000000 <= o < 0x8000000000000000:
+            out += INT64_S.pack(INT64, o)
+        else:
+            raise ValueError('Integer out of range: {}'.format(o))
+    elif t is dict:
+        method = o.get('method')
+        if len(o) == 2 and 'args' in o and method in METHOD_CODES:
+            out += CODE.pack(MESSAGE, METHOD_CODES[method])
+            encode_value(o['args'], out)
+        else:
+            out += LENGTH.pack(DICT, len(o))
+            for key, value in o.items():
+                encode_value(key, out)
+                encode_value(value, out)
+    elif t in RECORD_CODES:
+        out += CODE.pack(RECORD, RECORD_CODES[t])
+        for field in t.fields:
+            encode_value(getattr(o, field), out)
+    elif t is tuple:
+        if len(o) == 2 and type(o[0]) is str and type(o[1]) is int and 0 <= o[1] < 0x10000:
+            # (host, port) address
+            host = o[0].encode('utf-8')
+            out += CODE.pack(ADDR, len(host))
+            out += host
+            out += PORT.pack(o[1])
+        else:
+            out += LENGTH.pack(TUPLE, len(o))
+            for value in o:
+                encode_value(value, out)
+    elif t is list:
+        out += LENGTH.pack(LIST, len(o))
+        for value in o:
+            encode_value(value, out)
+    elif t is float:
+        out += FLOAT_S.pack(FLOAT, o)
+    elif o is None:
+        out += b'\x00'
+    elif o is True:
+        out += b'\x01'
+    elif o is False:
+        out += b'\x02'
+    else:
+        raise ValueError('Unsupported type: {}'.format(t.__name__))
+
+
+# size of the encoded value, in bytes
+def value_size(o):
+    out = bytearray()
+    encode_value(o, out)
+    return len(out)
+
+
+def decode_value(data, offset):
+    tag = data[offset]
+    offset += 1
+    if tag == SYMBOL:
+        return SYMBOLS[data[offset]], offset + 1
+    if tag == INT8:
+        value = data[offset]
+        return (value - 0x100 if value & 0x80 else value), offset + 1
+    if tag == MESSAGE:
+        method = METHODS[data[offset]]
+        args, offset = decode_value(data, offset + 1)
+        return {'method': method, 'args': args}, offset
+    if tag == RECORD:
+        cls = RECORD_TYPES[data[offset]]
+        offset += 1
+        values = []
+        for field in cls.fields:
+            value, offset = decode_value(data, offset)
+            values.append(value)
+        # the constructor checks the fields (ValueError)
+        return cls(*values), offset
+    if tag == DICT or tag == LIST or tag == TUPLE or tag == STR:
+        length = LENGTH.unpack_from(data, offset - 1)[1]
+        offset += 2
+        if tag == STR:
+            end = offset + length
+            if end > len(data):
+                raise ValueError('Truncated string')
+            return str(data[offset:end], 'utf-8'), end
+        if tag == DICT:
+            o = {}
+            for i in range(length):
+                key, offset = decode_value(data, offset)
+                if type(key) not in KEY_TYPES:
+                    raise ValueError('Unsupported dict key: {}'.format(type(key).__name__))
+                o[key], offset = decode_value(data, offset)
+            return o, offset
+        o = []
+        for i in range(length):
+            value, offset = decode_value(data, offset)
+            o.append(value)
+        return (o if tag == LIST else tuple(o)), offset
+    if tag == ADDR:
+        end = offset + 1 + data[offset]
+        if end + 2 > len(data):
+            raise ValueError('Truncated address')
+        return (str(data[offset + 1:end], 'utf-8'), PORT.unpack_from(data, end)[0]), end + 2
+    if tag == NONE:
+        return None, offset
+    if tag == TRUE:
+        return True, offset
+    if tag == FALSE:
+        return False, offset
+    if tag == INT16:
+        return INT16_S.unpack_from(data, offset - 1)[1], offset + 2
+    if tag == INT32:
+        return INT32_S.unpack_from(data, offset - 1)[1], offset + 4
+    if tag == INT64:
+        return INT64_S.unpack_from(data, offset - 1)[1], offset + 8
+    if tag == FLOAT:
+        return FLOAT_S.unpack_from(data, offset - 1)[1], offset + 8
+    raise ValueError('Unknown tag: {}'.format(tag))
+
+
+# reusable receive buffer: the datagrams are received into it (recvfrom_into) and decoded from a view of it,
+# without a new bytes object per datagram; the decoded values never refer to the buffer
+# (a receiving thread needs its own buffer)
+class ReceiveBuffer:
+    def __init__(self, size = MAX_DATAGRAM):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+
+    # (view of the datagram, sender address); the view is valid until the next call
+    def recvfrom(self, sock):
+        n, addr = sock.recvfrom_into(self.buffer)
+        return self.view[:n], addr
+
+
+# encode a message in a single (not fragmented) datagram
+def encode_message(o):
+    out = bytearray(HEADER.pack(VERSION, 0))
+    encode_value(o, out)
+    return out
+
+
+# encode a message in one or more datagrams with at most 'max_datagram' bytes
+def encode(o, max_datagram = MAX_DATAGRAM):
+    data = encode_message(o)
+    if len(data) <= max_datagram:
+        return [data]
+
+    body = memoryview(data)[HEADER.size:]
+    chunk = max_datagram - HEADER.size - FRAGMENT.size
+    count = (len(body) + chunk - 1) // chunk
+    if count > MAX_FRAGMENTS:
+        raise ValueError('Message too big: {} bytes'.format(len(data)))
+
+    message_id = next(message_ids) & 0xffffffff
+    fragments = []
+    for index in range(count):
+        fragment = bytearray(HEADER.pack(VERSION, FLAG_FRAGMENT))
+        fragment += FRAGMENT.pack(message_id, index, count)
+        fragment += body[index * chunk:(index + 1) * chunk]
+        fragments.append(fragment)
+    return fragments
+
+
+# decode a complete (not fragmented) datagram
+def decode(data):
+    try:
+        version, flags = HEADER.unpack_from(data, 0)
+        if version != VERSION:
+            raise ValueError('Unsupported version: {}'.format(version))
+        if flags & FLAG_FRAGMENT:
+            raise ValueError('Fragmented datagram')
+        o, offset = decode_value(data, HEADER.size)
+    except (IndexError, TypeError, struct.error, UnicodeDecodeError, RecursionError) as e:
+        raise ValueError('Malformed datagram: {}'.format(e))
+    if offset != len(data):
+        raise ValueError('Trailing bytes in datagram')
+    return o
+
+
+# joins the fragments of messages received from several addresses
+class Reassembler:
+    def __init__(self, timeout = 5, max_pending = 64):
+        self.timeout = timeout
+        self.max_pending = max_pending
+        # (address, message id) -> [arrival time, number of fragments, {index: data}]
+        self.pending = {}
+
+    # returns the decoded message, or None if it is not complete yet
+    def feed(self, data, addr):
+        if len(data) < HEADER.size or not data[1] & FLAG_FRAGMENT:
+            return decode(data)
+
+        try:
+            message_id, index, count = FRAGMENT.unpack_from(data, HEADER.size)
+        except struct.error:
+            raise ValueError('Malformed fragment header')
+        if count > MAX_FRAGMENTS or index >= count:
+            raise ValueError('Invalid fragment {}/{}'.format(index, count))
+
+        now = time.monotonic()
+        key = (addr, message_id)
+        if key not in self.pending:
+            self.expire(now)
+            self.pending[key] = [now, count, {}]
+        entry = self.pending[key]
+        if entry[1] != count:
+            raise ValueError('Inconsistent fragment count')
+        entry[2][index] = bytes(data[HEADER.size + FRAGMENT.size:])
+
+        if len(entry[2]) < count:
+            return None
+        del self.pending[key]
+        message = bytearray(HEADER.pack(VERSION, 0))
+        for i in range(count):
+            message += entry[2][i]
+        return decode(message)
+
+    # drop incomplete messages that are too old (or too many)
+    def expire(self, now):
+        for key in [key for key, entry in self.pending.items() if now - entry[0] > self.timeout]:
+            del self.pending[key]
+        while len(self.pending) >= self.max_pending:
+            del self.pending[next(iter(self.pending))]
@@ -0,0 +1,156 @@
+import heapq
+import itertools
+import logging
+import selectors
+import socket
+import threading
+import utils
+from messages import Message
+from ringNode import RingNode
+from sharding import HashRing
+from utils import recv
+
+
+# abstract class for the simulation entities (Restaurant, Clerk, Chef and Waiter)
+class Entity(threading.Thread):
+    def __init__(self, name, ring_port, ring_size, timeout, port, ide, comm_thread = None):
+        threading.Thread.__init__(self)
+        self.name = name
+        self.id = ide
+        self.port = port
+        self.ring_addr = ('localhost', ring_port)
+        if self.port == ring_port:
+            self.ring_addr = None
+        self.ring_size = ring_size
+        self.entities_table = None
+        self.client_socket = None
+        self.done = False
+        self.leaving = False
+
+        # consistent hashing ring of each role, rebuilt when the role nodes change
+        self.hash_rings = {}
+
+        # timers heap: (deadline, sequence, function, args)
+        self.timers = []
+        self.timer_sequence = itertools.count()
+
+        # Create a logger for the entity
+        self.logger = logging.getLogger('SIMU - (' + str(self.id) + ') ' + self.name)
+        self.logger.setLevel(logging.INFO)
+
+        # Start communication thread (unless one is given, e.g. by the virtual simulation)
+        if comm_thread is None:
+            comm_thread = RingNode(self.name, self.id, ('localhost', self.port), self.ring_size, self.ring_addr, timeout)
+            comm_thread.start()
+        self.comm_thread = comm_thread
+
+    # handle a message (messages.Message) received in the client socket
+    def handle_client(self, o, addr):
+        raise NotImplementedError
+
+    # handle a request (messages.RingMessage) received from the token ring
+    def handle_request(self, request):
+        raise NotImplementedError
+
+    # entity thread, once the node is in the ring and the entities table is complete
+    def joined(self):
+        pass
+
+    # give the pending work away while leaving the ring (entity thread), True when there is none left
+    def drain(self):
+        return True
+
+    # move the keys that belong to other nodes of the role now (entity thread, after a node of the role joined or left)
+    def rebalance(self):
+        pass
+
+    # node of 'role' responsible for 'key' (e.g. the Waiter of a ticket number)
+    def shard(self, role, key):
+        nodes = self.entities_table[role]
+        ring = self.hash_rings.get(role)
+        if ring is None or ring.nodes != nodes:
+            ring = self.hash_rings[role] = HashRing(nodes)
+        return ring.node(key)
+
+    # call 'function(*args)' in the entity thread after 'delay' seconds, without blocking it
+    def call_later(self, delay, function, *args):
+        heapq.heappush(self.timers, (utils.clock.time() + max(delay, 0), next(self.timer_sequence), function, args))
+
+    # run the expired timers and return the time until the next one (None if there are no timers)
+    def run_timers(self):
+        while self.timers:
+            now = utils.clock.time()
+            deadline, sequence, function, args = self.timers[0]
+            if deadline > now:
+                return deadline - now
+            heapq.heappop(self.timers)
+            function(*args)
+        return None
+
+    def run(self):
+        # socket for receiving clients requests
+        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client_socket.settimeout(3)
+        self.client_socket.bind((self.comm_thread.address[0], self.port + 100)) # client_port = port + 100
+
+        # wait for the entities table (the communication thread sets 'ready' when it is complete)
+        while not self.comm_thread.ready.wait(0.5) and not self.done:
+            pass
+        entities_table = self.comm_thread.get_nodes_table()
+        self.entities_table = entities_table
+
+        self.logger.info('Entities table: %s', entities_table)
+        self.joined()
+
+        # wait for client datagrams and ring requests at the same time
+        selector = selectors.DefaultSelector()
+        selector.register(self.client_socket, selectors.EVENT_READ, 'client')
+        selector.register(self.comm_thread.wakeup_recv, selectors.EVENT_READ, 'ring')
+
+        members = entities_table.get(self.name)
+        while not self.done:
+            timeout = self.run_timers()
+            # the lists of the nodes table are replaced when they change
+            if entities_table.get(self.name) is not members:
+                members = entities_table.get(self.name)
+                self.rebalance()
+            if self.leaving and self.comm_thread.leave_refused:
+                self.logger.warning('Leave refused, the entity stays in the ring')
+                self.leaving = False
+                self.comm_thread.stay()
+            if self.leaving:
+                if self.comm_thread.unlinked:
+                    self.logger.info('Left the ring')
+                    break
+                if self.drain():
+                    self.comm_thread.unlink()
+
+            for key, _ in selector.select(timeout):
+                if key.data == 'client':
+                    o, addr = recv(self.client_socket)
+                    if isinstance(o, Message):
+                        self.handle_client(o, addr)
+                    elif o is not None:
+                        self.logger.warning('Dropping client datagram from %s: %s', addr, o)
+                else:
+                    self.comm_thread.wakeup_recv.recv(4096)
+                    request = self.comm_thread.get_recv_requests()
+                    while request is not None:
+                        self.logger.debug('Request %s', request)
+                        self.handle_request(request)
+                        request = self.comm_thread.get_recv_requests()
+
+        self.client_socket.close()
+
+    # leave the ring while the restaurant keeps running: the node is removed from the nodes tables
+    # at once, and leaves the ring when it has no pending work ('drain') and no new requests
+    def leave(self):
+        self.comm_thread.leave()
+        self.leaving = True
+        self.comm_thread.wakeup_send.send(b'\0')
+
+    # stop the entity and its communication thread
+    def stop(self):
+        self.done = True
+        self.comm_thread.stop()
+        self.comm_thread.wakeup_send.send(b'\0')
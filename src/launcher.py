@@ -0,0 +1,180 @@
+# coding: utf-8
+
+import argparse
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import threading
+import time
+from ringNode import RingNode
+from Chef import Chef
+from Clerk import Clerk
+from Restaurant import Restaurant
+from Waiter import Waiter
+from utils import config
+
+FORMAT = '%(asctime)s %(name)-25s %(levelname)-8s %(message)s'
+DATEFMT = '%m-%d %H:%M:%S'
+
+logger = logging.getLogger('LAUNCHER')
+
+# entity class of each node name
+ENTITY_CLASSES = {'Drive-Through': Restaurant, 'Clerk': Clerk, 'Chef': Chef, 'Waiter': Waiter}
+
+
+# ring layout: [(id, name, (host, port))], the first node is the initial node of the ring
+def default_layout(host = 'localhost', base_port = 5000, no_chefs = 1):
+    names = ['Drive-Through', 'Clerk', 'Chef', 'Waiter'] + ['Chef'] * (no_chefs - 1)
+    return [(ide, name, (host, base_port + ide)) for ide, name in enumerate(names)]
+
+
+# 'name@host:port' entries separated by commas, the ids follow the order of the entries
+def parse_layout(text):
+    layout = []
+    for ide, entry in enumerate(entry.strip() for entry in text.split(',') if entry.strip()):
+        name, address = entry.split('@')
+        host, port = address.rsplit(':', 1)
+        if name not in ENTITY_CLASSES:
+            raise ValueError('Unknown entity: {}'.format(name))
+        layout.append((ide, name, (host, int(port))))
+    if not layout or layout[0][1] != 'Drive-Through':
+        raise ValueError('The first node of the layout must be the Drive-Through')
+    return layout
+
+
+# entity process: the communication thread knows the whole ring from the layout (static membership),
+# and the logs go to the launcher through 'log_queue'
+def run_entity(node, layout, timeout, log_queue, ready, restarted):
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(logging.INFO)
+
+    # a crash in any thread of the node crashes the process, so the launcher restarts it
+    def crash(args):
+        logging.getLogger('LAUNCHER').error('Thread %s crashed', args.thread.name,
+                                            exc_info = (args.exc_type, args.exc_value, args.exc_traceback))
+        os._exit(1)
+    threading.excepthook = crash
+
+    ide, name, address = node
+    seeds = {i: (n, a) for i, n, a in layout}
+    ring_addr = None if ide == layout[0][0] else layout[0][2]
+    # the local transport only reaches the nodes of the same process
+    transport = 'udp' if config.get('TOKEN', 'TRANSPORT', fallback = 'udp') == 'local' else None
+    comm_thread = RingNode(name, ide, address, len(layout), ring_addr, timeout, seeds = seeds, rejoin = restarted,
+                           transport = transport)
+    comm_thread.start()
+    entity = ENTITY_CLASSES[name](layout[0][2][1], len(layout), timeout, address[1], ide, comm_thread)
+    entity.start()
+    comm_thread.ready.wait()
+    ready.set()
+    entity.join()
+
+
+# starts the nodes of 'hosts' (all of them if None) in one process each, restarts the crashed ones
+# and writes the logs of all of them to the console (and to 'log_file')
+class Launcher:
+    def __init__(self, layout, hosts = None, timeout = 3, max_restarts = 3, log_file = None, console = True):
+        self.layout = layout
+        self.nodes = [node for node in layout if hosts is None or node[2][0] in hosts]
+        self.timeout = timeout
+        self.max_restarts = max_restarts
+        # the entity processes are forked, so they inherit the configuration (e.g. scaled by the benchmarks)
+        self.context = multiprocessing.get_context('fork')
+        self.log_queue = self.context.Queue()
+        handlers = []
+        if console:
+            handlers.append(logging.StreamHandler())
+        if log_file is not None:
+            handlers.append(logging.FileHandler(log_file, mode = 'w'))
+        for handler in handlers:
+            handler.setFormatter(logging.Formatter(FORMAT, DATEFMT))
+        self.listener = logging.handlers.QueueListener(self.log_queue, *handlers)
+        # node id -> [process, ready event, number of restarts]
+        self.processes = {}
+        # nodes not restarted any more
+        self.failed = set()
+        self.done = False
+
+    def start_node(self, node, restarted = False):
+        ready = self.context.Event()
+        process = self.context.Process(target = run_entity, name = '({}) {}'.format(node[0], node[1]),
+                                       args = (node, self.layout, self.timeout, self.log_queue, ready, restarted))
+        process.start()
+        restarts = self.processes[node[0]][2] + 1 if restarted else 0
+        self.processes[node[0]] = [process, ready, restarts]
+
+    def start(self):
+        self.listener.start()
+        # the launcher logs go with the logs of the nodes
+        logger.addHandler(logging.handlers.QueueHandler(self.log_queue))
+        logger.propagate = False
+        for node in self.nodes:
+            logger.info('Starting %s %s at %s', node[1], node[0], node[2])
+            self.start_node(node)
+
+    # wait until all the local nodes have their nodes table
+    def wait_ready(self, timeout = None):
+        deadline = None if timeout is None else time.time() + timeout
+        for process, ready, restarts in self.processes.values():
+            if not ready.wait(None if deadline is None else max(deadline - time.time(), 0)):
+                return False
+        return True
+
+    # restart the nodes that exited with an error (at most 'max_restarts' times each)
+    def check(self):
+        for node in self.nodes:
+            process, ready, restarts = self.processes[node[0]]
+            if process.is_alive() or process.exitcode is None or self.done:
+                continue
+            if process.exitcode == 0:
+                # the node left the ring
+                continue
+            if restarts < self.max_restarts:
+                logger.warning('%s %s exited with code %s, restarting it', node[1], node[0], process.exitcode)
+                process.join()
+                self.start_node(node, restarted = True)
+            elif node[0] not in self.failed:
+                logger.error('%s %s exited with code %s after %s restarts', node[1], node[0], process.exitcode, restarts)
+                self.failed.add(node[0])
+
+    # supervise the nodes until all of them exit (or for 'duration' seconds)
+    def supervise(self, duration = None, interval = 0.5):
+        end = None if duration is None else time.time() + duration
+        while not self.done and (end is None or time.time() < end):
+            self.check()
+            if not any(process.is_alive() for process, ready, restarts in self.processes.values()):
+                break
+            time.sleep(interval)
+
+    def stop(self):
+        self.done = True
+        for process, ready, restarts in self.processes.values():
+            process.terminate()
+        for process, ready, restarts in self.processes.values():
+            process.join()
+        self.listener.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Starts each entity in its own process')
+    parser.add_argument('-l', dest='layout', help='ring layout: name@host:port entries separated by commas '
+                        '(default: Drive-Through, Clerk, Chef(s) and Waiter in localhost, from port 5000)', default=None)
+    parser.add_argument('-k', dest='no_chefs', type=int, help='number of Chefs of the default layout', default=1)
+    parser.add_argument('-H', dest='hosts', nargs='+', help='start only the nodes of these hosts (one launcher per host)', default=None)
+    parser.add_argument('-r', dest='max_restarts', type=int, help='restarts of each crashed node', default=3)
+    parser.add_argument('-d', dest='duration', type=float, help='run for some seconds (default: until all the nodes exit)', default=None)
+    parser.add_argument('-o', dest='log_file', help='log file of all the nodes', default='./logs/simulation.log')
+    args = parser.parse_args()
+
+    logger.setLevel(logging.INFO)
+    layout = default_layout(no_chefs = args.no_chefs) if args.layout is None else parse_layout(args.layout)
+    launcher = Launcher(layout, args.hosts, max_restarts = args.max_restarts, log_file = args.log_file)
+    launcher.start()
+    try:
+        launcher.supervise(args.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        launcher.stop()
@@ -0,0 +1,204 @@
+# coding: utf-8
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import statistics
+import codec
+from messages import Delivery, Order, OrderReply, Payment, PaymentRequest, Pickup
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(name)-25s %(levelname)-8s %(message)s',
+                    datefmt='%m-%d %H:%M:%S')
+
+logger = logging.getLogger('LOAD - Generator')
+
+# client session phases, in order
+PHASES = ['ticket', 'payment_request', 'order_delivered']
+
+
+# receives the datagrams of one client session
+class ClientProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.messages = asyncio.Queue()
+        self.reassembler = codec.Reassembler()
+
+    def datagram_received(self, data, addr):
+        try:
+            o = self.reassembler.feed(data, addr)
+        except ValueError as e:
+            logger.warning('Dropping datagram from %s: %s', addr, e)
+            return
+        if o is not None:
+            self.messages.put_nowait((o, addr))
+
+
+# latency of each phase of the client sessions
+class Statistics:
+    def __init__(self):
+        self.latencies = {phase: [] for phase in PHASES}
+        self.total = []
+        self.started = 0
+        self.failed = {phase: 0 for phase in PHASES}
+
+    def summary(self):
+        summary = {'started': self.started, 'completed': len(self.total), 'failed': self.failed}
+        for phase, values in list(self.latencies.items()) + [('total', self.total)]:
+            if values:
+                values = sorted(values)
+                summary[phase] = {'mean': statistics.mean(values),
+                                  'p50': values[len(values) // 2],
+                                  'p95': values[int(len(values) * 0.95)],
+                                  'p99': values[int(len(values) * 0.99)],
+                                  'max': values[-1]}
+        return summary
+
+
+# random order with 1 to 5 items, following the menu mix probabilities
+def random_order(mix):
+    order = {'hamburger': 0, 'drink': 0, 'fries': 0}
+    for item in random.choices(list(mix), weights=list(mix.values()), k=random.randint(1, 5)):
+        order[item] += 1
+    return order
+
+
+# ORDER -> PICKUP -> PAYMENT, like client.py; a session fails in the phase of a timeout, a socket error
+# (e.g. no file descriptors left) or an unexpected reply
+async def session(ring, order, timeout, stats):
+    loop = asyncio.get_running_loop()
+    stats.started += 1
+    phase = PHASES[0]
+    transport = None
+    try:
+        transport, protocol = await loop.create_datagram_endpoint(ClientProtocol, local_addr=('localhost', 0))
+        start = last = loop.time()
+        transport.sendto(codec.encode_message(Order(order)), ring)
+
+        # Wait for Ticket
+        o, addr = await asyncio.wait_for(protocol.messages.get(), timeout)
+        if type(o) is not OrderReply:
+            raise ValueError('Unexpected ticket reply: {!r}'.format(o))
+        now = loop.time()
+        stats.latencies[phase].append(now - last)
+        last = now
+        ticket_no = o.ticket_no
+        transport.sendto(codec.encode_message(Pickup(o.ticket_no, o.order)), ring)
+
+        # Wait for payment request
+        phase = PHASES[1]
+        o, addr = await asyncio.wait_for(protocol.messages.get(), timeout)
+        if type(o) is not PaymentRequest or o.ticket_no != ticket_no:
+            raise ValueError('Unexpected payment request: {!r}'.format(o))
+        now = loop.time()
+        stats.latencies[phase].append(now - last)
+        last = now
+        transport.sendto(codec.encode_message(Payment(o.amount, ticket_no)), addr)
+
+        # Wait for the order (the Waiter that takes over the ticket when a Waiter leaves sends the bill again)
+        phase = PHASES[2]
+        o, addr = await asyncio.wait_for(protocol.messages.get(), timeout)
+        while type(o) is PaymentRequest and o.ticket_no == ticket_no:
+            transport.sendto(codec.encode_message(Payment(o.amount, ticket_no)), addr)
+            o, addr = await asyncio.wait_for(protocol.messages.get(), timeout)
+        if type(o) is not Delivery or o.ticket_no != ticket_no:
+            raise ValueError('Unexpected order delivery: {!r}'.format(o))
+        now = loop.time()
+        stats.latencies[phase].append(now - last)
+        stats.total.append(now - start)
+    except asyncio.TimeoutError:
+        stats.failed[phase] += 1
+    except (OSError, ValueError) as e:
+        logger.warning('Session failed in phase %s: %s', phase, e)
+        stats.failed[phase] += 1
+    finally:
+        if transport is not None:
+            transport.close()
+
+
+# every session uses one socket: raise the open files limit to the hard limit
+def raise_file_limit():
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError) as e:
+            logger.warning('Open files limit stays at %s: %s', soft, e)
+
+
+# time between two session arrivals
+def arrivals(profile, rate, burst_size):
+    while True:
+        if profile == 'poisson':
+            yield random.expovariate(rate)
+        elif profile == 'burst':
+            # 'burst_size' sessions at the same time, with the same average rate
+            for i in range(burst_size - 1):
+                yield 0
+            yield burst_size / rate
+        else:
+            yield 1 / rate
+
+
+async def generate(ring, no_sessions, rate, profile, burst_size, mix, timeout):
+    raise_file_limit()
+    stats = Statistics()
+    sessions = []
+    for delay in arrivals(profile, rate, burst_size):
+        if len(sessions) == no_sessions:
+            break
+        sessions.append(asyncio.create_task(session(ring, random_order(mix), timeout, stats)))
+        if delay > 0:
+            await asyncio.sleep(delay)
+    await asyncio.gather(*sessions)
+    return stats
+
+
+def main(ring, no_sessions, rate, profile, burst_size, mix, timeout, output = None):
+    logger.info('Starting %d sessions (%s arrivals, %.2f sessions/s)', no_sessions, profile, rate)
+    stats = asyncio.run(generate(ring, no_sessions, rate, profile, burst_size, mix, timeout))
+    summary = stats.summary()
+
+    logger.info('Sessions completed: %d of %d; failed: %s', summary['completed'], summary['started'], summary['failed'])
+    for phase in PHASES + ['total']:
+        if phase in summary:
+            logger.info('%-16s mean %.3f s; p50 %.3f s; p95 %.3f s; p99 %.3f s', phase, summary[phase]['mean'],
+                        summary[phase]['p50'], summary[phase]['p95'], summary[phase]['p99'])
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(summary, f, indent=2)
+    return summary
+
+
+# 'hamburger=2,drink=1,fries=1' -> {'hamburger': 2.0, 'drink': 1.0, 'fries': 1.0}
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        name, weight = item.split('=')
+        if name not in ('hamburger', 'drink', 'fries'):
+            raise argparse.ArgumentTypeError('unknown menu item: {}'.format(name))
+        mix[name] = float(weight)
+    return mix
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Drive-through load generator')
+    parser.add_argument('-r', dest='ring', type=int, help='ring access port', default=5100)
+    parser.add_argument('-n', dest='no_sessions', type=int, help='number of client sessions', default=1000)
+    parser.add_argument('-R', dest='rate', type=float, help='target arrival rate (sessions per second)', default=10)
+    parser.add_argument('-p', dest='profile', choices=['poisson', 'burst', 'constant'], help='arrival profile', default='poisson')
+    parser.add_argument('-b', dest='burst_size', type=int, help='sessions per burst', default=50)
+    parser.add_argument('-m', dest='mix', type=parse_mix, help='menu mix weights', default='hamburger=1,drink=1,fries=1')
+    parser.add_argument('-t', dest='timeout', type=float, help='timeout of each phase (seconds)', default=300)
+    parser.add_argument('-o', dest='output', help='write the results to a JSON file', default=None)
+    args = parser.parse_args()
+    main(('localhost', args.ring), args.no_sessions, args.rate, args.profile, args.burst_size, args.mix, args.timeout, args.output)
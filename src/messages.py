@@ -0,0 +1,306 @@
+import enum
+import math
+
+# messages of the entities: with the clients (client socket) and between the entities (token ring)
+#
+# one class with __slots__ for each message, with the fields in wire order: the codec sends the
+# field values without their names, and builds the message again with the class constructor.
+# The constructors check the field types and raise ValueError, like the codec does for a
+# malformed datagram, so an invalid message never gets to the entity handlers.
+# New message classes must be appended at the end of TYPES (their index is the wire code).
+
+
+class Method(enum.Enum):
+    ORDER = 'ORDER'
+    ORDER_REP = 'ORDER_REP'
+    PICKUP = 'PICKUP'
+    PAYMENT = 'PAYMENT'
+    CLIENT_ORDER = 'CLIENT_ORDER'
+    CLIENT_PICKUP = 'CLIENT_PICKUP'
+    COOK_ORDER = 'COOK_ORDER'
+    HANDOVER_ORDER = 'HANDOVER_ORDER'
+    REQUEST_EQUIPMENT = 'REQUEST_EQUIPMENT'
+    COOK_TIME = 'COOK_TIME'
+    FREE_EQUIPMENT = 'FREE_EQUIPMENT'
+    ORDER_READY = 'ORDER_READY'
+    TICKET_HANDOVER = 'TICKET_HANDOVER'
+    PAYMENT_REQUEST = 'PAYMENT_REQUEST'
+    DELIVERY = 'DELIVERY'
+
+    def __str__(self):
+        return self.value
+
+
+# the methods as module constants, for the entity handlers: reading an attribute of the Method class is much slower
+(ORDER, ORDER_REP, PICKUP, PAYMENT, CLIENT_ORDER, CLIENT_PICKUP, COOK_ORDER, HANDOVER_ORDER,
+ REQUEST_EQUIPMENT, COOK_TIME, FREE_EQUIPMENT, ORDER_READY, TICKET_HANDOVER, PAYMENT_REQUEST, DELIVERY) = Method
+
+
+def invalid(message):
+    return ValueError('Invalid {} message: {!r}'.format(message.method, message))
+
+
+# the orders sent by the clients; the ring messages only check the type, they carry orders already checked
+def is_order(o):
+    return type(o) is dict and all(type(portions) is int and portions >= 0 for portions in o.values())
+
+
+class Message:
+    __slots__ = ()
+    method = None
+    fields = ()
+
+    def __repr__(self):
+        return '{}({})'.format(self.method, ', '.join('{}={!r}'.format(field, getattr(self, field)) for field in self.fields))
+
+
+# client messages
+
+class Order(Message):
+    __slots__ = ('order',)
+    method = Method.ORDER
+    fields = __slots__
+
+    def __init__(self, order):
+        self.order = order
+        if not is_order(order):
+            raise invalid(self)
+
+
+class OrderReply(Message):
+    __slots__ = ('ticket_no', 'order')
+    method = Method.ORDER_REP
+    fields = __slots__
+
+    def __init__(self, ticket_no, order):
+        self.ticket_no = ticket_no
+        self.order = order
+        if type(ticket_no) is not int or type(order) is not dict:
+            raise invalid(self)
+
+
+class Pickup(Message):
+    __slots__ = ('ticket_no', 'order')
+    method = Method.PICKUP
+    fields = __slots__
+
+    def __init__(self, ticket_no, order):
+        self.ticket_no = ticket_no
+        self.order = order
+        if type(ticket_no) is not int or not is_order(order):
+            raise invalid(self)
+
+
+# the payment of the clients that do not send the ticket number goes to their oldest bill
+class Payment(Message):
+    __slots__ = ('amount', 'ticket_no')
+    method = Method.PAYMENT
+    fields = __slots__
+
+    def __init__(self, amount, ticket_no = None):
+        self.amount = amount
+        self.ticket_no = ticket_no
+        # NaN is never less than the bill
+        if (type(amount) is not int and type(amount) is not float or not math.isfinite(amount)
+                or ticket_no is not None and type(ticket_no) is not int):
+            raise invalid(self)
+
+
+# bill of a cooked and picked up order, paid to the Waiter that sent it
+class PaymentRequest(Message):
+    __slots__ = ('ticket_no', 'amount')
+    method = Method.PAYMENT_REQUEST
+    fields = __slots__
+
+    def __init__(self, ticket_no, amount):
+        self.ticket_no = ticket_no
+        self.amount = amount
+        if type(ticket_no) is not int or type(amount) is not int and type(amount) is not float:
+            raise invalid(self)
+
+
+# paid order given to the client
+class Delivery(Message):
+    __slots__ = ('ticket_no', 'order')
+    method = Method.DELIVERY
+    fields = __slots__
+
+    def __init__(self, ticket_no, order):
+        self.ticket_no = ticket_no
+        self.order = order
+        if type(ticket_no) is not int or type(order) is not dict:
+            raise invalid(self)
+
+
+# ring messages: 'id' is the destination node and 'msg_id' (sender node, sequence number)
+# is set by the RingNode of the sender, to drop the duplicates
+
+class RingMessage(Message):
+    __slots__ = ('id', 'msg_id')
+
+
+class ClientOrder(RingMessage):
+    __slots__ = ('client_addr', 'order')
+    method = Method.CLIENT_ORDER
+    fields = __slots__ + RingMessage.__slots__
+
+    def __init__(self, client_addr, order, id, msg_id = None):
+        self.client_addr = client_addr
+        self.order = order
+        self.id = id
+        self.msg_id = msg_id
+        if type(client_addr) is not tuple or type(order) is not dict or type(id) is not int:
+            raise invalid(self)
+
+
+class ClientPickup(RingMessage):
+    __slots__ = ('client_addr', 'order', 'ticket_no')
+    method = Method.CLIENT_PICKUP
+    fields = __slots__ + RingMessage.__slots__
+
+    def __init__(self, client_addr, order, ticket_no, id, msg_id = None):
+        self.client_addr = client_addr
+        self.order = order
+        self.ticket_no = ticket_no
+        self.id = id
+        self.msg_id = msg_id
+        if type(client_addr) is not tuple or type(order) is not dict or type(ticket_no) is not int or type(id) is not int:
+            raise invalid(self)
+
+
+# 'issued_at': time the Clerk issued the ticket (priority of the earliest ticket scheduler)
+class CookOrder(RingMessage):
+    __slots__ = ('client_addr', 'order', 'ticket_no', 'issued_at')
+    method = Method.COOK_ORDER
+    fields = __slots__ + RingMessage.__slots__
+    handed_over = False
+
+    def __init__(self, client_addr, order, ticket_no, issued_at, id, msg_id = None):
+        self.client_addr = client_addr
+        self.order = order
+        self.ticket_no = ticket_no
+        self.issued_at = issued_at
+        self.id = id
+        self.msg_id = msg_id
+        if (type(client_addr) is not tuple or type(order) is not dict or type(ticket_no) is not int
+                or type(issued_at) is not float and type(issued_at) is not int or type(id) is not int):
+            raise invalid(self)
+
+
+# queued order given by the Chef 'sender' to another Chef (never handed over again)
+class HandoverOrder(CookOrder):
+    __slots__ = ('sender',)
+    method = Method.HANDOVER_ORDER
+    fields = CookOrder.__slots__ + __slots__ + RingMessage.__slots__
+    handed_over = True
+
+    def __init__(self, client_addr, order, ticket_no, issued_at, sender, id, msg_id = None):
+        self.sender = sender
+        CookOrder.__init__(self, client_addr, order, ticket_no, issued_at, id, msg_id)
+        if type(sender) is not int:
+            raise invalid(self)
+
+
+# request of the Chef 'sender' for 'portions' slots of an equipment, 'remaining' portions of the whole order
+class EquipmentRequest(RingMessage):
+    __slots__ = ('equipment', 'client_addr', 'ticket_no', 'portions', 'remaining', 'issued_at', 'sender')
+    method = Method.REQUEST_EQUIPMENT
+    fields = __slots__ + RingMessage.__slots__
+
+    def __init__(self, equipment, client_addr, ticket_no, portions, remaining, issued_at, sender, id, msg_id = None):
+        self.equipment = equipment
+        self.client_addr = client_addr
+        self.ticket_no = ticket_no
+        self.portions = portions
+        self.remaining = remaining
+        self.issued_at = issued_at
+        self.sender = sender
+        self.id = id
+        self.msg_id = msg_id
+        if (type(equipment) is not str or type(client_addr) is not tuple or type(ticket_no) is not int
+                or type(portions) is not int or portions < 1 or type(remaining) is not int
+                or type(issued_at) is not float and type(issued_at) is not int or type(sender) is not int or type(id) is not int):
+            raise invalid(self)
+
+
+# equipment units leased to a Chef: the portions are ready at the 'schedule' times, all of them after 'time' seconds
+class CookTime(RingMessage):
+    __slots__ = ('equipment', 'units', 'portions', 'schedule', 'time', 'client_addr', 'ticket_no')
+    method = Method.COOK_TIME
+    fields = __slots__ + RingMessage.__slots__
+
+    def __init__(self, equipment, units, portions, schedule, time, client_addr, ticket_no, id, msg_id = None):
+        self.equipment = equipment
+        self.units = units
+        self.portions = portions
+        self.schedule = schedule
+        self.time = time
+        self.client_addr = client_addr
+        self.ticket_no = ticket_no
+        self.id = id
+        self.msg_id = msg_id
+        if (type(equipment) is not str or type(units) is not list or type(portions) is not int
+                or type(schedule) is not list or type(time) is not float and type(time) is not int or type(client_addr) is not tuple
+                or type(ticket_no) is not int or type(id) is not int):
+            raise invalid(self)
+
+
+class EquipmentFree(RingMessage):
+    __slots__ = ('equipment', 'client_addr', 'ticket_no', 'units', 'sender')
+    method = Method.FREE_EQUIPMENT
+    fields = __slots__ + RingMessage.__slots__
+
+    def __init__(self, equipment, client_addr, ticket_no, units, sender, id, msg_id = None):
+        self.equipment = equipment
+        self.client_addr = client_addr
+        self.ticket_no = ticket_no
+        self.units = units
+        self.sender = sender
+        self.id = id
+        self.msg_id = msg_id
+        if (type(equipment) is not str or type(client_addr) is not tuple or type(ticket_no) is not int
+                or type(units) is not list or type(sender) is not int or type(id) is not int):
+            raise invalid(self)
+
+
+class OrderReady(RingMessage):
+    __slots__ = ('client_addr', 'ticket_no')
+    method = Method.ORDER_READY
+    fields = __slots__ + RingMessage.__slots__
+
+    def __init__(self, client_addr, ticket_no, id, msg_id = None):
+        self.client_addr = client_addr
+        self.ticket_no = ticket_no
+        self.id = id
+        self.msg_id = msg_id
+        if type(client_addr) is not tuple or type(ticket_no) is not int or type(id) is not int:
+            raise invalid(self)
+
+
+# state of one ticket given by the Waiter 'sender' to the Waiter that owns it now (after a Waiter joined or left):
+# the pickup request ('order'), the ready order ('client_addr') or the payment session (all the fields)
+class TicketHandover(RingMessage):
+    __slots__ = ('ticket_no', 'order', 'client_addr', 'amount', 'deadline', 'sender')
+    method = Method.TICKET_HANDOVER
+    fields = __slots__ + RingMessage.__slots__
+
+    def __init__(self, ticket_no, order, client_addr, amount, deadline, sender, id, msg_id = None):
+        self.ticket_no = ticket_no
+        self.order = order
+        self.client_addr = client_addr
+        self.amount = amount
+        self.deadline = deadline
+        self.sender = sender
+        self.id = id
+        self.msg_id = msg_id
+        if (type(ticket_no) is not int or order is not None and type(order) is not dict
+                or client_addr is not None and type(client_addr) is not tuple
+                or amount is not None and type(amount) is not int and type(amount) is not float
+                or deadline is not None and type(deadline) is not float and type(deadline) is not int
+                or type(sender) is not int or type(id) is not int):
+            raise invalid(self)
+
+
+# wire code of each message class: new classes at the end
+TYPES = (Order, OrderReply, Pickup, Payment, ClientOrder, ClientPickup, CookOrder, HandoverOrder,
+         EquipmentRequest, CookTime, EquipmentFree, OrderReady, TicketHandover, PaymentRequest, Delivery)
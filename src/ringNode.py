@@ -1,12 +1,54 @@
+import codec
+import itertools
 import logging
-import pickle
 import queue
 import socket
+import statistics
 import threading
-from utils import contains_successor, work
+import time
+from collections import deque
+from transport import create_transport
+from utils import contains_successor, work, config
+
+# Chord-like finger table: the nodes 1, 2, 4, 8... positions after 'identification' in the ring (sorted ids)
+class FingerTable:
+    def __init__(self, ids, identification):
+        self.ids = sorted(ids)
+        self.id = identification
+        self.positions = {node: position for position, node in enumerate(self.ids)}
+        self.fingers = []
+        distance = 1
+        while distance < len(self.ids):
+            finger = self.ids[(self.positions[identification] + distance) % len(self.ids)]
+            if finger not in self.fingers:
+                self.fingers.append(finger)
+            distance *= 2
+
+    # number of ring positions from 'self' to 'node'
+    def distance(self, node):
+        return (self.positions[node] - self.positions[self.id]) % len(self.ids)
+
+    # finger closest to 'destination' without passing it (O(log n) hops to any node)
+    def next_hop(self, destination):
+        distance = self.distance(destination)
+        return max((finger for finger in self.fingers if self.distance(finger) <= distance), key = self.distance)
+
+
+# static membership from a seed list: 'id name host:port' entries separated by commas
+def parse_seeds(text):
+    seeds = {}
+    for entry in text.split(','):
+        if entry.strip():
+            identification, name, address = entry.split()
+            host, port = address.rsplit(':', 1)
+            seeds[int(identification)] = (name, (host, int(port)))
+    return seeds
+
 
 class RingNode(threading.Thread):
-    def __init__(self, name, identification, address, ring_size, ring_addr = None, timeout = 3):
+    def __init__(self, name, identification, address, ring_size, ring_addr = None, timeout = 3, batch_size = None, frame_size = None,
+                 routing = None, parking = None, loss_factor = None, loss_timeout = None, seeds = None, join_retry = None,
+                 rejoin = False, transport = None):
         threading.Thread.__init__(self)
         
         # basic properties
@@ -19,10 +61,112 @@ class RingNode(threading.Thread):
         self.ring_addr = ring_addr
         self.nodes_table = {self.name: [self.id]}
         self.token_turn = 0
+        self.done = False
+
+        # membership: after the node discovery the nodes table is updated by versioned changes carried
+        # in the token (JOIN, LEAVE and UNLINK), so nodes join and leave without stopping the ring;
+        # 'ready' is set when the nodes table is complete
+        self.ready = threading.Event()
+        self.table_version = 0
+        # changes to put in the next token: [kind, id, name, address]
+        self.pending_changes = []
+        # replies to the nodes that joined through 'self' (sent again if the node asks again)
+        self.join_replies = {}
+        # join requests forwarded by 'self' (id -> time), the retransmissions are not forwarded again
+        # for 'timeout' seconds; requests received while 'self' is still joining are handled after it joins
+        self.join_forwarded = {}
+        self.early_joins = []
+        # leave in two steps: out of the nodes tables (LEAVE) and, two rotations later, out of the ring (UNLINK)
+        self.leave_passes = None
+        self.unlinked = False
+        # set when the LEAVE would remove the last node of the role (another one left first)
+        self.leave_refused = False
+        # requests put in the received queue and taken by the entity; the node is unlinked
+        # only if the entity asked for it after handling all of them ('unlink_at')
+        self.recv_count = 0
+        self.handled_count = 0
+        self.unlink_at = None
+
+        # token frame limits (number of messages and size in bytes)
+        if batch_size is None:
+            batch_size = config.getint('TOKEN', 'BATCH_SIZE', fallback = 8)
+        if frame_size is None:
+            frame_size = config.getint('TOKEN', 'FRAME_SIZE', fallback = 1024)
+        self.batch_size = batch_size
+        self.frame_size = frame_size
+        # bigger messages are fragmented in several datagrams
+        self.datagram_size = config.getint('TOKEN', 'DATAGRAM_SIZE', fallback = codec.MAX_DATAGRAM)
+
+        # directed messages go in the token frame ('token'), through the finger table ('finger')
+        # or straight to the destination ('direct'); the addresses are learned in the node discovery
+        if routing is None:
+            routing = config.get('TOKEN', 'ROUTING', fallback = 'token')
+        if routing not in ('token', 'finger', 'direct'):
+            raise ValueError('Unknown routing: {}'.format(routing))
+        self.routing = routing
+        self.addresses = {self.id: self.address}
+        self.finger_table = None
 
         # queues to store received requests and requests to be sent
         self.recv_requests = queue.Queue()
         self.send_requests = queue.Queue()
+        # wake-up socket pair: one byte is written for each received request,
+        # so the simulation thread can wait on it with a selector
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_send.setblocking(False)
+        # request that did not fit in the last token frame
+        self.deferred_request = None
+
+        # status board carried by the token: node id -> status published by its entity (e.g. Chef load)
+        self.status = None
+        self.status_board = {}
+
+        # an idle token (a whole rotation without messages) is parked in the initial entity;
+        # a node with requests to send wakes it up with a WAKE datagram
+        if parking is None:
+            parking = config.getboolean('TOKEN', 'PARKING', fallback = True)
+        self.parking = parking
+        self.home_addr = self.address if ring_addr is None else ring_addr
+        self.parked_token = None
+        self.wake_pending = False
+        # True when the last token left 'self' without messages (it may be parked now)
+        self.idle_token = False
+        self.park_epoch = 0
+
+        # token rotation times, measured at each frame arrival
+        self.last_token_time = None
+        self.rotation_times = deque(maxlen = 1000)
+
+        # token loss: a node waiting for the token claims a new one after 'loss_factor' times
+        # the median rotation time (at least 'loss_timeout' seconds); the claim goes around the ring
+        # and only the node whose claim comes back (highest generation, then highest id) regenerates it
+        if loss_factor is None:
+            loss_factor = config.getfloat('TOKEN', 'LOSS_FACTOR', fallback = 10)
+        if loss_timeout is None:
+            loss_timeout = config.getfloat('TOKEN', 'LOSS_TIMEOUT', fallback = 0.2)
+        self.loss_factor = loss_factor
+        self.min_loss_timeout = loss_timeout
+        self.loss_timeout = loss_timeout
+        self.last_wake_time = 0
+        # generation of the last token seen, and the lowest generation still accepted (raised by the claims)
+        self.generation = 0
+        self.min_generation = 0
+        # generation claimed by 'self' (None if not claiming) and when
+        self.claiming = None
+        self.claim_time = 0
+        # messages put in the last frame, sent again if the token is regenerated before it comes back;
+        # every message has a [source id, sequence number] id, so the destination drops the duplicates
+        self.in_flight = []
+        self.retransmit = deque()
+        self.sequence = itertools.count()
+        self.delivered = {}
+
+        # ring formation: the join requests (and the RING_COUNT token of the initial entity) are sent again
+        # after 'join_retry' seconds, doubled after each retry up to 'timeout'
+        if join_retry is None:
+            join_retry = config.getfloat('TOKEN', 'JOIN_RETRY', fallback = 0.02)
+        self.join_retry = min(join_retry, timeout)
+        self.count_timeout = self.join_retry
 
         # check if 'self' is the first node in the ring
         if ring_addr is None:
@@ -36,43 +180,71 @@ class RingNode(threading.Thread):
             self.inside_token_ring = False
             self.initial_entity = False
         
-        self.socket=socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.settimeout(timeout)
+        # static membership: the nodes table and the successor come from the seed list
+        # (id -> (name, address)), the node discovery is skipped
+        if seeds is None:
+            seeds = parse_seeds(config.get('TOKEN', 'SEEDS', fallback = ''))
+        self.seeded = self.id in seeds
+        if self.seeded:
+            self.seed_table(seeds)
+
+        # a restarted node of a running (seeded) ring: the ring is not formed again, the token is claimed
+        # if it was lost with the previous run, and the sequence numbers start after the ones of that run
+        self.rejoin = rejoin
+        if rejoin:
+            self.token_turn = 1
+            self.last_token_time = time.time()
+            self.sequence = itertools.count(int(time.time() * 1000000))
+
+        self.timeout = timeout
 
         # Create a logger for this node
         self.logger = logging.getLogger('COMM - (' + str(self.id) + ') ' + self.name)
         self.logger.setLevel(logging.INFO)
 
+        # UDP datagrams ('udp') or message objects handed to the nodes of this process ('local')
+        if transport is None:
+            transport = config.get('TOKEN', 'TRANSPORT', fallback = 'udp')
+        self.transport = create_transport(transport, self.logger, self.datagram_size)
+        self.transport.settimeout(timeout)
+
     
     def send(self, address, o):
         # self.logger.debug('Sending %s to %s', o, address)
-        p = pickle.dumps(o)
-        self.socket.sendto(p, address)
+        self.transport.send(address, o)
     
     def recv(self):
-        try:
-            p, addr = self.socket.recvfrom(1024)
-        except socket.timeout:
-            return None, None
-        else:
-            if len(p) == 0:
-                return None, addr
-            else:
-                return p, addr
+        return self.transport.recv()
     
-    # get nodes table in 'self' perspective
+    # get nodes table in 'self' perspective (updated in place when nodes join or leave)
     def get_nodes_table(self):
-        total_size = 0
-        for key, value in self.nodes_table.items():
-            total_size += len(value)
-
-        if total_size == self.ring_size:
+        if self.ready.is_set():
             return self.nodes_table
 
+    # nodes table, addresses and successor of a ring with the seed nodes (sorted by id)
+    def seed_table(self, seeds):
+        ids = sorted(seeds)
+        self.nodes_table = {}
+        for node in ids:
+            self.nodes_table.setdefault(seeds[node][0], []).append(node)
+        self.addresses = {node: seeds[node][1] for node in ids}
+        self.ring_size = len(ids)
+        self.successor_id = ids[(ids.index(self.id) + 1) % len(ids)]
+        self.successor_addr = self.addresses[self.successor_id]
+        self.inside_token_ring = True
+        if self.routing != 'token':
+            self.finger_table = FingerTable(ids, self.id)
+        self.ready.set()
+
+    # RING_COUNT token sent by the initial entity to check if all the nodes joined the ring
+    def ring_count(self):
+        self.send(self.successor_addr, {'method': 'TOKEN', 'args': {'method': 'RING_COUNT', 'args': 1}})
+
     # used by simulation thread
     def get_recv_requests(self):
         self.logger.debug('Get received request')
         if self.recv_requests.qsize() != 0:
+            self.handled_count += 1
             return self.recv_requests.get()
         else:
             return None
@@ -80,18 +252,328 @@ class RingNode(threading.Thread):
     # used by communication thread
     def put_recv_requests(self, o):
         self.logger.debug('Put received request: %s', o)
+        self.recv_count += 1
         self.recv_requests.put(o)
+        self.wake_entity()
+
+    # wake up the simulation thread waiting for requests
+    def wake_entity(self):
+        try:
+            self.wakeup_send.send(b'\0')
+        except BlockingIOError:
+            # the simulation thread has not read the previous wake-ups yet
+            pass
 
     # used by communication thread
     def get_send_requests(self):
         self.logger.debug('Get request to be sent')
+        if self.deferred_request is not None:
+            p = self.deferred_request
+            self.deferred_request = None
+            return p
+        if self.retransmit:
+            return self.retransmit.popleft()
         if self.send_requests.qsize() != 0:
             return self.send_requests.get()
 
     # used by simulation thread
     def put_send_requests(self, o):
         self.logger.debug('Put request to be sent: %s', o)
-        self.send_requests.put(o)
+        o.msg_id = (self.id, next(self.sequence))
+        if self.finger_table is not None:
+            self.route(o)
+        else:
+            self.send_requests.put(o)
+            if self.idle_token:
+                self.wake()
+
+    # ask the initial entity for the parked token
+    def wake(self):
+        if not self.parking:
+            return
+        self.idle_token = False
+        self.last_wake_time = time.time()
+        try:
+            self.send(self.home_addr, {'method': 'WAKE', 'args': self.id})
+        except OSError:
+            # the socket is already closed
+            pass
+
+    # send a directed message outside the token, straight or to the next finger
+    # (once: unlike the token frames, a lost ROUTE datagram is not sent again)
+    def route(self, o):
+        destination = o.id
+        if destination == self.id:
+            self.put_recv_requests(o)
+        elif destination not in self.addresses:
+            # like the token frames: the destination left the ring (or never joined)
+            self.logger.warning('Dropping %s to node %s (not in the ring)', o.method, destination)
+        elif self.routing == 'direct':
+            self.send(self.addresses[destination], {'method': 'ROUTE', 'args': o})
+        else:
+            self.send(self.addresses[self.finger_table.next_hop(destination)], {'method': 'ROUTE', 'args': o})
+
+    # used by simulation thread: status written in the token status board at the next token pass
+    def set_status(self, status):
+        self.status = status
+        if self.idle_token:
+            self.wake()
+
+    # used by simulation thread: last status board seen in the token
+    def get_status_board(self):
+        return self.status_board
+
+    # True while 'self' waits for the token to send or to confirm messages
+    def waiting_token(self):
+        return (self.deferred_request is not None or self.send_requests.qsize() != 0
+                or len(self.in_flight) != 0 or len(self.retransmit) != 0
+                or len(self.pending_changes) != 0 or self.unlink_at is not None)
+
+    # used by simulation thread: remove 'self' from the nodes tables; the node still passes the token
+    # and receives the messages already sent to it until 'unlink'
+    def leave(self):
+        if self.initial_entity:
+            raise ValueError('The initial entity cannot leave the ring')
+        if self.nodes_table.get(self.name) == [self.id]:
+            raise ValueError('The last {} cannot leave the ring'.format(self.name))
+        self.pending_changes.append(['LEAVE', self.id, self.name, None])
+        if self.idle_token:
+            self.wake()
+
+    # used by simulation thread, when the entity has no pending work: leave the ring (at least two
+    # rotations after 'leave', so every node stopped sending requests to 'self'), unless new requests arrive
+    def unlink(self):
+        self.unlink_at = self.handled_count
+        if self.idle_token:
+            self.wake()
+
+    # used by simulation thread, after the leave was refused: the node stays in the ring
+    def stay(self):
+        self.leave_refused = False
+        self.unlink_at = None
+
+    # put a membership change in the token and apply it to 'self'
+    def add_change(self, o, kind, node, name, address):
+        version = max(o['args'].get('version', 0), self.table_version) + 1
+        o['args']['version'] = version
+        successor = [self.successor_id, self.successor_addr] if kind == 'UNLINK' else None
+        change = [version, kind, node, name, address, successor, 0]
+        self.apply_change(change, o)
+        # number of nodes that still have to see the change
+        change[-1] = len(self.addresses)
+        o['args'].setdefault('members', []).append(change)
+
+    def apply_change(self, change, o):
+        version, kind, node, name, address, successor, remaining = change
+        self.table_version = version
+        ids = self.nodes_table.get(name, [])
+        # the lists are replaced (not changed), the entity thread may be reading them
+        if kind == 'JOIN':
+            self.logger.info('NODE_JOIN - %s %s joined the ring (version %s)', name, node, version)
+            self.addresses[node] = address
+            self.delivered.pop(node, None)
+            if node not in ids:
+                self.nodes_table[name] = ids + [node]
+        else:
+            self.logger.info('NODE_%s - %s %s left the ring (version %s)', kind, name, node, version)
+            self.nodes_table[name] = [i for i in ids if i != node]
+            o['args'].get('status', {}).pop(node, None)
+            if kind == 'UNLINK':
+                self.addresses.pop(node, None)
+                self.delivered.pop(node, None)
+                self.join_replies.pop(node, None)
+                self.join_forwarded.pop(node, None)
+                if self.successor_id == node:
+                    self.successor_id, self.successor_addr = successor
+                    self.logger.info('NODE_UNLINK - Successor: %s; Address: %s', self.successor_id, self.successor_addr)
+        self.ring_size = len(self.addresses)
+        if self.finger_table is not None:
+            self.finger_table = FingerTable(list(self.addresses), self.id)
+        self.retain_connections()
+        # the entity moves the keys of the shards that changed
+        self.wake_entity()
+
+    # connections (tcp, unix) only to the nodes this node still sends to
+    def retain_connections(self):
+        addresses = {self.successor_addr, self.home_addr}
+        if self.routing == 'direct':
+            addresses.update(self.addresses.values())
+        elif self.finger_table is not None:
+            addresses.update(self.addresses[finger] for finger in self.finger_table.fingers)
+        self.transport.retain(addresses)
+
+    # time after which a missing token is claimed
+    def token_deadline(self):
+        return max(self.last_token_time, self.last_wake_time, self.claim_time) + self.loss_timeout
+
+    # claim a new token generation: the claim goes around the ring and comes back if it wins
+    def claim_token(self):
+        generation = max(self.generation, self.min_generation, self.claiming or 0) + 1
+        self.logger.warning('Token missing for %.3f seconds, claiming generation %s',
+                            time.time() - max(self.last_token_time, self.last_wake_time), generation)
+        self.claiming = generation
+        self.min_generation = generation
+        self.claim_time = time.time()
+        self.send(self.successor_addr, {'method': 'TOKEN_CLAIM', 'args': {'id': self.id, 'generation': generation}})
+
+    def token_claim(self, args):
+        claimer, generation = args['id'], args['generation']
+        if generation <= self.generation:
+            # a token of this generation is already going around
+            return
+        if self.parked_token is not None:
+            # the token is parked here (a lost WAKE): it is not lost, so it goes around again, with the
+            # claimed generation (the nodes the claim went through drop the older ones)
+            self.logger.info('Token claimed by node %s while parked', claimer)
+            self.parked_token['args']['generation'] = generation
+            self.generation = generation
+            self.min_generation = max(self.min_generation, generation)
+            self.unpark()
+            return
+        if claimer == self.id:
+            if self.claiming == generation:
+                self.logger.warning('Token regenerated (generation %s)', generation)
+                self.claiming = None
+                token = {'method': 'TOKEN', 'args': {'method': 'FRAME', 'args': [], 'generation': generation}}
+                self.send(self.successor_addr, self.exchange_frame(token))
+            return
+        # the claim with the highest generation (then the highest id) wins
+        if self.claiming is not None and (self.claiming, self.id) > (generation, claimer):
+            return
+        self.claiming = None
+        # older tokens still going around are dropped from now on
+        self.min_generation = max(self.min_generation, generation)
+        self.send(self.successor_addr, {'method': 'TOKEN_CLAIM', 'args': args})
+
+    # send the parked token around the ring
+    def unpark(self):
+        token = self.parked_token
+        self.parked_token = None
+        token['args']['idle'] = 0
+        token['args']['epoch'] = token['args'].get('epoch', 0) + 1
+        self.send(self.successor_addr, self.exchange_frame(token))
+
+    # deliver the messages addressed to 'self' and fill the frame with pending requests
+    def exchange_frame(self, o):
+        # the rotations with a parked token are not measured
+        now = time.time()
+        epoch = o['args'].get('epoch', 0)
+        if self.last_token_time is not None and epoch == self.park_epoch:
+            self.rotation_times.append(now - self.last_token_time)
+            if len(self.rotation_times) % 64 == 0:
+                self.loss_timeout = max(self.min_loss_timeout, self.loss_factor * statistics.median(self.rotation_times))
+        self.last_token_time = now
+        self.park_epoch = epoch
+
+        # the messages put in the last frame came back delivered, unless the token was regenerated
+        generation = o['args'].get('generation', 0)
+        if generation != self.generation:
+            self.generation = generation
+            self.claiming = None
+            if self.in_flight:
+                self.logger.info('Sending %s messages again in token generation %s', len(self.in_flight), generation)
+                # same order as the first time (sequence numbers of each node must arrive in order)
+                if self.deferred_request is not None:
+                    self.retransmit.appendleft(self.deferred_request)
+                    self.deferred_request = None
+                self.retransmit.extendleft(reversed(self.in_flight))
+        self.in_flight = []
+
+        # membership changes, each one visits every node once
+        changes = o['args'].get('members')
+        if changes:
+            for change in changes:
+                if change[0] > self.table_version:
+                    self.apply_change(change, o)
+                change[-1] -= 1
+            changes = [change for change in changes if change[-1] > 0]
+            if changes:
+                o['args']['members'] = changes
+            else:
+                del o['args']['members']
+        if self.leave_passes is not None:
+            self.leave_passes += 1
+        while self.pending_changes:
+            kind, node, name, address = self.pending_changes.pop(0)
+            # the token carries every change not seen by all the nodes, so the table is up to date here
+            if kind == 'LEAVE' and self.nodes_table.get(name) == [node]:
+                self.logger.warning('NODE_LEAVE - Refused, %s %s is the last one', name, node)
+                self.leave_refused = True
+                self.wake_entity()
+                continue
+            self.add_change(o, kind, node, name, address)
+            if kind == 'LEAVE':
+                self.leave_passes = 0
+
+        # encoded size of each frame message, carried by the token (the frame is not encoded again to measure it)
+        encodes = self.transport.encodes
+        sizes = o['args'].get('sizes', [])
+        frame = []
+        frame_sizes = []
+        for i, request in enumerate(o['args']['args']):
+            if request.id == self.id:
+                # the messages of each node arrive in order, so an old sequence number is a duplicate
+                msg_id = request.msg_id
+                if msg_id is not None:
+                    if msg_id[1] <= self.delivered.get(msg_id[0], -1):
+                        self.logger.debug('Dropping duplicate message %s', msg_id)
+                        continue
+                    self.delivered[msg_id[0]] = msg_id[1]
+                # put received requests in a queue for the simulation thread
+                self.put_recv_requests(request)
+            elif request.id not in self.addresses:
+                self.logger.warning('Dropping %s to node %s (not in the ring)', request.method, request.id)
+            else:
+                frame.append(request)
+                if encodes:
+                    frame_sizes.append(sizes[i])
+        o['args']['args'] = frame
+
+        # publish 'self' status and keep a copy of the board
+        board = o['args'].setdefault('status', {})
+        if self.status is not None and self.leave_passes is None:
+            board[self.id] = self.status
+        self.status_board = dict(board)
+
+        # set before checking the send queue, so a request put meanwhile sends a WAKE
+        self.idle_token = True
+
+        # the frame size is not limited if the transport does not encode the messages
+        size = sum(frame_sizes)
+        while len(frame) < self.batch_size:
+            p = self.get_send_requests()
+            if p is None:
+                break
+            p_size = codec.value_size(p) if encodes else 0
+            # the request stays for the next token if the frame gets too big; each pass takes at least
+            # one request, so a big one does not wait for a frame without the messages of the other nodes
+            if self.in_flight and size + p_size > self.frame_size:
+                self.deferred_request = p
+                break
+            frame.append(p)
+            self.in_flight.append(p)
+            if encodes:
+                frame_sizes.append(p_size)
+            size += p_size
+            self.logger.debug('Send: %s', p)
+        if encodes:
+            o['args']['sizes'] = frame_sizes
+
+        # the last token pass of a leaving node: the entity handled all its requests, they are all sent,
+        # and everyone stopped sending it new ones (two rotations after LEAVE)
+        if (self.leave_passes is not None and self.leave_passes >= 2 and self.unlink_at == self.recv_count
+                and self.deferred_request is None and self.send_requests.qsize() == 0 and not self.retransmit):
+            self.add_change(o, 'UNLINK', self.id, self.name, None)
+            self.unlinked = True
+
+        # number of nodes in a row that passed the token without messages
+        # (a leaving node keeps the token going until it is unlinked)
+        if frame or self.unlink_at is not None:
+            self.idle_token = False
+            o['args']['idle'] = 0
+        else:
+            o['args']['idle'] = o['args'].get('idle', 0) + 1
+        return o
 
     def node_discovery(self, args):
         token_entity_table=args['args']['args']
@@ -104,11 +586,22 @@ class RingNode(threading.Thread):
         else:
             token_entity_table[self.name]=[self.id]
 
-
-        self.nodes_table = token_entity_table
-        self.logger.info('NODE_DISCOVERY - My Table of Nodes: %s', self.nodes_table)
         args['args']['args']=token_entity_table
-        
+
+        # the addresses are complete in the second discovery round
+        addresses = args['args'].setdefault('addresses', {})
+        addresses[self.id] = self.address
+        # the table is kept (and updated in place) once it is complete
+        if not self.ready.is_set():
+            self.nodes_table = {name: list(ids) for name, ids in token_entity_table.items()}
+            self.logger.info('NODE_DISCOVERY - My Table of Nodes: %s', self.nodes_table)
+            self.addresses = dict(addresses)
+            if len(self.addresses) == self.ring_size:
+                if self.routing != 'token':
+                    self.finger_table = FingerTable(list(self.addresses), self.id)
+                    self.logger.info('NODE_DISCOVERY - Fingers: %s', self.finger_table.fingers)
+                self.ready.set()
+
 
         self.send(self.successor_addr,args)
     
@@ -119,77 +612,140 @@ class RingNode(threading.Thread):
 
         self.logger.info('NODE_JOIN - Request from ID: %s; Address: %s;', identification, address)
 
-        if self.id == self.successor_id:
+        if identification in self.join_replies:
+            # the node did not get the reply and asked again (its successor is still the same,
+            # the nodes joining next to it are inserted before it)
+            self.send(address, {'method': 'NODE_JOIN_REP', 'args': self.join_replies[identification]})
+        elif identification == self.successor_id or identification == self.id:
+            # already in the ring (a late retransmission)
+            pass
+        elif self.id == self.successor_id or contains_successor(self.id, self.successor_id, identification):
+            reply = {'successor_id': self.successor_id, 'successor_addr': self.successor_addr}
             self.successor_id = identification
             self.successor_addr = address
-            args = {'successor_id': self.id, 'successor_addr': self.address}
             self.logger.info('NODE_JOIN - Successor: %s; Address: %s', self.successor_id, self.successor_addr)
-            self.send(address,{'method': 'NODE_JOIN_REP', 'args': args})
-        elif contains_successor(self.id, self.successor_id, identification):
-            args = {'successor_id': self.successor_id, 'successor_addr': self.successor_addr}
-            self.successor_id = identification
-            self.successor_addr = address
-            self.logger.info('NODE_JOIN - Successor: %s; Address: %s', self.successor_id, self.successor_addr)
-            self.send(address, {'method': 'NODE_JOIN_REP', 'args': args})
-        else:
+            if self.ready.is_set():
+                # joining a running ring: the node gets the current table, and the others
+                # get a JOIN change in the next token
+                reply['table'] = {'version': self.table_version, 'nodes': self.nodes_table, 'addresses': self.addresses}
+                self.pending_changes.append(['JOIN', identification, args['name'], address])
+            self.join_replies[identification] = reply
+            self.send(address, {'method': 'NODE_JOIN_REP', 'args': reply})
+        elif time.time() - self.join_forwarded.get(identification, 0) >= self.timeout:
             self.logger.debug('NODE_JOIN - Find Successor (id = %s)', identification)
+            self.join_forwarded[identification] = time.time()
             self.send(self.successor_addr, {'method': 'NODE_JOIN_REQ', 'args': args})
     
     def run(self):
         # node binding to itself
         self.logger.info('NODE_JOIN - Binding to address %s', self.address)
         try:
-            self.socket.bind(self.address)
-        except socket.error as msg:
+            self.transport.bind(self.address)
+        except OSError as msg:
             self.logger.info('Error binding to address %s: %s', self.address, msg)
 
         # initial entity sends a token to check if the ring is complete
-        if self.initial_entity:
-            o = {'method': 'TOKEN', 'args': {'method': 'RING_COUNT', 'args': 1}}
+        if self.initial_entity and not self.rejoin:
             self.logger.info('NODE_JOIN - Current ring size: %s', 1)
-            self.send(self.successor_addr, o)
-
-        while not self.inside_token_ring:
-            # token ring join message
-            o = {'method': 'NODE_JOIN_REQ', 'args': {'id': self.id, 'address': self.address}}
-            self.logger.info('NODE_JOIN - Sending NODE_JOIN request')
-            # send to the initial token ring node
-            self.send(self.ring_addr, o)
-            # block the program execution until receiving a message
-            p, addr = self.recv()
-
-            if p is not None:
-                o = pickle.loads(p)
+            self.ring_count()
+
+        retry = self.join_retry
+        o = None
+        while not self.inside_token_ring and not self.done:
+            if o is None:
+                # token ring join message
+                o = {'method': 'NODE_JOIN_REQ', 'args': {'id': self.id, 'address': self.address, 'name': self.name}}
+                self.logger.info('NODE_JOIN - Sending NODE_JOIN request')
+                # send to the initial token ring node
+                self.send(self.ring_addr, o)
+                # wait for the reply; the request is sent again soon (the initial node may not be up yet),
+                # and less often while the ring is busy
+                self.transport.settimeout(retry)
+                retry = min(retry * 2, self.timeout)
+            o, addr = self.recv()
+
+            if o is not None:
                 if o['method'] == 'NODE_JOIN_REP':
                     self.logger.debug('NODE_JOIN - Received NODE_JOIN response')
                     args = o['args']
                     self.successor_id = args['successor_id']
                     self.successor_addr = args['successor_addr']
                     self.inside_token_ring = True
+                    table = args.get('table')
+                    if table is not None:
+                        # the ring is already running: the JOIN change adds 'self' to the tables
+                        self.nodes_table = {name: list(ids) for name, ids in table['nodes'].items()}
+                        self.addresses = dict(table['addresses'])
+                        self.addresses[self.id] = self.address
+                        self.table_version = table['version']
+                        self.ring_size = len(self.addresses)
+                        if self.routing != 'token':
+                            self.finger_table = FingerTable(list(self.addresses), self.id)
+                        self.ready.set()
                     self.logger.info('NODE_JOIN - Joined Token-Ring - Successor: %s; Address: %s', self.successor_id, self.successor_addr)
+                    for args in self.early_joins:
+                        self.entity_join(args)
+                    self.early_joins = []
+                elif o['method'] == 'NODE_JOIN_REQ':
+                    # a node joining next to 'self', forwarded before 'self' got its reply
+                    self.early_joins.append(o['args'])
        
-        done = False
-        while not done:
-            p, addr = self.recv()
-            if p is not None:
-                o = pickle.loads(p)
+        while not self.done:
+            # shorter timeout while waiting for the token, to notice when it is lost
+            waiting = self.last_token_time is not None and self.waiting_token()
+            # the RING_COUNT token is sent again if it does not come back (lost before all the nodes were up)
+            forming = self.initial_entity and self.token_turn == 0
+            if waiting:
+                self.transport.settimeout(max(self.token_deadline() - time.time(), 0.001))
+            elif forming:
+                self.transport.settimeout(self.count_timeout)
+            elif self.last_token_time is not None:
+                # the requests put meanwhile do not wake up the recv, so 'waiting' is checked again soon
+                self.transport.settimeout(self.loss_timeout)
+            else:
+                self.transport.settimeout(self.timeout)
+            o, addr = self.recv()
+            if o is not None:
                 self.logger.debug('Received "O": %s', o)
                 if o['method'] == 'NODE_JOIN_REQ':
                     self.entity_join(o['args'])
 
+                elif o['method'] == 'ROUTE':
+                    self.route(o['args'])
+
+                elif o['method'] == 'TOKEN_CLAIM':
+                    self.token_claim(o['args'])
+
+                elif o['method'] == 'WAKE':
+                    if self.parked_token is not None:
+                        self.logger.debug('Token woken up by node %s', o['args'])
+                        self.unpark()
+                    else:
+                        # the token is on its way, it must not be parked when it arrives
+                        self.wake_pending = True
+
                 # Token methods
                 if o['method'] == 'TOKEN':
                     if o['args']['method'] == 'RING_COUNT':
                         self.logger.debug('NODE_JOIN - Current ring size: %s', o['args']['args'])
                         # check if the token returns to the initial entity
                         if self.initial_entity:
+                            self.count_timeout = self.join_retry
+                            if self.token_turn > 0:
+                                # a retransmitted RING_COUNT token, the ring is already complete
+                                continue
                             # check if the ring is complete
                             if o['args']['args'] == self.ring_size: 
                                 self.logger.info('NODE_JOIN process COMPLETED')
-                                self.logger.info('NODE_DISCOVERY process STARTED')
-                                self.logger.info('NODE_DISCOVERY - My Table of Nodes: %s', self.nodes_table)
                                 self.token_turn += 1
-                                o = {'method': 'TOKEN', 'args': {'method':'NODE_DISCOVERY', 'args': self.nodes_table}} 
+                                if self.seeded:
+                                    # the nodes tables are known, the simulation starts right away
+                                    o = {'method': 'TOKEN', 'args': {'method': 'FRAME', 'args': []}}
+                                    self.logger.info('SIMULATION process STARTED')
+                                else:
+                                    self.logger.info('NODE_DISCOVERY process STARTED')
+                                    self.logger.info('NODE_DISCOVERY - My Table of Nodes: %s', self.nodes_table)
+                                    o = {'method': 'TOKEN', 'args': {'method':'NODE_DISCOVERY', 'args': self.nodes_table}} 
                             else:
                                 # reset the ring size counter
                                 o['args']['args'] = 1
@@ -201,7 +757,7 @@ class RingNode(threading.Thread):
                         self.token_turn += 1
                         # in the second time, the node discovery process is complete
                         if self.token_turn > 2:
-                            o = {'method': 'TOKEN', 'args': {'method':None, 'args':None}}
+                            o = {'method': 'TOKEN', 'args': {'method': 'FRAME', 'args': []}}
                             self.logger.info('NODE_DISCOVERY process COMPLETED')
                             self.logger.info('SIMULATION process STARTED')
                             self.send(self.successor_addr, o)
@@ -209,29 +765,45 @@ class RingNode(threading.Thread):
                             # continue node discovery process
                             self.node_discovery(o)
 
-                    elif o['args']['method'] == None:
-                        p = self.get_send_requests()
-                        
-                        if p is not None:
-                            self.logger.debug('Send": %s', p)
-                            o= {'method': 'TOKEN', 'args': p}
-                        self.send(self.successor_addr,o)
-                    else:
-                        received_id = o['args']['args']['id']
-                        received_req = o['args']
-                        
-                        if self.id == received_id:
-                            # put received requests in a queue for the simulation thread
-                            self.put_recv_requests(received_req)
-                            p=self.get_send_requests()
-                            if p is not None:
-                                self.logger.debug('Send: %s', p)
-                                o = {'method': 'TOKEN', 'args': p}
-                            else:
-                                o = {'method': 'TOKEN', 'args': {'method':None, 'args':None}}
+                    elif o['args']['method'] == 'FRAME':
+                        if o['args'].get('generation', 0) < max(self.generation, self.min_generation):
+                            # an old token that was claimed lost (e.g. delayed), a newer one is going around
+                            self.logger.warning('Dropping token of generation %s', o['args'].get('generation', 0))
+                            continue
+                        o = self.exchange_frame(o)
+                        # the token is not parked while membership changes go around the ring
+                        if (self.parking and self.initial_entity and o['args']['idle'] >= self.ring_size
+                                and not self.wake_pending and not o['args'].get('members')):
+                            self.logger.debug('Token parked')
+                            self.parked_token = o
+                        else:
+                            self.wake_pending = False
+                            self.send(self.successor_addr, o)
 
-                        self.send(self.successor_addr, o)
+            if waiting and self.waiting_token() and time.time() >= self.token_deadline():
+                # a lost token (or a lost WAKE datagram)
+                self.claim_token()
+            elif forming and o is None and self.token_turn == 0 and not self.done:
+                self.logger.debug('NODE_JOIN - RING_COUNT token sent again')
+                self.count_timeout = min(self.count_timeout * 2, self.timeout)
+                self.ring_count()
+
+            if self.unlinked:
+                self.logger.info('NODE_UNLINK - Left the ring')
+                self.done = True
+                self.wakeup_send.send(b'\0')
                     
+        self.transport.close()
+
+    # stop the communication thread (wakes up the blocking recv)
+    def stop(self):
+        self.done = True
+        try:
+            self.transport.wake()
+        except OSError:
+            # the socket is already closed
+            pass
+
     def __str__(self):
         return 'Name: {}; ID: {}; Address: {}; Successor: {}'\
             .format(self.name, self.id, self.address, self.successor_addr)
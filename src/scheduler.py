@@ -0,0 +1,67 @@
+import heapq
+import itertools
+
+# ready queues of the kitchen equipment requests (messages.EquipmentRequest), selected in config.ini ([RESTAURANT] SCHEDULER)
+#
+# every policy is a heap ordered by a priority key, so push and pop are O(log n);
+# the arrival order breaks the ties
+
+
+# first in, first out (the original behaviour)
+class Scheduler:
+    def __init__(self):
+        self.heap = []
+        self.sequence = itertools.count()
+
+    def key(self, request):
+        return 0
+
+    def push(self, request):
+        heapq.heappush(self.heap, (self.key(request), next(self.sequence), request))
+
+    def pop(self):
+        return heapq.heappop(self.heap)[2]
+
+    def __len__(self):
+        return len(self.heap)
+
+
+# shortest remaining order first: the orders with less portions left finish sooner
+class ShortestRemainingOrderFirst(Scheduler):
+    def key(self, request):
+        return request.remaining
+
+
+# earliest ticket first: the oldest orders, by the time the Clerk issued the ticket
+class EarliestTicketFirst(Scheduler):
+    def key(self, request):
+        return request.issued_at
+
+
+# fair share across Chefs (start-time fair queueing, weighted by the number of portions)
+class FairShare(Scheduler):
+    def __init__(self):
+        Scheduler.__init__(self)
+        self.virtual_time = 0
+        # finish tag of the last request of each Chef
+        self.finish = {}
+
+    def key(self, request):
+        start = max(self.virtual_time, self.finish.get(request.sender, 0))
+        self.finish[request.sender] = start + request.portions
+        return start
+
+    def pop(self):
+        start, sequence, request = heapq.heappop(self.heap)
+        self.virtual_time = start
+        return request
+
+
+SCHEDULERS = {'fifo': Scheduler, 'srof': ShortestRemainingOrderFirst,
+              'earliest_ticket': EarliestTicketFirst, 'fair_share': FairShare}
+
+
+def create_scheduler(name):
+    if name not in SCHEDULERS:
+        raise ValueError('Unknown scheduler: {} (one of {})'.format(name, ', '.join(SCHEDULERS)))
+    return SCHEDULERS[name]()
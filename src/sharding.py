@@ -0,0 +1,27 @@
+import bisect
+import hashlib
+
+# consistent hashing of the nodes of one role (e.g. all the Waiters)
+#
+# each node has 'replicas' points in a 64 bit ring and a key belongs to the
+# node of the first point after the key hash, so adding or removing a node
+# only moves the keys of its own points
+
+
+def key_hash(key):
+    # same hash in every process (the builtin hash of str is randomized)
+    return int.from_bytes(hashlib.blake2b(str(key).encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    def __init__(self, nodes, replicas = 64):
+        self.nodes = list(nodes)
+        self.points = sorted((key_hash('{}-{}'.format(node, i)), node) for node in self.nodes for i in range(replicas))
+        self.hashes = [point[0] for point in self.points]
+
+    # node responsible for 'key'
+    def node(self, key):
+        if not self.points:
+            raise ValueError('Empty hash ring')
+        i = bisect.bisect(self.hashes, key_hash(key)) % len(self.points)
+        return self.points[i][1]
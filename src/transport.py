@@ -0,0 +1,370 @@
+import codec
+import os
+import queue
+import selectors
+import socket
+import struct
+import tempfile
+import threading
+from utils import config
+
+# transports under RingNode.send and RingNode.recv: whole messages are sent to an address
+# and received (with the sender address) by the node bound to it
+#
+# udp:   codec datagrams over UDP sockets (fragmented when bigger than 'datagram_size')
+# local: the message objects go straight to the mailbox of a node of the same process,
+#        without serialization (e.g. all the entities in Simulation.py)
+# tcp:   persistent TCP connections to the other nodes (the successor, mostly), with length-framed messages
+# unix:  the same over AF_UNIX sockets, one socket file per node address
+
+
+class UdpTransport:
+    # the messages are encoded, so their size is known (and limited)
+    encodes = True
+
+    def __init__(self, logger, datagram_size = codec.MAX_DATAGRAM):
+        self.logger = logger
+        self.datagram_size = datagram_size
+        self.address = None
+        self.reassembler = codec.Reassembler()
+        self.buffer = codec.ReceiveBuffer(datagram_size)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def bind(self, address):
+        self.socket.bind(address)
+        self.address = address
+
+    def settimeout(self, timeout):
+        self.socket.settimeout(timeout)
+
+    def send(self, address, o):
+        for p in codec.encode(o, self.datagram_size):
+            self.socket.sendto(p, address)
+
+    # (message, sender address); the message is None after a timeout, a wake-up or an incomplete fragmented message
+    def recv(self):
+        try:
+            p, addr = self.buffer.recvfrom(self.socket)
+        except socket.timeout:
+            return None, None
+        except ConnectionRefusedError:
+            # a previous datagram was sent to a closed port
+            return None, None
+        else:
+            if len(p) == 0:
+                return None, addr
+            try:
+                # None while a fragmented message is not complete
+                return self.reassembler.feed(p, addr), addr
+            except ValueError as e:
+                self.logger.warning('Dropping datagram from %s: %s', addr, e)
+                return None, addr
+
+    # wake up the blocking recv with an empty datagram
+    def wake(self):
+        self.socket.sendto(b'', self.address)
+
+    # no connections to close
+    def retain(self, addresses):
+        pass
+
+    def close(self):
+        self.socket.close()
+
+
+class LocalTransport:
+    encodes = False
+
+    # mailboxes of the nodes bound in this process: address -> queue of (message, sender address)
+    mailboxes = {}
+    lock = threading.Lock()
+
+    def __init__(self, logger, datagram_size = None):
+        self.logger = logger
+        self.address = None
+        self.mailbox = queue.SimpleQueue()
+        self.timeout = None
+
+    def bind(self, address):
+        with LocalTransport.lock:
+            if address in LocalTransport.mailboxes:
+                raise OSError('Address already in use: {}'.format(address))
+            LocalTransport.mailboxes[address] = self.mailbox
+        self.address = address
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    # the receiver gets the same object: the sender must not change it after sending it
+    def send(self, address, o):
+        mailbox = LocalTransport.mailboxes.get(address)
+        # like a datagram sent to a closed port
+        if mailbox is not None:
+            mailbox.put((o, self.address))
+
+    def recv(self):
+        try:
+            return self.mailbox.get(timeout = self.timeout)
+        except queue.Empty:
+            return None, None
+
+    def wake(self):
+        self.mailbox.put((None, self.address))
+
+    def retain(self, addresses):
+        pass
+
+    def close(self):
+        with LocalTransport.lock:
+            if LocalTransport.mailboxes.get(self.address) is self.mailbox:
+                del LocalTransport.mailboxes[self.address]
+
+
+# frame = length (4 bytes) | codec message; the first frame of a connection is the address of the sender node
+FRAME_LENGTH = struct.Struct('!I')
+# longest frame accepted, the biggest message of the udp transport (the length of a corrupt frame is not trusted)
+MAX_FRAME = codec.MAX_FRAGMENTS * codec.MAX_DATAGRAM
+
+
+class StreamTransport:
+    encodes = True
+
+    def __init__(self, logger, datagram_size = None, family = socket.AF_INET):
+        self.logger = logger
+        self.family = family
+        self.address = None
+        self.timeout = None
+        # frames are written when the receiving thread goes back to recv, or at 'flush_size' bytes,
+        # so the messages sent in one token pass go out in one write (TCP_NODELAY: no kernel Nagle delays)
+        self.flush_size = config.getint('TOKEN', 'FLUSH_SIZE', fallback = 65536)
+        self.connect_timeout = config.getfloat('TOKEN', 'CONNECT_TIMEOUT', fallback = 1)
+        self.listener = None
+        self.selector = selectors.DefaultSelector()
+        # wake-up socket pair of the blocking recv
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_send.setblocking(False)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, 'wakeup')
+        # outgoing connections: address -> [socket, output buffer, write lock]; 'lock' guards the table
+        # and the buffers, the write lock the socket (connect and write without blocking the other connections)
+        self.connections = {}
+        self.lock = threading.Lock()
+        # incoming connections: socket -> [sender address, input buffer, bytes in the buffer]
+        self.incoming = {}
+        self.buffer_size = 65536
+        self.messages = []
+        self.owner = None
+
+    # socket file of the address of a node (AF_UNIX)
+    def path(self, address):
+        directory = config.get('TOKEN', 'SOCKET_DIR', fallback = '') or tempfile.gettempdir()
+        return os.path.join(directory, 'ring-{}-{}.sock'.format(*address))
+
+    def bind(self, address):
+        listener = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family == socket.AF_UNIX:
+            path = self.path(address)
+            if os.path.exists(path):
+                # a socket file left by a node that is not running any more
+                try:
+                    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                        probe.connect(path)
+                except OSError:
+                    os.unlink(path)
+            listener.bind(path)
+        else:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind(address)
+        listener.listen()
+        listener.setblocking(False)
+        self.listener = listener
+        self.selector.register(listener, selectors.EVENT_READ, 'listener')
+        self.address = address
+        self.owner = threading.get_ident()
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def connect(self, address):
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.settimeout(self.connect_timeout)
+        sock.connect(self.path(address) if self.family == socket.AF_UNIX else address)
+        if self.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        hello = codec.encode_message(self.address)
+        sock.sendall(FRAME_LENGTH.pack(len(hello)) + hello)
+        return sock
+
+    def send(self, address, o):
+        data = codec.encode_message(o)
+        with self.lock:
+            connection = self.connections.get(address)
+            if connection is None:
+                connection = self.connections[address] = [None, bytearray(), threading.Lock()]
+            connection[1] += FRAME_LENGTH.pack(len(data))
+            connection[1] += data
+            # the other threads (e.g. a WAKE put by the entity) do not wait for the next recv
+            flush = threading.get_ident() != self.owner or len(connection[1]) >= self.flush_size
+        if flush:
+            self.flush_connection(address, connection)
+
+    # write the output buffer; the buffer is taken under the write lock, so the frames go out in order.
+    # A connection dropped from the table is closed once its last frames are written
+    def flush_connection(self, address, connection):
+        with connection[2]:
+            with self.lock:
+                data = bytes(connection[1])
+                connection[1].clear()
+                dropped = self.connections.get(address) is not connection
+            if data:
+                self.write(address, connection, data)
+            if dropped and connection[0] is not None:
+                connection[0].close()
+                connection[0] = None
+
+    # connect (again) if needed; the frames are dropped if the node is not reachable,
+    # like datagrams sent to a closed port
+    def write(self, address, connection, data):
+        for attempt in range(2):
+            try:
+                if connection[0] is None:
+                    connection[0] = self.connect(address)
+                connection[0].sendall(data)
+                return
+            except OSError as e:
+                if connection[0] is not None:
+                    connection[0].close()
+                    connection[0] = None
+                if attempt == 1 or isinstance(e, (ConnectionRefusedError, FileNotFoundError, socket.timeout)):
+                    self.logger.debug('Dropping %s bytes to %s: %s', len(data), address, e)
+                    return
+
+    def flush(self):
+        with self.lock:
+            pending = [(address, connection) for address, connection in self.connections.items() if connection[1]]
+        for address, connection in pending:
+            self.flush_connection(address, connection)
+
+    # close the connections to the other addresses (e.g. a former successor), after their last frames
+    def retain(self, addresses):
+        with self.lock:
+            dropped = [address for address in self.connections if address not in addresses]
+            dropped = [(address, self.connections.pop(address)) for address in dropped]
+        for address, connection in dropped:
+            self.flush_connection(address, connection)
+
+    # read the complete frames of an incoming connection: the data is received straight into the connection
+    # buffer (grown for big frames) and the frames are decoded from views of it
+    def read(self, sock):
+        connection = self.incoming[sock]
+        sender, buffer, fill = connection
+        if fill == len(buffer):
+            buffer.extend(bytes(len(buffer)))
+        try:
+            with memoryview(buffer) as view:
+                n = sock.recv_into(view[fill:])
+        except OSError:
+            n = 0
+        if n == 0:
+            self.close_incoming(sock)
+            return
+        fill += n
+        offset = 0
+        corrupt = False
+        with memoryview(buffer) as view:
+            while fill - offset >= FRAME_LENGTH.size:
+                length = FRAME_LENGTH.unpack_from(view, offset)[0]
+                if length > MAX_FRAME:
+                    self.logger.warning('Closing the connection of %s: frame of %s bytes', sender, length)
+                    corrupt = True
+                    break
+                end = offset + FRAME_LENGTH.size + length
+                if end > fill:
+                    break
+                try:
+                    o = codec.decode(view[offset + FRAME_LENGTH.size:end])
+                except ValueError as e:
+                    self.logger.warning('Dropping frame from %s: %s', sender, e)
+                    o = None
+                offset = end
+                if sender is None:
+                    # the first frame is the address of the sender node
+                    sender = connection[0] = o
+                elif o is not None:
+                    self.messages.append((o, sender))
+            # the incomplete frame goes to the start of the buffer
+            view[:fill - offset] = view[offset:fill]
+        if corrupt:
+            self.close_incoming(sock)
+            return
+        connection[2] = fill - offset
+        # room for the whole frame
+        if connection[2] >= FRAME_LENGTH.size:
+            size = FRAME_LENGTH.size + FRAME_LENGTH.unpack_from(buffer, 0)[0]
+            if size > len(buffer):
+                buffer.extend(bytes(size - len(buffer)))
+
+    def close_incoming(self, sock):
+        self.selector.unregister(sock)
+        sock.close()
+        del self.incoming[sock]
+
+    def recv(self):
+        self.flush()
+        while not self.messages:
+            events = self.selector.select(self.timeout)
+            if not events:
+                return None, None
+            for key, mask in events:
+                if key.data == 'listener':
+                    try:
+                        sock, addr = self.listener.accept()
+                    except OSError:
+                        continue
+                    sock.setblocking(False)
+                    self.incoming[sock] = [None, bytearray(self.buffer_size), 0]
+                    self.selector.register(sock, selectors.EVENT_READ, 'incoming')
+                elif key.data == 'wakeup':
+                    self.wakeup_recv.recv(4096)
+                    return None, self.address
+                else:
+                    self.read(key.fileobj)
+        return self.messages.pop(0)
+
+    def wake(self):
+        self.wakeup_send.send(b'\0')
+
+    def close(self):
+        # e.g. the last token sent by a node leaving the ring
+        self.retain(())
+        for sock in self.incoming:
+            sock.close()
+        self.incoming = {}
+        if self.listener is not None:
+            self.listener.close()
+            if self.family == socket.AF_UNIX:
+                try:
+                    os.unlink(self.path(self.address))
+                except OSError:
+                    pass
+        self.selector.close()
+        self.wakeup_recv.close()
+        self.wakeup_send.close()
+
+
+class TcpTransport(StreamTransport):
+    def __init__(self, logger, datagram_size = None):
+        StreamTransport.__init__(self, logger, datagram_size, socket.AF_INET)
+
+
+class UnixTransport(StreamTransport):
+    def __init__(self, logger, datagram_size = None):
+        StreamTransport.__init__(self, logger, datagram_size, socket.AF_UNIX)
+
+
+TRANSPORTS = {'udp': UdpTransport, 'local': LocalTransport, 'tcp': TcpTransport, 'unix': UnixTransport}
+
+
+def create_transport(name, logger, datagram_size = codec.MAX_DATAGRAM):
+    if name not in TRANSPORTS:
+        raise ValueError('Unknown transport: {}'.format(name))
+    return TRANSPORTS[name](logger, datagram_size)
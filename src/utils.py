@@ -1,12 +1,25 @@
 import configparser
+import itertools
 import time
-from random import randint
+from random import randint, gauss
 import socket
-import pickle
+import logging
+import threading
+import codec
+
+# real time clock (replaced by a virtual clock in VirtualSimulation)
+class Clock:
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+clock = Clock()
 
 # simulate entity work
 def work(seconds):
-    time.sleep(seconds)
+    clock.sleep(seconds)
 
 # load the configuration file
 config = configparser.ConfigParser()
@@ -14,6 +27,17 @@ config.read('../config.ini')
 
 count_Chef=-1
 
+# menu item cooked in each kitchen equipment
+ITEMS = {'barbecue_grill': 'hamburger', 'fryer': 'fries', 'bar': 'drink'}
+
+# estimated time to cook the portions of each menu item, with the equipment mean times
+def cook_time(portions):
+    return sum(portions.get(item, 0) * config.getfloat(equipment.upper(), 'MEAN') for equipment, item in ITEMS.items())
+
+# random time of each entity action (never negative, 'work' would fail)
+def action_time():
+    return max(gauss(config.getfloat('ACTION_TIME', 'MEAN'), config.getfloat('ACTION_TIME', 'STD_DEVIATION')), 0)
+
 def contains_successor(identification, successor, node):
     if identification < node <= successor:
         return True
@@ -21,27 +45,54 @@ def contains_successor(identification, successor, node):
         return True
     return False
 
+# ticket numbers: 64 bit integers (signed, like the codec INT64) with the id of the Clerk node in the high
+# bits and a sequence number, unique across the Clerks of the ring
+TICKET_NODE_BITS = 16
+TICKET_SEQUENCE_BITS = 47
+
+# ticket numbers of the Clerk 'node_id'; the sequence starts at the clock time in milliseconds and is
+# not saved, so a restarted Clerk does not repeat the tickets of its orders still in flight only if it
+# issued at most one ticket per millisecond since it started (a faster Clerk runs ahead of the clock)
+def ticket_numbers(node_id):
+    if not 0 <= node_id < 1 << TICKET_NODE_BITS:
+        raise ValueError('Node id out of the ticket range: {}'.format(node_id))
+    prefix = node_id << TICKET_SEQUENCE_BITS
+    mask = (1 << TICKET_SEQUENCE_BITS) - 1
+    for sequence in itertools.count(int(clock.time() * 1000)):
+        yield prefix | sequence & mask
+
+# receive buffer and reassembler of the fragmented messages of each thread (e.g. each entity client socket)
+buffers = threading.local()
+
 def recv(sock):
+    buffer = getattr(buffers, 'buffer', None)
+    if buffer is None:
+        buffer = buffers.buffer = codec.ReceiveBuffer()
+        buffers.reassembler = codec.Reassembler()
+    reassembler = buffers.reassembler
     try:
-        p, port = sock.recvfrom(1024)
+        p, port = buffer.recvfrom(sock)
     except socket.timeout:
 
         return None, None
     else:
         if len(p) == 0:
             return None, port
-        else:
-            return p, port
+        try:
+            return reassembler.feed(p, port), port
+        except ValueError as e:
+            logging.getLogger('Codec').warning('Dropping datagram from %s: %s', port, e)
+            return None, port
 
 def send(sock,address, o):
-    p = pickle.dumps(o)
-    sock.sendto(p, address)
+    for p in codec.encode(o):
+        sock.sendto(p, address)
 
 def choose_node(name,table):
     
     size = len(table[name])
     if size == 0:
-        return table['name'][0]
+        raise ValueError('No {} in the nodes table'.format(name))
     else:
         globals()['count_%s'%name] += 1
         return table[name][globals().get('count_%s'%name)%size]
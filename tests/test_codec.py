@@ -0,0 +1,62 @@
+import os
+import random
+import struct
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import codec
+from messages import CookOrder, Order, Payment
+
+
+def test_round_trip():
+    o = {'method': 'TOKEN', 'args': {'method': 'FRAME', 'args': [CookOrder(('127.0.0.1', 5006), {'fries': 2}, 1 << 47, 1.5, 2, (1, 3))]}}
+    decoded = codec.decode(codec.encode_message(o))
+    order = decoded['args']['args'][0]
+    assert (order.client_addr, order.order, order.ticket_no, order.msg_id) == (('127.0.0.1', 5006), {'fries': 2}, 1 << 47, (1, 3))
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'\x01',
+    b'\x02\x00\x00',                                        # unknown version
+    b'\x01\x00\xff',                                        # unknown tag
+    b'\x01\x00\x08\x00\x05ab',                              # truncated string
+    b'\x01\x00\x08\x00\x02\xff\xfe',                        # invalid utf-8
+    bytes.fromhex('01000d00010b000000'),                    # dict with a list key
+    bytes.fromhex('01000d00010c00010b000000'),              # dict with a tuple key holding a list
+    b'\x01\x00\x0f\xff',                                    # unknown record code
+    b'\x01\x00\x0f\x00\x03\x05',                            # record with an invalid field
+    b'\x01\x00\x00\x00',                                    # trailing bytes
+    b'\x01\x00' + b'\x0b\x00\x01' * 2000 + b'\x00',         # too deep
+])
+def test_malformed_datagram(data):
+    with pytest.raises(ValueError):
+        codec.decode(data)
+
+
+# a payment of NaN or infinity would pass the 'amount < bill' check
+@pytest.mark.parametrize('amount', [float('nan'), float('inf'), float('-inf')])
+def test_non_finite_payment(amount):
+    with pytest.raises(ValueError):
+        Payment(amount, 7)
+    data = bytes(codec.encode_message(Payment(1.5, 7))).replace(struct.pack('!d', 1.5), struct.pack('!d', amount))
+    with pytest.raises(ValueError):
+        codec.decode(data)
+
+
+# random changes of valid datagrams never raise anything but ValueError
+def test_corrupted_datagrams():
+    random.seed(1)
+    valid = [bytes(codec.encode_message(o)) for o in [Order({'hamburger': 1, 'fries': 2}), {'a': [1, (2, 3)], 4: None},
+             {'method': 'TOKEN', 'args': {'method': 'FRAME', 'args': [CookOrder(('h', 1), {}, 7, 0, 2)]}}]]
+    for i in range(20000):
+        data = bytearray(random.choice(valid))
+        for j in range(random.randint(1, 3)):
+            data[random.randrange(2, len(data))] = random.randrange(256)
+        try:
+            codec.decode(data)
+        except ValueError:
+            pass
@@ -0,0 +1,42 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from VirtualSimulation import EventLoop, VirtualClock
+
+
+# each event of the entity works 'duration' seconds of virtual time
+def make_loop():
+    clock = VirtualClock()
+    loop = EventLoop(clock)
+    handled = []
+    def work(name, duration):
+        handled.append((name, clock.now, len(loop.events)))
+        clock.sleep(duration)
+    return loop, handled, work
+
+
+def test_busy_entity_handles_events_in_arrival_order():
+    loop, handled, work = make_loop()
+    entity = object()
+    loop.schedule(0, entity, work, 'a', 10)
+    loop.schedule(5, entity, work, 'c', 1)
+    loop.schedule(3, entity, work, 'b', 1)
+    loop.schedule(20, entity, work, 'd', 1)
+    loop.schedule(4, None, work, 'client', 0)
+    loop.run()
+    assert [(name, t) for name, t, size in handled] == [('a', 0), ('client', 4), ('b', 10), ('c', 11), ('d', 20)]
+
+
+# the events waiting for a busy entity are not pushed into the heap again and again
+def test_overloaded_entity_heap_size():
+    loop, handled, work = make_loop()
+    entity = object()
+    for i in range(1000):
+        loop.schedule(i * 0.001, entity, work, i, 1)
+    loop.run()
+    assert [(name, t) for name, t, size in handled] == [(i, i) for i in range(1000)]
+    # once all the events arrived, the heap only holds the event that frees the entity
+    assert max(size for name, t, size in handled[2:]) <= 1
+    assert loop.processed == 1000
@@ -0,0 +1,195 @@
+import asyncio
+import collections
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import loadgen
+import utils
+from Chef import Chef
+from Clerk import Clerk
+from Restaurant import Restaurant
+from Waiter import Waiter
+from messages import Delivery, Order, OrderReply, Payment, PaymentRequest, Pickup
+from ringNode import RingNode
+
+ENTITY_CLASSES = {'Drive-Through': Restaurant, 'Clerk': Clerk, 'Chef': Chef, 'Waiter': Waiter}
+MIX = {'hamburger': 1, 'drink': 1, 'fries': 1}
+
+
+# config.ini with the times in milliseconds (like benchmark.scale_times), restored after the tests
+@pytest.fixture(autouse = True, scope = 'module')
+def config():
+    saved = {section: dict(utils.config[section]) for section in utils.config.sections()}
+    utils.config.read(os.path.join(os.path.dirname(__file__), '..', 'config.ini'))
+    for section in ['ACTION_TIME', 'BARBECUE_GRILL', 'BAR', 'FRYER']:
+        for option in ['MEAN', 'STD_DEVIATION']:
+            utils.config.set(section, option, str(utils.config.getfloat(section, option) * 0.001))
+    yield
+    for section in utils.config.sections():
+        utils.config.remove_section(section)
+    utils.config.read_dict(saved)
+
+
+# entity 'ide' of a ring in this process (LocalTransport); the clients still use UDP (port + 100)
+def start_entity(base_port, name, ide, ring_size):
+    ring_addr = None if ide == 0 else ('localhost', base_port)
+    comm_thread = RingNode(name, ide, ('localhost', base_port + ide), ring_size, ring_addr, 3, transport = 'local')
+    comm_thread.start()
+    entity = ENTITY_CLASSES[name](base_port, ring_size, 3, base_port + ide, ide, comm_thread)
+    entity.start()
+    return entity
+
+
+def start_restaurant(base_port, names):
+    entities = [start_entity(base_port, name, ide, len(names)) for ide, name in enumerate(names)]
+    assert wait_for(lambda: all(entity.entities_table is not None for entity in entities), 30)
+    return entities
+
+
+def wait_for(condition, timeout = 10):
+    deadline = time.perf_counter() + timeout
+    while not condition() and time.perf_counter() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+
+# calls of 'method' of the entity for each ticket ('ticket' gets the ticket number from the arguments)
+def count(entity, method, counts, ticket = lambda ticket_no, *args: ticket_no):
+    function = getattr(entity, method)
+    def counted(*args):
+        counts[ticket(*args)] += 1
+        function(*args)
+    setattr(entity, method, counted)
+
+
+# the sessions of the load generator, in a thread
+def generate(base_port, no_sessions, rate, profile = 'poisson', burst_size = 1):
+    result = {}
+    def load():
+        result['stats'] = asyncio.run(loadgen.generate(('localhost', base_port + 100), no_sessions, rate, profile,
+                                                       burst_size, MIX, 20))
+    generator = threading.Thread(target = load)
+    generator.start()
+    return generator, result
+
+
+def stop(entities):
+    for entity in entities:
+        entity.stop()
+    for entity in entities:
+        entity.join(5)
+
+
+# every order is cooked once, billed and paid once, and its session completes
+def assert_once(summary, cooked, paid, no_sessions):
+    assert summary['completed'] == no_sessions
+    assert not any(summary['failed'].values())
+    assert len(cooked) == no_sessions and set(cooked.values()) == {1}
+    assert len(paid) == no_sessions and set(paid.values()) == {1}
+
+
+def test_chef_joins_under_load():
+    base_port = 31200
+    entities = start_restaurant(base_port, ['Drive-Through', 'Clerk', 'Chef', 'Waiter'])
+    cooked, paid = collections.Counter(), collections.Counter()
+    count(entities[2], 'order_ready', cooked)
+    count(entities[3], 'pay', paid, lambda session, amount: session.ticket_no)
+    try:
+        generator, result = generate(base_port, 60, 60)
+        time.sleep(0.3)
+        chef = start_entity(base_port, 'Chef', 4, 5)
+        count(chef, 'order_ready', cooked)
+        entities.append(chef)
+        assert wait_for(lambda: 4 in entities[1].entities_table['Chef'])
+        generator.join()
+        assert_once(result['stats'].summary(), cooked, paid, 60)
+    finally:
+        stop(entities)
+
+
+def test_chef_leaves_with_queued_orders():
+    base_port = 31210
+    entities = start_restaurant(base_port, ['Drive-Through', 'Clerk', 'Chef', 'Waiter', 'Chef'])
+    first = entities[2]
+    cooked, paid = collections.Counter(), collections.Counter()
+    for chef in (entities[2], entities[4]):
+        count(chef, 'order_ready', cooked)
+    count(entities[3], 'pay', paid, lambda session, amount: session.ticket_no)
+    try:
+        # one burst: the orders queue up behind the cooking slots
+        generator, result = generate(base_port, 40, 40, 'burst', 40)
+        assert wait_for(lambda: len(first.cook_order) >= 2)
+        first.leave()
+        first.comm_thread.join(10)
+        assert not first.comm_thread.is_alive()
+        assert first.id not in entities[1].entities_table['Chef']
+        generator.join()
+        assert_once(result['stats'].summary(), cooked, paid, 40)
+    finally:
+        stop(entities)
+
+
+# ORDER and PICKUP of a client session, until the payment request
+def open_session(base_port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('localhost', 0))
+    sock.settimeout(10)
+    utils.send(sock, ('localhost', base_port + 100), Order(MIX))
+    o, addr = utils.recv(sock)
+    assert type(o) is OrderReply
+    utils.send(sock, ('localhost', base_port + 100), Pickup(o.ticket_no, o.order))
+    request, addr = utils.recv(sock)
+    assert type(request) is PaymentRequest and request.ticket_no == o.ticket_no
+    return sock, request, addr
+
+
+# pays the last payment request (sent again by the Waiter that took over the ticket) and waits for the order
+def pay(sock, request, addr):
+    sock.settimeout(0.2)
+    o, sender = utils.recv(sock)
+    while o is not None:
+        assert type(o) is PaymentRequest
+        request, addr = o, sender
+        o, sender = utils.recv(sock)
+    sock.settimeout(10)
+    utils.send(sock, addr, Payment(request.amount, request.ticket_no))
+    o, sender = utils.recv(sock)
+    assert type(o) is Delivery and o.ticket_no == request.ticket_no
+    # no second delivery
+    sock.settimeout(0.2)
+    assert utils.recv(sock) == (None, None)
+    return o.ticket_no
+
+
+def test_waiter_leaves_with_open_sessions():
+    base_port = 31220
+    entities = start_restaurant(base_port, ['Drive-Through', 'Clerk', 'Chef', 'Waiter', 'Waiter'])
+    cooked, paid = collections.Counter(), collections.Counter()
+    count(entities[2], 'order_ready', cooked)
+    for waiter in (entities[3], entities[4]):
+        count(waiter, 'pay', paid, lambda session, amount: session.ticket_no)
+    sessions = []
+    try:
+        for i in range(12):
+            sessions.append(open_session(base_port))
+        # the Waiter with more open sessions leaves before they are paid
+        leaving = max(entities[3], entities[4], key = lambda waiter: len(waiter.payments))
+        assert leaving.payments
+        leaving.leave()
+        leaving.comm_thread.join(10)
+        assert not leaving.comm_thread.is_alive()
+        tickets = [pay(*session) for session in sessions]
+        assert sorted(tickets) == sorted(request.ticket_no for sock, request, addr in sessions)
+        assert len(cooked) == 12 and set(cooked.values()) == {1}
+        assert len(paid) == 12 and set(paid.values()) == {1}
+    finally:
+        for sock, request, addr in sessions:
+            sock.close()
+        stop(entities)
@@ -0,0 +1,119 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from messages import OrderReady
+from ringNode import RingNode
+
+LOSS_TIMEOUT = 0.2
+
+
+# ring of 'size' nodes in this process (LocalTransport), with token parking
+def start_ring(base_port, size = 4):
+    nodes = []
+    for i in range(size):
+        ring_addr = None if i == 0 else ('localhost', base_port)
+        node = RingNode('Chef', i, ('localhost', base_port + i), size, ring_addr, loss_timeout = LOSS_TIMEOUT,
+                        parking = True, transport = 'local')
+        node.daemon = True
+        node.start()
+        nodes.append(node)
+    for node in nodes:
+        assert node.ready.wait(10)
+    return nodes
+
+
+# the next 'count' messages of 'method' sent by 'node' are dropped; returns the drop times
+def drop(node, method, count = 1):
+    drops = []
+    send = node.send
+    def lossy_send(address, o):
+        if len(drops) < count and (o['method'] == method or o['method'] == 'TOKEN' and o['args']['method'] == method):
+            drops.append(time.perf_counter())
+            return
+        send(address, o)
+    node.send = lossy_send
+    return drops
+
+
+# (time, ticket number) of the messages delivered to 'node'
+def collect(node):
+    delivered = []
+    def consume():
+        while True:
+            request = node.recv_requests.get()
+            if request is None:
+                break
+            delivered.append((time.perf_counter(), request.ticket_no))
+    consumer = threading.Thread(target = consume, daemon = True)
+    consumer.start()
+    return delivered, consumer
+
+
+def wait_for(condition, timeout = 5):
+    deadline = time.perf_counter() + timeout
+    while not condition() and time.perf_counter() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+
+def stop(nodes, target, consumer):
+    target.recv_requests.put(None)
+    consumer.join()
+    for node in nodes:
+        node.stop()
+
+
+def test_lost_token_frame():
+    nodes = start_ring(31000)
+    source, lossy, target = nodes[1], nodes[2], nodes[3]
+    delivered, consumer = collect(target)
+    try:
+        sent = 0
+        for i in range(50):
+            source.put_send_requests(OrderReady(('localhost', 5006), sent, target.id))
+            sent += 1
+            time.sleep(0.001)
+        drops = drop(lossy, 'FRAME')
+        while not drops:
+            source.put_send_requests(OrderReady(('localhost', 5006), sent, target.id))
+            sent += 1
+            time.sleep(0.001)
+        for i in range(50):
+            source.put_send_requests(OrderReady(('localhost', 5006), sent, target.id))
+            sent += 1
+
+        assert wait_for(lambda: len(delivered) >= sent)
+        tickets = [ticket_no for t, ticket_no in delivered]
+        # every message once: the messages of the lost frame are sent again, the duplicates are dropped
+        assert sorted(tickets) == list(range(sent))
+        recovery = next(t for t, ticket_no in delivered if t > drops[0]) - drops[0]
+        assert recovery < LOSS_TIMEOUT * 1.5
+        assert max(node.generation for node in nodes) == 1
+    finally:
+        stop(nodes, target, consumer)
+
+
+def test_lost_wake():
+    nodes = start_ring(31100)
+    source, target = nodes[1], nodes[3]
+    delivered, consumer = collect(target)
+    try:
+        assert wait_for(lambda: nodes[0].parked_token is not None)
+        drops = drop(source, 'WAKE')
+        source.put_send_requests(OrderReady(('localhost', 5006), 1, target.id))
+
+        assert wait_for(lambda: len(delivered) >= 1)
+        # the claim finds the parked token, which goes around again (no second claim, no regenerated token)
+        recovery = delivered[0][0] - drops[0]
+        assert recovery < LOSS_TIMEOUT * 1.5
+        source.put_send_requests(OrderReady(('localhost', 5006), 2, target.id))
+        assert wait_for(lambda: len(delivered) >= 2)
+        time.sleep(0.05)
+        assert [ticket_no for t, ticket_no in delivered] == [1, 2]
+        assert all(node.claiming is None for node in nodes)
+    finally:
+        stop(nodes, target, consumer)
@@ -0,0 +1,55 @@
+import logging
+import os
+import socket
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import codec
+import transport
+
+
+def frame(o):
+    data = codec.encode_message(o)
+    return transport.FRAME_LENGTH.pack(len(data)) + data
+
+
+# a frame length bigger than MAX_FRAME closes the connection, without allocating the frame
+def test_oversized_frame():
+    t = transport.TcpTransport(logging.getLogger('test'))
+    t.bind(('localhost', 31500))
+    t.settimeout(0.2)
+    try:
+        with socket.create_connection(('localhost', 31500)) as bad:
+            bad.sendall(frame(('localhost', 1)) + transport.FRAME_LENGTH.pack(0xfffffff0) + b'x' * 100)
+            for i in range(3):
+                assert t.recv() == (None, None)
+            assert not t.incoming
+        with socket.create_connection(('localhost', 31500)) as good:
+            good.sendall(frame(('localhost', 2)) + frame({'method': 'WAKE', 'args': 3}))
+            assert t.recv() == ({'method': 'WAKE', 'args': 3}, ('localhost', 2))
+    finally:
+        t.close()
+
+
+# the connections to the addresses not retained are closed, after their buffered frames
+def test_retain():
+    receiver = transport.TcpTransport(logging.getLogger('test'))
+    receiver.bind(('localhost', 31501))
+    receiver.settimeout(0.2)
+    sender = transport.TcpTransport(logging.getLogger('test'))
+    sender.bind(('localhost', 31502))
+    try:
+        sender.send(('localhost', 31501), {'method': 'WAKE', 'args': 1})
+        sender.retain({('localhost', 31501)})
+        assert ('localhost', 31501) in sender.connections
+        sender.send(('localhost', 31501), {'method': 'WAKE', 'args': 2})
+        sender.retain({('localhost', 31503)})
+        assert not sender.connections
+        assert receiver.recv() == ({'method': 'WAKE', 'args': 1}, ('localhost', 31502))
+        assert receiver.recv() == ({'method': 'WAKE', 'args': 2}, ('localhost', 31502))
+        assert receiver.recv() == (None, None)
+        assert not receiver.incoming
+    finally:
+        sender.close()
+        receiver.close()